@@ -0,0 +1,242 @@
+import argparse
+import glob
+import gzip
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import struct
+import subprocess
+import time
+import zlib
+
+import numpy as np
+
+from lambda_function import ParallelGzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import blosc2
+except ImportError:
+    blosc2 = None
+
+'''
+Measures candidate storage codecs for NIfTI volumes: compression ratio, compress and
+decompress throughput, and peak RSS, written to JSON.
+
+The corpus is either real .nii files (--corpus DIR) or synthetic ones: a 3D int16
+T1-like volume and a 4D int16 BOLD-like series, each a noisy head-shaped ellipsoid on
+a zero background, which compresses much like the real thing. Each codec runs in a
+fresh process so its peak RSS isn't inflated by the codecs before it. Codecs whose
+package or binary isn't available are skipped and listed in the output.
+
+Codecs:
+  gzip-N         zlib at level N (what python's gzip module produces)
+  parallel-gzip  the in-process block-parallel gzip used by the Lambda
+  pigz-N         pigz -N, if pigz is on PATH (the Lambda's previous approach)
+  zstd-N         Zstandard at level N
+  shuffle-*      byte-shuffle by the voxel size, then zlib or zstd
+  blosc2-*       Blosc2 with shuffle, if blosc2 is installed
+
+Example:
+python benchmark_codecs.py --output codec_benchmark.json
+python benchmark_codecs.py --corpus /data/nii --repeat 3 --output codec_benchmark.json
+'''
+
+NIFTI_DATATYPES = {np.dtype(np.int16): (4, 16), np.dtype(np.float32): (16, 32)}
+
+
+def nifti_bytes(volume, voxel_size=(1.0, 1.0, 1.0, 2.0)):
+    """Serialise an array as a minimal single-file NIfTI-1 (.nii) image"""
+    datatype, bitpix = NIFTI_DATATYPES[volume.dtype]
+    dim = [volume.ndim] + list(volume.shape) + [1] * (7 - volume.ndim)
+    header = bytearray(348)
+    struct.pack_into('<i', header, 0, 348)
+    struct.pack_into('<8h', header, 40, *dim)
+    struct.pack_into('<hh', header, 70, datatype, bitpix)
+    struct.pack_into('<8f', header, 76, 1.0, *voxel_size, 1.0, 1.0, 1.0)
+    struct.pack_into('<f', header, 108, 352.0)  # vox_offset
+    struct.pack_into('<f', header, 112, 1.0)  # scl_slope
+    header[344:348] = b'n+1\x00'
+    # Four zero bytes say there are no header extensions
+    return bytes(header) + b'\x00' * 4 + volume.tobytes(order='F')
+
+
+def head_volume(shape, rng):
+    """A noisy ellipsoid of tissue on a zero background, roughly like a skull-stripped head"""
+    axes = [np.linspace(-1, 1, n) for n in shape]
+    grid = np.meshgrid(*axes, indexing='ij')
+    inside = sum(g ** 2 for g in grid) < 0.8
+    tissue = 600 + 200 * np.sin(grid[0] * 7) * np.cos(grid[1] * 5)
+    return np.where(inside, tissue + rng.normal(0, 40, shape), 0)
+
+
+def synthetic_corpus(directory, scale=1.0):
+    """Write the synthetic corpus to directory and return the file paths"""
+    rng = np.random.default_rng(0)
+    os.makedirs(directory, exist_ok=True)
+    t1_shape = tuple(max(8, int(n * scale)) for n in (176, 240, 256))
+    bold_shape = tuple(max(8, int(n * scale)) for n in (90, 90, 60))
+    volumes = {
+        'synthetic_T1w.nii': head_volume(t1_shape, rng).astype(np.int16),
+        'synthetic_bold.nii': np.stack(
+            [head_volume(bold_shape, rng) for _ in range(max(2, int(40 * scale)))], axis=-1).astype(np.int16)
+    }
+    paths = []
+    for name, volume in volumes.items():
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(nifti_bytes(volume))
+        paths.append(path)
+    return paths
+
+
+def byte_shuffle(data, itemsize):
+    """Group the k-th byte of every voxel together, which makes slowly varying data far more compressible"""
+    body = np.frombuffer(data, dtype=np.uint8, count=len(data) - len(data) % itemsize)
+    return body.reshape(-1, itemsize).T.tobytes() + data[len(body):]
+
+
+def byte_unshuffle(data, itemsize):
+    body = np.frombuffer(data, dtype=np.uint8, count=len(data) - len(data) % itemsize)
+    return body.reshape(itemsize, -1).T.tobytes() + data[len(body):]
+
+
+def pigz(level):
+    def compress(data):
+        return subprocess.run(['pigz', f'-{level}', '-c'], input=data, capture_output=True, check=True).stdout
+
+    def decompress(data):
+        return subprocess.run(['pigz', '-d', '-c'], input=data, capture_output=True, check=True).stdout
+    return compress, decompress
+
+
+def make_codecs(itemsize=2):
+    """Name -> (compress, decompress) for every codec available here, plus the names skipped"""
+    codecs = {}
+    skipped = []
+    for level in (1, 6, 9):
+        codecs[f'gzip-{level}'] = (lambda data, level=level: gzip.compress(data, compresslevel=level, mtime=0),
+                                   gzip.decompress)
+    codecs['parallel-gzip'] = (lambda data: b''.join(ParallelGzip(level=1).compress([data])), gzip.decompress)
+    codecs['shuffle-zlib-1'] = (lambda data: zlib.compress(byte_shuffle(data, itemsize), 1),
+                                lambda data: byte_unshuffle(zlib.decompress(data), itemsize))
+
+    if shutil.which('pigz'):
+        for level in (1, 6):
+            codecs[f'pigz-{level}'] = pigz(level)
+    else:
+        skipped.append('pigz')
+
+    if zstandard:
+        for level in (1, 3, 9, 19):
+            codecs[f'zstd-{level}'] = (
+                lambda data, level=level: zstandard.ZstdCompressor(level=level, threads=-1).compress(data),
+                lambda data: zstandard.ZstdDecompressor().decompress(data))
+        codecs['shuffle-zstd-3'] = (
+            lambda data: zstandard.ZstdCompressor(level=3).compress(byte_shuffle(data, itemsize)),
+            lambda data: byte_unshuffle(zstandard.ZstdDecompressor().decompress(data), itemsize))
+    else:
+        skipped.append('zstd')
+
+    if blosc2:
+        for name, codec in (('lz4', blosc2.Codec.LZ4), ('zstd', blosc2.Codec.ZSTD)):
+            codecs[f'blosc2-{name}-shuffle'] = (
+                lambda data, codec=codec: blosc2.compress2(data, typesize=itemsize, codec=codec, clevel=5,
+                                                           filters=[blosc2.Filter.SHUFFLE]),
+                blosc2.decompress2)
+    else:
+        skipped.append('blosc2')
+    return codecs, skipped
+
+
+def nifti_itemsize(data):
+    """Bytes per voxel from a NIfTI-1 header (2 if the header isn't recognised)"""
+    if len(data) >= 348 and struct.unpack_from('<i', data, 0)[0] == 348:
+        return max(1, struct.unpack_from('<h', data, 72)[0] // 8)
+    return 2
+
+
+def measure(path, codec_name, repeat):
+    """Run one codec over one file (in a fresh worker process) and return its measurements"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    compress, decompress = make_codecs(nifti_itemsize(data))[0][codec_name]
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    compress_times, decompress_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        compressed = compress(data)
+        compress_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        restored = decompress(compressed)
+        decompress_times.append(time.perf_counter() - start)
+    if restored != data:
+        raise ValueError(f"{codec_name} did not round-trip {path}")
+
+    megabytes = len(data) / (1024 * 1024)
+    # ru_maxrss is in KiB on Linux; pigz runs in a child process, so its RSS isn't counted
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'file': os.path.basename(path),
+        'codec': codec_name,
+        'bytes': len(data),
+        'compressed_bytes': len(compressed),
+        'ratio': round(len(data) / len(compressed), 3),
+        'compress_mb_per_s': round(megabytes / min(compress_times), 1),
+        'decompress_mb_per_s': round(megabytes / min(decompress_times), 1),
+        'peak_rss_mb': round(peak / 1024, 1),
+        'peak_rss_over_baseline_mb': round((peak - baseline) / 1024, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark compression codecs on NIfTI files')
+    parser.add_argument('--corpus', help='Directory of .nii files to use instead of the synthetic corpus')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Scale factor for the synthetic volumes (1.0 is roughly full ABCD size)')
+    parser.add_argument('--workdir', default='codec_benchmark_corpus', help='Where the synthetic corpus is written')
+    parser.add_argument('--codecs', nargs='+', help='Only run these codecs (default: all available)')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per measurement; the fastest is reported')
+    parser.add_argument('--output', help='Optional JSON file for the results')
+    args = parser.parse_args()
+
+    if args.corpus:
+        paths = sorted(glob.glob(os.path.join(args.corpus, '*.nii')))
+    else:
+        paths = synthetic_corpus(args.workdir, args.scale)
+    if not paths:
+        parser.error('No .nii files found')
+
+    codecs, skipped = make_codecs()
+    names = [name for name in codecs if not args.codecs or name in args.codecs]
+    if skipped:
+        print(f"Skipping unavailable codecs: {', '.join(skipped)}")
+
+    results = []
+    # One process per measurement, so each codec's peak RSS is its own
+    context = multiprocessing.get_context('spawn')
+    for path in paths:
+        for name in names:
+            with context.Pool(1) as pool:
+                result = pool.apply(measure, (path, name, args.repeat))
+            results.append(result)
+            print(f"{result['file']:>24} {name:>22}: ratio {result['ratio']:6.2f}, "
+                  f"compress {result['compress_mb_per_s']:7.1f} MB/s, "
+                  f"decompress {result['decompress_mb_per_s']:7.1f} MB/s, peak RSS {result['peak_rss_mb']} MB")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'files': [os.path.basename(path) for path in paths],
+                       'skipped_codecs': skipped,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,58 +1,246 @@
 import boto3
+import contextlib
 import os
 import json
-import subprocess
-import tempfile
-from typing import Dict
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, Optional
 from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Compression settings. COMPRESS_LEVEL 1 matches the pigz -1 this replaced; blocks of
+# COMPRESS_BLOCK_SIZE are deflated on one pool of COMPRESS_THREADS threads (zlib releases
+# the GIL), shared by all the tasks in an invocation.
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 1))
+COMPRESS_THREADS = int(os.environ.get('COMPRESS_THREADS', os.cpu_count() or 2))
+COMPRESS_BLOCK_SIZE = int(os.environ.get('COMPRESS_BLOCK_SIZE', 1024 * 1024))
+
+# Transfer settings: the source is read in RANGE_SIZE ranged GETs, RANGE_PREFETCH ahead,
+# and the output is written in PART_SIZE multipart parts (S3's minimum is 5 MiB) by
+# PART_UPLOAD_WORKERS threads. These are per invocation: concurrent tasks split them
+# (at least one each), which bounds the memory held in ranges and parts across tasks.
+RANGE_SIZE = int(os.environ.get('RANGE_SIZE', 8 * 1024 * 1024))
+RANGE_PREFETCH = int(os.environ.get('RANGE_PREFETCH', 2))
+PART_SIZE = int(os.environ.get('PART_SIZE', 8 * 1024 * 1024))
+PART_UPLOAD_WORKERS = int(os.environ.get('PART_UPLOAD_WORKERS', 4))
+
+# Number of S3 Batch tasks (files) from one invocation compressed at the same time
+TASK_CONCURRENCY = int(os.environ.get('TASK_CONCURRENCY', 8))
+
+# Enough connections for every task's range and part threads (rounded up to one each)
+# plus the task threads themselves
+S3_MAX_CONNECTIONS = RANGE_PREFETCH + PART_UPLOAD_WORKERS + 4 * TASK_CONCURRENCY
+
+# gzip member header: deflate, no flags, no mtime, unknown OS
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+# Deflate can refer back at most 32 KiB, so that much of the previous block primes the next
+DEFLATE_WINDOW = 32 * 1024
+
+
+class ParallelGzip:
+    """
+    pigz-style parallel gzip compressor over a stream of chunks.
+
+    The input is cut into block_size blocks, each deflated independently on a thread
+    pool with the previous block's last 32 KiB as a preset dictionary, so the ratio
+    stays close to single-threaded gzip. Every block but the last ends on a sync flush
+    (byte aligned, not final), so the blocks concatenate into one valid deflate stream.
+    The CRC and length for the gzip trailer are computed in order as blocks are queued.
+
+    compress() can run its blocks on a shared executor (e.g. one pool for several
+    concurrent files) with max_pending capping how many of its blocks are held at once.
+    """
+
+    def __init__(self, level: int = COMPRESS_LEVEL, threads: int = COMPRESS_THREADS,
+                 block_size: int = COMPRESS_BLOCK_SIZE):
+        self.level = level
+        self.threads = max(1, threads)
+        self.block_size = block_size
+
+    def _deflate_block(self, data: bytes, dictionary: bytes, last: bool) -> bytes:
+        if dictionary:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=dictionary)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def _blocks(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Re-cut arbitrary chunks into block_size blocks"""
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer += chunk
+            while len(buffer) >= self.block_size:
+                yield bytes(buffer[:self.block_size])
+                del buffer[:self.block_size]
+        if buffer:
+            yield bytes(buffer)
+
+    def compress(self, chunks: Iterable[bytes], executor: Optional[Executor] = None,
+                 max_pending: Optional[int] = None) -> Iterator[bytes]:
+        """Yield the gzip-compressed form of the concatenated chunks, piece by piece"""
+        yield GZIP_HEADER
+        blocks = self._blocks(chunks)
+        block = next(blocks, b'')
+        following = next(blocks, None)
+        if following is None:
+            # Small files fit in one block; skip the thread pool
+            yield self._deflate_block(block, b'', True)
+            yield struct.pack('<II', zlib.crc32(block), len(block) & 0xffffffff)
+            return
+
+        crc = 0
+        size = 0
+        dictionary = b''
+        pending = deque()
+        # By default at most two blocks per thread are held, compressed or waiting to be
+        max_pending = max_pending or 2 * self.threads
+        with contextlib.ExitStack() as stack:
+            if executor is None:
+                executor = stack.enter_context(ThreadPoolExecutor(max_workers=self.threads))
+            while True:
+                last = following is None
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                pending.append(executor.submit(self._deflate_block, block, dictionary, last))
+                dictionary = block[-DEFLATE_WINDOW:]
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+                if last:
+                    break
+                block = following
+                following = next(blocks, None)
+            while pending:
+                yield pending.popleft().result()
+        yield struct.pack('<II', crc, size & 0xffffffff)
+
 
 class S3Compressor:
-    def __init__(self):
+    def __init__(self, level: int = COMPRESS_LEVEL, threads: int = COMPRESS_THREADS):
         # Configure S3 client with retry strategy
         self.s3 = boto3.client('s3', config=Config(
             retries={'max_attempts': 3, 'mode': 'adaptive'},
-            max_pool_connections=50
+            max_pool_connections=S3_MAX_CONNECTIONS
         ))
-        self.tmp_dir = tempfile.mkdtemp()
+        self.gzip = ParallelGzip(level=level, threads=threads)
+        # One compression pool for every file being compressed at the same time
+        self.compress_pool = ThreadPoolExecutor(max_workers=self.gzip.threads)
 
-    def _download_file(self, bucket: str, key: str, local_path: str) -> bool:
-        """Download a single file from S3"""
-        try:
-            self.s3.download_file(bucket, key, local_path)
-            return True
-        except Exception as e:
-            print(f"Error downloading {key}: {str(e)}")
-            return False
+    def _read_ranges(self, bucket: str, key: str, prefetch: int = RANGE_PREFETCH) -> Iterator[bytes]:
+        """
+        Stream an object as RANGE_SIZE ranged GETs, keeping prefetch requests ahead.
+        The first GET also reports the object's size, so small files cost one request.
+        """
+        def get_range(start):
+            return self.s3.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{start + RANGE_SIZE - 1}')
 
-    def _compress_file(self, input_path: str) -> str:
-        """Compress a file using pigz"""
         try:
-            # Use pigz with 2 threads (Lambda has 2 vCPUs) and fastest compression
-            process = subprocess.run(
-                ['pigz', '-1', '-p2', '-f', input_path],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            return f"{input_path}.gz"
-        except subprocess.CalledProcessError as e:
-            print(f"Compression error: {e.stderr}")
-            raise
-        except Exception as e:
-            print(f"Unexpected error during compression: {str(e)}")
+            first = get_range(0)
+        except ClientError as e:
+            # Ranges can't be satisfied on an empty object
+            if e.response['Error']['Code'] == 'InvalidRange':
+                return
             raise
+        size = int(first['ContentRange'].split('/')[-1])
+        yield first['Body'].read()
+
+        starts = deque(range(RANGE_SIZE, size, RANGE_SIZE))
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=prefetch + 1) as executor:
+            while starts or pending:
+                while starts and len(pending) <= prefetch:
+                    pending.append(executor.submit(get_range, starts.popleft()))
+                yield pending.popleft().result()['Body'].read()
+
+    def _upload_stream(self, stream: Iterable[bytes], bucket: str, key: str,
+                       workers: int = PART_UPLOAD_WORKERS) -> int:
+        """
+        Upload a stream of bytes as PART_SIZE multipart parts on workers threads, or with
+        a single PUT if it turns out smaller than one part.
+
+        Returns:
+            int: Number of bytes uploaded
+        """
+        buffer = bytearray()
+        upload_id = None
+        futures = []
+        in_flight = threading.BoundedSemaphore(2 * workers)
+        total = 0
+
+        def upload_part(part_number, data):
+            try:
+                response = self.s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                               PartNumber=part_number, Body=data)
+                return {'PartNumber': part_number, 'ETag': response['ETag']}
+            finally:
+                in_flight.release()
 
-    def _upload_file(self, local_path: str, bucket: str, key: str) -> bool:
-        """Upload a compressed file to S3"""
         try:
-            self.s3.upload_file(local_path, bucket, key)
-            return True
-        except Exception as e:
-            print(f"Error uploading {key}: {str(e)}")
-            return False
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for piece in stream:
+                    buffer += piece
+                    total += len(piece)
+                    while len(buffer) >= PART_SIZE:
+                        if upload_id is None:
+                            upload_id = self.s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+                        in_flight.acquire()
+                        futures.append(executor.submit(upload_part, len(futures) + 1, bytes(buffer[:PART_SIZE])))
+                        del buffer[:PART_SIZE]
+
+                if upload_id is None:
+                    self.s3.put_object(Bucket=bucket, Key=key, Body=bytes(buffer))
+                    return total
+                if buffer:
+                    in_flight.acquire()
+                    futures.append(executor.submit(upload_part, len(futures) + 1, bytes(buffer)))
+                parts = [future.result() for future in futures]
+
+            self.s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                              MultipartUpload={'Parts': parts})
+            return total
+        except Exception:
+            if upload_id is not None:
+                self.s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+
+    def compress_object(self, source_bucket: str, source_key: str, dest_bucket: str, dest_key: str,
+                        concurrency: int = 1) -> Dict:
+        """
+        Gzip an S3 object into another key entirely in memory: ranged GETs feed the
+        parallel compressor, which feeds a multipart upload. Nothing touches /tmp, so
+        the object size isn't limited by Lambda's ephemeral storage.
+
+        concurrency is how many files are being compressed at once; this one gets that
+        share of the prefetch, part upload and compression settings.
+        """
+        start = time.perf_counter()
+        bytes_in = 0
+
+        def counted(chunks):
+            nonlocal bytes_in
+            for chunk in chunks:
+                bytes_in += len(chunk)
+                yield chunk
+
+        chunks = counted(self._read_ranges(source_bucket, source_key, max(1, RANGE_PREFETCH // concurrency)))
+        compressed = self.gzip.compress(chunks, self.compress_pool, max(2, 2 * self.gzip.threads // concurrency))
+        bytes_out = self._upload_stream(compressed, dest_bucket, dest_key,
+                                        max(1, PART_UPLOAD_WORKERS // concurrency))
+        elapsed = time.perf_counter() - start
+        stats = {
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'seconds': elapsed,
+            'mb_per_second': bytes_in / (1024 * 1024) / elapsed if elapsed else 0.0
+        }
+        print(f"Compressed {source_key} ({bytes_in} -> {bytes_out} bytes) at {stats['mb_per_second']:.1f} MB/s")
+        return stats
 
     def process_file(self, source_bucket: str, source_key: str,
-                     dest_bucket: str, dest_key: str) -> Dict:
+                     dest_bucket: str, dest_key: str, concurrency: int = 1) -> Dict:
         """Process a single file for S3 Batch Operations"""
         result = {
             'key': source_key,
@@ -68,41 +256,19 @@ class S3Compressor:
                     'resultString': 'File is not a .nii file or is already compressed'
                 }
 
-            # Create temporary file paths
-            input_path = os.path.join(self.tmp_dir, os.path.basename(source_key))
-
-            # Download
-            if not self._download_file(source_bucket, source_key, input_path):
-                return {
-                    'resultCode': 'PermanentFailure',
-                    'resultString': 'Failed to download source file'
-                }
-
+            compressed_key = f"{os.path.splitext(dest_key)[0]}.nii.gz"
             try:
-                # Compress
-                compressed_path = self._compress_file(input_path)
-
-                # Upload compressed file
-                compressed_key = f"{os.path.splitext(dest_key)[0]}.nii.gz"
-                if not self._upload_file(compressed_path, dest_bucket, compressed_key):
-                    return {
-                        'resultCode': 'PermanentFailure',
-                        'resultString': 'Failed to upload compressed file'
-                    }
-
+                self.compress_object(source_bucket, source_key, dest_bucket, compressed_key, concurrency)
+            except ClientError as e:
                 return {
-                    'resultCode': 'Succeeded',
-                    'resultString': f'Successfully compressed and uploaded to {compressed_key}'
+                    'resultCode': 'PermanentFailure',
+                    'resultString': f'Failed to compress {source_key} to {compressed_key}: {str(e)}'
                 }
 
-            finally:
-                # Cleanup temporary files
-                for temp_file in [input_path, f"{input_path}.gz"]:
-                    try:
-                        if os.path.exists(temp_file):
-                            os.remove(temp_file)
-                    except Exception as e:
-                        print(f"Warning: Could not delete temporary file {temp_file}: {str(e)}")
+            return {
+                'resultCode': 'Succeeded',
+                'resultString': f'Successfully compressed and uploaded to {compressed_key}'
+            }
 
         except Exception as e:
             return {
@@ -110,15 +276,22 @@ class S3Compressor:
                 'resultString': f'Error processing file: {str(e)}'
             }
 
-def lambda_handler(event, context):
-    """AWS Lambda handler for S3 Batch Operations"""
-    try:
-        # Parse the S3 Batch Operations event
-        invocation_schema_version = event['invocationSchemaVersion']
-        invocation_id = event['invocationId']
-        task = event['tasks'][0]
-        task_id = task['taskId']
+# Kept for the life of the execution environment, so warm invocations reuse the client
+# and its connection pool instead of paying for a new one per invocation
+_compressor = None
+
+
+def get_compressor() -> S3Compressor:
+    """Return the compressor for this execution environment, creating it on first use"""
+    global _compressor
+    if _compressor is None:
+        _compressor = S3Compressor()
+    return _compressor
 
+
+def process_task(task: Dict, compressor: S3Compressor, concurrency: int = 1) -> Dict:
+    """Compress the object named by one S3 Batch task, returning that task's result"""
+    try:
         # Get source object information
         s3_key = task['s3Key']
         s3_bucket = task['s3BucketArn'].split(':')[-1]
@@ -130,30 +303,33 @@ def lambda_handler(event, context):
         # Calculate destination key
         dest_key = os.path.join(dest_prefix, s3_key) if dest_prefix else s3_key
 
-        # Process the file
-        compressor = S3Compressor()
-        result = compressor.process_file(s3_bucket, s3_key, dest_bucket, dest_key)
-
-        # Return the result in S3 Batch Operations format
-        return {
-            'invocationSchemaVersion': invocation_schema_version,
-            'treatMissingKeysAs': 'PermanentFailure',
-            'invocationId': invocation_id,
-            'results': [{
-                'taskId': task_id,
-                **result
-            }]
-        }
-
+        result = compressor.process_file(s3_bucket, s3_key, dest_bucket, dest_key, concurrency)
     except Exception as e:
-        # Handle any unexpected errors
-        return {
-            'invocationSchemaVersion': invocation_schema_version,
-            'treatMissingKeysAs': 'PermanentFailure',
-            'invocationId': invocation_id,
-            'results': [{
-                'taskId': task_id,
-                'resultCode': 'PermanentFailure',
-                'resultString': f"Unexpected error: {str(e)}"
-            }]
+        result = {
+            'resultCode': 'PermanentFailure',
+            'resultString': f"Unexpected error: {str(e)}"
         }
+    return {
+        'taskId': task['taskId'],
+        **result
+    }
+
+
+def lambda_handler(event, context):
+    """AWS Lambda handler for S3 Batch Operations"""
+    # Tasks run TASK_CONCURRENCY at a time on the shared compressor, splitting its
+    # compression pool and transfer settings between them; each gets its own result,
+    # and map() keeps the results in task order
+    tasks = event['tasks']
+    compressor = get_compressor()
+    concurrency = max(1, min(TASK_CONCURRENCY, len(tasks)))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda task: process_task(task, compressor, concurrency), tasks))
+
+    # Return the results in S3 Batch Operations format
+    return {
+        'invocationSchemaVersion': event['invocationSchemaVersion'],
+        'treatMissingKeysAs': 'PermanentFailure',
+        'invocationId': event['invocationId'],
+        'results': results
+    }
@@ -1,13 +1,24 @@
+import argparse
+import functools
+import gzip
+import hashlib
+import io
 import json
+import queue
+import struct
 import tarfile
+import threading
+import time
 import urllib.parse
-from io import BytesIO
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from io import RawIOBase, SEEK_CUR, SEEK_END, SEEK_SET
 import boto3
 import os
 import logging
 from botocore.exceptions import ClientError
 from botocore.config import Config
-from boto3.s3.transfer import TransferConfig
 import rapidgzip
 import resource
 
@@ -15,19 +26,688 @@ import resource
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Ranged-read settings for streaming archives out of S3. Peak memory for the compressed
+# side is roughly RANGE_BLOCK_SIZE * RANGE_CACHE_BLOCKS, whatever the archive size.
+RANGE_BLOCK_SIZE = int(os.environ.get('RANGE_BLOCK_SIZE', 8 * 1024 * 1024))
+RANGE_CACHE_BLOCKS = int(os.environ.get('RANGE_CACHE_BLOCKS', 8))
+RANGE_PREFETCH = int(os.environ.get('RANGE_PREFETCH', 3))
+
+# Member upload pipeline settings. Members up to SMALL_MEMBER_SIZE are read into memory
+# and uploaded by UPLOAD_WORKERS threads while the tar reader moves on; at most
+# UPLOAD_MEMORY_BUDGET bytes of member data are held waiting for upload at any time.
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 16))
+UPLOAD_MEMORY_BUDGET = int(os.environ.get('UPLOAD_MEMORY_BUDGET', 256 * 1024 * 1024))
+SMALL_MEMBER_SIZE = int(os.environ.get('SMALL_MEMBER_SIZE', 8 * 1024 * 1024))
+
+# Members larger than SMALL_MEMBER_SIZE are sent as multipart uploads, with up to
+# PART_UPLOAD_WORKERS parts uploading while decompression produces the next ones
+PART_UPLOAD_WORKERS = int(os.environ.get('PART_UPLOAD_WORKERS', 8))
+
+# Re-pack mode: with REPACK_NIFTI=1, .nii members are gzipped on the way out and written
+# as .nii.gz at REPACK_LEVEL (1 matches the pigz -1 used by compressS3niis), so the
+# separate compression batch job isn't needed
+REPACK_NIFTI = os.environ.get('REPACK_NIFTI', '0') == '1'
+REPACK_LEVEL = int(os.environ.get('REPACK_LEVEL', 1))
+# Members too large for the uploader pool are re-packed pigz-style: cut into
+# REPACK_BLOCK_SIZE blocks that are deflated in parallel (on as many threads as the
+# task's rapidgzip parallelization) while the tar reader carries on
+REPACK_BLOCK_SIZE = int(os.environ.get('REPACK_BLOCK_SIZE', 1024 * 1024))
+
+# A gzip member header: deflate, no flags, no mtime, unknown OS
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+# Deflate's window; each parallel block is primed with this much of the one before
+DEFLATE_WINDOW = 32 * 1024
+
+# Checkpointing: the members of an archive already in S3 are recorded in a JSON object
+# under CHECKPOINT_PREFIX (in CHECKPOINT_BUCKET, or the archive's bucket), saved at most
+# every CHECKPOINT_INTERVAL seconds. Extraction stops CHECKPOINT_TIMEOUT_MARGIN seconds
+# before the Lambda timeout and reports a TemporaryFailure, so S3 Batch retries the task
+# and the retry resumes from the checkpoint instead of starting over.
+CHECKPOINT_BUCKET = os.environ.get('CHECKPOINT_BUCKET')
+CHECKPOINT_PREFIX = os.environ.get('CHECKPOINT_PREFIX', '.fastunpack-checkpoints/')
+CHECKPOINT_INTERVAL = int(os.environ.get('CHECKPOINT_INTERVAL', 30))
+CHECKPOINT_TIMEOUT_MARGIN = int(os.environ.get('CHECKPOINT_TIMEOUT_MARGIN', 60))
+
+# Archive indexes: with INDEX_ARCHIVES=1, a full extraction also stores a rapidgzip seek
+# index (<archive>INDEX_SUFFIX) and a tar member table (<archive>MEMBERS_SUFFIX) next
+# to the archive, so single members can later be pulled out with extract_member()
+INDEX_ARCHIVES = os.environ.get('INDEX_ARCHIVES', '0') == '1'
+INDEX_SUFFIX = os.environ.get('INDEX_SUFFIX', '.gzindex')
+MEMBERS_SUFFIX = os.environ.get('MEMBERS_SUFFIX', '.members.json')
+
+# Number of archives from one S3 Batch invocation processed at the same time
+TASK_CONCURRENCY = int(os.environ.get('TASK_CONCURRENCY', 2))
+
+# Every thread that talks to S3 shares the one client below: per task, the member
+# uploaders, the part uploaders of a multipart member, the range prefetchers and the
+# tar reader itself. Its connection pool is sized for all of them, so they don't wait
+# on botocore's default of 10 connections.
+S3_MAX_CONNECTIONS = TASK_CONCURRENCY * (UPLOAD_WORKERS + PART_UPLOAD_WORKERS + RANGE_PREFETCH + 1)
+
 # Configure S3 client with retry configuration
 s3 = boto3.client('s3', 
     config=Config(
         retries = dict(
             max_attempts = 10,
             mode = 'adaptive'
-        )
+        ),
+        max_pool_connections = S3_MAX_CONNECTIONS
     )
 )
 
-def process_task(task):
+
+class S3RangeReader(RawIOBase):
+    """
+    Seekable, read-only file object over an S3 object, backed by ranged GETs.
+
+    The object is read in block_size blocks kept in a small LRU ring (max_blocks). Each
+    read schedules the next `prefetch` blocks on background threads, so sequential reads
+    rarely wait on S3. rapidgzip seeks around its read-ahead window while decompressing
+    in parallel; those seeks are served from the ring and only cost another GET if the
+    block has already been evicted.
+    """
+
+    def __init__(self, client, bucket, key, size=None, block_size=RANGE_BLOCK_SIZE,
+                 max_blocks=RANGE_CACHE_BLOCKS, prefetch=RANGE_PREFETCH):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size if size is not None else client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.block_size = block_size
+        self.max_blocks = max(max_blocks, prefetch + 1)
+        self.prefetch = prefetch
+        self.position = 0
+        self.requests = 0
+        self.bytes_fetched = 0
+        self._blocks = OrderedDict()  # block index -> Future[bytes]
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(prefetch, 1))
+
+    def _fetch(self, index):
+        start = index * self.block_size
+        end = min(start + self.block_size, self.size) - 1
+        data = self.client.get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={start}-{end}')['Body'].read()
+        with self._lock:
+            self.requests += 1
+            self.bytes_fetched += len(data)
+        return data
+
+    def _block(self, index):
+        """Get (or start fetching) a block, marking it most recently used"""
+        with self._lock:
+            future = self._blocks.get(index)
+            if future is None:
+                future = self._executor.submit(self._fetch, index)
+                self._blocks[index] = future
+            self._blocks.move_to_end(index)
+            while len(self._blocks) > self.max_blocks:
+                self._blocks.popitem(last=False)
+            return future
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=SEEK_SET):
+        if whence == SEEK_SET:
+            self.position = offset
+        elif whence == SEEK_CUR:
+            self.position += offset
+        elif whence == SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        index, offset = divmod(self.position, self.block_size)
+        # Queue the read-ahead first so the block being read ends up most recently used
+        for ahead in range(1, self.prefetch + 1):
+            if (index + ahead) * self.block_size < self.size:
+                self._block(index + ahead)
+        data = self._block(index).result()
+
+        n = min(len(buffer), len(data) - offset)
+        buffer[:n] = data[offset:offset + n]
+        self.position += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._blocks.clear()
+        super().close()
+
+
+class ParallelGzip:
+    """
+    pigz-style parallel gzip compressor over a stream of chunks (as in compressS3niis).
+
+    The input is cut into block_size blocks, each deflated independently on a thread
+    pool with the previous block's last 32 KiB as a preset dictionary, so the ratio
+    stays close to single-threaded gzip. Every block but the last ends on a sync flush
+    (byte aligned, not final), so the blocks concatenate into one valid deflate stream.
+    The CRC and length for the gzip trailer are computed in order as blocks are queued.
+    """
+
+    def __init__(self, level=REPACK_LEVEL, threads=None, block_size=REPACK_BLOCK_SIZE):
+        self.level = level
+        self.threads = max(1, threads or os.cpu_count() or 1)
+        self.block_size = block_size
+
+    def _deflate_block(self, data, dictionary, last):
+        if dictionary:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=dictionary)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def _blocks(self, chunks):
+        """Re-cut arbitrary chunks into block_size blocks"""
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer += chunk
+            while len(buffer) >= self.block_size:
+                yield bytes(buffer[:self.block_size])
+                del buffer[:self.block_size]
+        if buffer:
+            yield bytes(buffer)
+
+    def compress(self, chunks):
+        """Yield the gzip-compressed form of the concatenated chunks, piece by piece"""
+        yield GZIP_HEADER
+        blocks = self._blocks(chunks)
+        block = next(blocks, b'')
+        following = next(blocks, None)
+        if following is None:
+            # Small members fit in one block; skip the thread pool
+            yield self._deflate_block(block, b'', True)
+            yield struct.pack('<II', zlib.crc32(block), len(block) & 0xffffffff)
+            return
+
+        crc = 0
+        size = 0
+        dictionary = b''
+        pending = deque()
+        # At most two blocks per thread are held, compressed or waiting to be
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            while True:
+                last = following is None
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                pending.append(executor.submit(self._deflate_block, block, dictionary, last))
+                dictionary = block[-DEFLATE_WINDOW:]
+                if len(pending) >= 2 * self.threads:
+                    yield pending.popleft().result()
+                if last:
+                    break
+                block = following
+                following = next(blocks, None)
+            while pending:
+                yield pending.popleft().result()
+        yield struct.pack('<II', crc, size & 0xffffffff)
+
+
+class GzipCompressingReader(RawIOBase):
+    """
+    Read-only file object that returns the gzip-compressed form of another stream.
+
+    Lets a large member be compressed as it is decompressed out of the tar and cut into
+    multipart upload parts, without ever holding the whole member. The deflating is
+    done by a ParallelGzip on `threads` threads, so the reading thread only moves data.
+    """
+
+    def __init__(self, fileobj, level=REPACK_LEVEL, read_size=1024 * 1024, threads=None):
+        self.fileobj = fileobj
+        self.read_size = read_size
+        self._pieces = ParallelGzip(level, threads).compress(iter(lambda: fileobj.read(read_size), b''))
+        self._buffer = bytearray()
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self._buffer) < len(buffer) and not self._eof:
+            piece = next(self._pieces, None)
+            if piece is None:
+                self._eof = True
+            else:
+                self._buffer += piece
+        n = min(len(buffer), len(self._buffer))
+        buffer[:n] = self._buffer[:n]
+        del self._buffer[:n]
+        return n
+
+    def close(self):
+        # Stop the compressor (and its thread pool) if the upload gave up part way
+        self._pieces.close()
+        super().close()
+
+
+class BoundedReader(RawIOBase):
+    """Read-only file object over the next `size` bytes of another stream"""
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = 0
+        while n < len(buffer) and self.remaining:
+            data = self.fileobj.read(min(len(buffer) - n, self.remaining))
+            if not data:
+                break
+            buffer[n:n + len(data)] = data
+            n += len(data)
+            self.remaining -= len(data)
+        return n
+
+
+class MemoryBudget:
+    """Counting semaphore over bytes: acquire blocks until the bytes fit under the limit"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, n):
+        with self._condition:
+            # A single item bigger than the whole budget is let through on its own
+            while self.used and self.used + n > self.limit:
+                self._condition.wait()
+            self.used += n
+
+    def release(self, n):
+        with self._condition:
+            self.used -= n
+            self._condition.notify_all()
+
+
+class MemberUploader:
+    """
+    Consumer side of the extraction pipeline: uploads tar member payloads from a bounded
+    queue on a pool of threads.
+
+    The tar reader (producer) calls submit() with each member's bytes and carries on
+    decompressing while earlier members upload, so many small sidecar files are in flight
+    at once instead of paying one round trip each in turn. submit() blocks when the
+    memory budget is spent, which keeps decompression from running ahead of S3.
+    """
+
+    def __init__(self, client, bucket, max_workers=UPLOAD_WORKERS, memory_budget=UPLOAD_MEMORY_BUDGET,
+                 skip_existing=False):
+        self.client = client
+        self.bucket = bucket
+        self.skip_existing = skip_existing
+        self.skipped = 0
+        self.budget = MemoryBudget(memory_budget)
+        self.error = None
+        self.uploaded = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_workers * 4)
+        self._workers = [threading.Thread(target=self._run, daemon=True) for _ in range(max_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            key, data, content_type, compress_level, on_uploaded = item
+            try:
+                if self.error is None:
+                    extra = {'ContentType': content_type} if content_type else {}
+                    # zlib releases the GIL, so members compress in parallel across the workers
+                    body = gzip.compress(data, compresslevel=compress_level, mtime=0) if compress_level else data
+                    etag = self._existing_etag(key, body) if self.skip_existing else None
+                    if etag:
+                        with self._lock:
+                            self.skipped += 1
+                    else:
+                        etag = self.client.put_object(Bucket=self.bucket, Key=key, Body=body, **extra)['ETag']
+                        with self._lock:
+                            self.uploaded += 1
+                        logger.info(f"Uploaded {key}")
+                    if on_uploaded:
+                        on_uploaded(etag)
+            except Exception as e:
+                logger.error(f"Error uploading {key}: {str(e)}")
+                with self._lock:
+                    if self.error is None:
+                        self.error = e
+            finally:
+                self.budget.release(len(data))
+
+    def _existing_etag(self, key, body):
+        """Return the destination's ETag if it already holds exactly body, else None"""
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError:
+            return None
+        if response['ContentLength'] == len(body) and response['ETag'].strip('"') == hashlib.md5(body).hexdigest():
+            return response['ETag']
+        return None
+
+    def submit(self, key, data, content_type=None, compress_level=None, on_uploaded=None):
+        """
+        Queue one member for upload, blocking while the memory budget is spent.
+        If compress_level is given, the worker gzips data at that level before uploading.
+        on_uploaded is called with the object's ETag once it is in S3.
+        """
+        if self.error is not None:
+            raise self.error
+        self.budget.acquire(len(data))
+        self._queue.put((key, data, content_type, compress_level, on_uploaded))
+
+    def close(self):
+        """Wait for every queued upload, then raise the first upload error, if any"""
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self.error is not None:
+            raise self.error
+
+
+def upload_member_multipart(client, bucket, key, file_obj, size, part_size,
+                            content_type=None, max_workers=PART_UPLOAD_WORKERS, metadata=None):
+    """
+    Upload one large tar member as a multipart upload, feeding parts to concurrent UploadPart
+    calls while the rest of the member is still being decompressed.
+
+    upload_fileobj can't parallelize parts from an unseekable tar member, so parts are cut
+    here instead: each part_size read from the member is handed to a thread pool, with at
+    most 2 * max_workers parts in memory. Any failure aborts the upload so no orphaned parts
+    are left behind.
+
+    Returns:
+        str: ETag of the completed object
+    """
+    # S3 allows at most 10,000 parts per upload
+    part_size = max(part_size, -(-size // 10000))
+    start = time.monotonic()
+    extra = {'ContentType': content_type} if content_type else {}
+    if metadata:
+        extra['Metadata'] = metadata
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key, **extra)['UploadId']
+    in_flight = threading.BoundedSemaphore(2 * max_workers)
+
+    def upload_part(part_number, data):
+        try:
+            response = client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                          PartNumber=part_number, Body=data)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            in_flight.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            part_number = 1
+            while True:
+                in_flight.acquire()
+                data = file_obj.read(part_size)
+                if not data and part_number > 1:
+                    in_flight.release()
+                    break
+                futures.append(executor.submit(upload_part, part_number, data))
+                part_number += 1
+                if len(data) < part_size:
+                    break
+            parts = [future.result() for future in futures]
+
+        etag = client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                                MultipartUpload={'Parts': parts})['ETag']
+    except Exception:
+        client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+    elapsed = time.monotonic() - start
+    throughput = size / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+    logger.info(f"Uploaded {key} ({size} bytes in {len(parts)} parts) at {throughput:.1f} MB/s")
+    return etag
+
+
+def existing_member_etag(client, bucket, key, source):
+    """
+    Return the ETag of key if it is a completed multipart upload of the member
+    identified by source (its 'fastunpack-source' metadata), else None. Multipart ETags
+    aren't MD5s of the content, so this tag is how a retry recognises a large member
+    that finished uploading after the last checkpoint save.
+    """
+    try:
+        response = client.head_object(Bucket=bucket, Key=key)
+    except ClientError:
+        return None
+    if response.get('Metadata', {}).get('fastunpack-source') == source:
+        return response['ETag']
+    return None
+
+
+class ExtractionTimeout(Exception):
+    """Raised when extraction stops early to checkpoint before the Lambda times out"""
+
+
+class ExtractionCheckpoint:
+    """
+    Record of which members of one archive are already in S3, kept as a JSON object.
+
+    Members are marked done (with their tar header offset, size and ETag) as their uploads
+    finish, which can be out of order. resume_offset is the header offset of the earliest
+    member not yet done: everything before it is complete, so a retry can seek the
+    decompressed stream straight there and skip any later members already recorded.
+    The checkpoint only applies to the same archive (matched by ETag).
+    """
+
+    def __init__(self, client, bucket, tgz_key, archive_etag, interval=CHECKPOINT_INTERVAL):
+        self.client = client
+        self.bucket = CHECKPOINT_BUCKET or bucket
+        self.key = f"{CHECKPOINT_PREFIX}{tgz_key}.json"
+        self.archive_etag = archive_etag
+        self.interval = interval
+        self.members = {}  # member name -> {'offset', 'size', 'etag'}
+        self.resume_offset = 0
+        self.resumed = False
+        self._started = deque()  # header offsets of members handed off, in tar order
+        self._done = set()
+        self._next_offset = 0
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Pick up the checkpoint left by an earlier attempt at this archive, if there is one"""
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self.key)['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return self
+            raise
+        checkpoint = json.loads(body)
+        if checkpoint['archive_etag'] != self.archive_etag:
+            logger.info(f"Ignoring checkpoint s3://{self.bucket}/{self.key}: archive has changed")
+            return self
+        self.members = checkpoint['members']
+        self.resume_offset = self._next_offset = checkpoint['resume_offset']
+        self.resumed = True
+        logger.info(f"Resuming from checkpoint: {len(self.members)} members done, "
+                    f"seeking to offset {self.resume_offset}")
+        return self
+
+    def is_done(self, name):
+        return name in self.members
+
+    def start(self, offset):
+        """Note that the member whose header is at offset has been handed off for upload"""
+        with self._lock:
+            self._started.append(offset)
+
+    def done(self, name, offset, size, etag):
+        with self._lock:
+            self.members[name] = {'offset': offset, 'size': size, 'etag': etag}
+            self._done.add(offset)
+            self._dirty = True
+
+    def advance(self, next_offset):
+        """Note the offset of the next tar header once every earlier member has been handed off"""
+        with self._lock:
+            self._next_offset = next_offset
+            self._dirty = True
+
+    def save(self, force=False):
+        """Write the checkpoint if it has changed, at most every interval seconds unless forced"""
+        with self._lock:
+            if not self._dirty or (not force and time.monotonic() - self._saved_at < self.interval):
+                return
+            while self._started and self._started[0] in self._done:
+                self._done.discard(self._started.popleft())
+            self.resume_offset = self._started[0] if self._started else self._next_offset
+            body = json.dumps({
+                'archive_etag': self.archive_etag,
+                'resume_offset': self.resume_offset,
+                'members': self.members
+            })
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        self.client.put_object(Bucket=self.bucket, Key=self.key, Body=body)
+
+    def delete(self):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key)
+
+
+class ArchiveIndex:
+    """
+    Random-access index for one .tgz archive in S3.
+
+    Pairs rapidgzip's seek index (deflate block boundaries plus the 32 KiB window
+    needed to restart decompression at each) with a table of tar members
+    (name -> uncompressed data offset and size). With both, one member can be read by
+    fetching and decompressing only the few blocks around it instead of the whole
+    archive. Both parts are stored next to the archive and tied to its ETag, so an
+    index for a since-replaced archive is never used.
+    """
+
+    def __init__(self, archive_etag, members, gzip_index):
+        self.archive_etag = archive_etag
+        self.members = members  # member name -> {'offset', 'size'}
+        self.gzip_index = gzip_index
+
+    @staticmethod
+    def keys(tgz_key):
+        return f"{tgz_key}{INDEX_SUFFIX}", f"{tgz_key}{MEMBERS_SUFFIX}"
+
+    @classmethod
+    def from_stream(cls, archive_etag, members, gz_stream):
+        """Finish decompressing gz_stream so its seek index covers the whole archive, then export it"""
+        gz_stream.seek(0, SEEK_END)
+        buffer = io.BytesIO()
+        gz_stream.export_index(buffer)
+        return cls(archive_etag, members, buffer.getvalue())
+
+    @classmethod
+    def load(cls, client, bucket, tgz_key, archive_etag):
+        """Load the stored index for the archive, or None if there is no current one"""
+        index_key, members_key = cls.keys(tgz_key)
+        try:
+            table = json.loads(client.get_object(Bucket=bucket, Key=members_key)['Body'].read())
+            if table['archive_etag'] != archive_etag:
+                logger.info(f"Ignoring index for {tgz_key}: archive has changed")
+                return None
+            gzip_index = client.get_object(Bucket=bucket, Key=index_key)['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return cls(archive_etag, table['members'], gzip_index)
+
+    def save(self, client, bucket, tgz_key):
+        index_key, members_key = self.keys(tgz_key)
+        client.put_object(Bucket=bucket, Key=index_key, Body=self.gzip_index)
+        client.put_object(Bucket=bucket, Key=members_key, Body=json.dumps({
+            'archive_etag': self.archive_etag,
+            'members': self.members
+        }), ContentType='application/json')
+        logger.info(f"Indexed {tgz_key}: {len(self.members)} members, "
+                    f"{len(self.gzip_index)} byte seek index")
+
+
+def index_parallelization(parallelization=None):
+    """rapidgzip only records seek points when decompressing in parallel, so use at least 2 threads"""
+    return max(2, parallelization or os.cpu_count() or 1)
+
+
+def build_archive_index(bucket, tgz_key, parallelization=None):
+    """
+    Build and store the ArchiveIndex for an archive without extracting it.
+
+    The archive is still read and decompressed once end to end, but no members are
+    uploaded.
+    """
+    response = s3.head_object(Bucket=bucket, Key=tgz_key)
+    with S3RangeReader(s3, bucket, tgz_key, size=response['ContentLength']) as tgz_data:
+        with rapidgzip.open(tgz_data, parallelization=index_parallelization(parallelization)) as gz_stream:
+            with tarfile.open(fileobj=gz_stream, mode='r') as tar:
+                members = {member.name: {'offset': member.offset_data, 'size': member.size}
+                           for member in tar if member.isfile()}
+            index = ArchiveIndex.from_stream(response['ETag'], members, gz_stream)
+    index.save(s3, bucket, tgz_key)
+    return index
+
+
+def extract_member(bucket, tgz_key, member_name, dest_bucket=None, dest_key=None,
+                   chunk_size=8388608, parallelization=None):
+    """
+    Copy a single member out of an indexed archive into S3.
+
+    Only the ranges of the archive around the member are fetched: rapidgzip resumes
+    decompression at the nearest indexed block boundary before the member's offset.
+
+    Returns:
+        str: The key the member was written to (dest_key, or the member name)
+    """
+    response = s3.head_object(Bucket=bucket, Key=tgz_key)
+    index = ArchiveIndex.load(s3, bucket, tgz_key, response['ETag'])
+    if index is None:
+        raise ValueError(f"{tgz_key} has no current index; run build_archive_index first")
+    if member_name not in index.members:
+        raise KeyError(f"{member_name} is not a file in {tgz_key}")
+    member = index.members[member_name]
+    dest_bucket = dest_bucket or bucket
+    dest_key = dest_key or member_name
+
+    # The read is short, so don't prefetch far past the member
+    with S3RangeReader(s3, bucket, tgz_key, size=response['ContentLength'], prefetch=1) as tgz_data:
+        with rapidgzip.open(tgz_data, parallelization=parallelization or os.cpu_count()) as gz_stream:
+            gz_stream.import_index(io.BytesIO(index.gzip_index))
+            gz_stream.seek(member['offset'])
+            if member['size'] <= SMALL_MEMBER_SIZE:
+                s3.put_object(Bucket=dest_bucket, Key=dest_key, Body=gz_stream.read(member['size']),
+                              ContentType=guess_content_type(dest_key))
+            else:
+                upload_member_multipart(s3, dest_bucket, dest_key, BoundedReader(gz_stream, member['size']),
+                                        member['size'], chunk_size, guess_content_type(dest_key))
+        logger.info(f"Extracted {member_name} from {tgz_key} with {tgz_data.requests} ranged GETs "
+                    f"totalling {tgz_data.bytes_fetched} of {tgz_data.size} bytes")
+    return dest_key
+
+
+def process_task(task, parallelization=None, memory_budget=UPLOAD_MEMORY_BUDGET, deadline=None):
     """Process a single S3 Batch Operation task"""
 
+    key = task.get('s3Key')
     try:
         bucket = task['s3BucketArn'].split(':')[-1]
         key = urllib.parse.unquote_plus(task['s3Key'])
@@ -36,13 +716,23 @@ def process_task(task):
             raise ValueError(f"Input file {key} is not a .tgz file")
             
         # Process the file
-        extract_and_upload(bucket, key)
+        extract_and_upload(bucket, key, parallelization=parallelization, memory_budget=memory_budget,
+                           deadline=deadline)
         
         return {
             'taskId': task['taskId'],
             'resultCode': 'Succeeded',
             'resultString': f'Successfully processed {key}'
         }
+
+    except ExtractionTimeout as e:
+        # S3 Batch retries temporary failures; the retry resumes from the checkpoint
+        logger.info(f"Checkpointed {key} before timing out: {str(e)}")
+        return {
+            'taskId': task['taskId'],
+            'resultCode': 'TemporaryFailure',
+            'resultString': str(e)
+        }
         
     except Exception as e:
         logger.error(f"Error processing {key}: {str(e)}")
@@ -52,59 +742,67 @@ def process_task(task):
             'resultString': str(e)
         }
 
-def extract_and_upload(bucket, tgz_key, chunk_size=8388608):  # 8MB chunks
-    """Extract and upload files using streaming to minimize memory usage"""
+def extract_and_upload(bucket, tgz_key, chunk_size=8388608,  # 8MB chunks
+                       parallelization=None, memory_budget=UPLOAD_MEMORY_BUDGET,
+                       repack=REPACK_NIFTI, repack_level=REPACK_LEVEL, deadline=None, index=INDEX_ARCHIVES):
+    """
+    Extract and upload files using streaming to minimize memory usage.
+    With repack, .nii members are written as .nii.gz at repack_level.
+    With index, the archive's ArchiveIndex is stored alongside it once extraction completes.
+
+    Progress is checkpointed as members land in S3. If deadline (a time.monotonic()
+    value) passes, extraction stops, the checkpoint is saved and ExtractionTimeout is
+    raised; a later call resumes where this one left off.
+    """
     
     gz_stream = None
     tar = None
-    # Configure multipart upload
-    transfer_config = TransferConfig(
-        multipart_threshold=chunk_size,
-        multipart_chunksize=chunk_size,
-        max_concurrency=10,
-        use_threads=True
-    )
+    tgz_data = None
+    uploader = None
+    checkpoint = None
+    completed = False
+    archive_index = None
+    index_members = {}
 
     # Stream the compressed file
     try:
-        # Get object size first
+        # Read the archive through ranged GETs instead of buffering all of it, so the
+        # archive size is no longer capped by Lambda memory
         response = s3.head_object(Bucket=bucket, Key=tgz_key)
-        file_size = response['ContentLength']
-        
-        # Use range requests for large files
-        if file_size > 100 * 1024 * 1024:  # 100MB
-            position = 0
-            buffer = BytesIO()
-            
-            while position < file_size:
-                end = min(position + chunk_size - 1, file_size - 1)
-                range_header = f'bytes={position}-{end}'
-                
-                chunk = s3.get_object(
-                    Bucket=bucket,
-                    Key=tgz_key,
-                    Range=range_header
-                )['Body'].read()
-                
-                buffer.write(chunk)
-                position = end + 1
-                
-            buffer.seek(0)
-            tgz_data = buffer
-            
-        else:
-            # For smaller files, read all at once
-            response = s3.get_object(Bucket=bucket, Key=tgz_key)
-            tgz_data = BytesIO(response['Body'].read())
+        tgz_data = S3RangeReader(s3, bucket, tgz_key, size=response['ContentLength'])
+
+        checkpoint = ExtractionCheckpoint(s3, bucket, tgz_key, response['ETag']).load()
+        archive_tag = response['ETag'].strip('"')
+        # On a retry, members from the failed attempt may have landed after the checkpoint
+        # was last saved; those are skipped if the destination already matches
+        uploader = MemberUploader(s3, bucket, memory_budget=memory_budget, skip_existing=checkpoint.resumed)
 
         # Use rapidgzip for parallel decompression
-        with rapidgzip.open(tgz_data, parallelization=os.cpu_count()) as gz_stream:
+        parallelization = parallelization or os.cpu_count()
+        if index:
+            parallelization = index_parallelization(parallelization)
+        with rapidgzip.open(tgz_data, parallelization=parallelization) as gz_stream:
+            # Everything before the resume offset is already extracted. A stored seek index
+            # lets rapidgzip jump there instead of decompressing up to it again.
+            if checkpoint.resume_offset:
+                stored_index = ArchiveIndex.load(s3, bucket, tgz_key, response['ETag'])
+                if stored_index:
+                    gz_stream.import_index(io.BytesIO(stored_index.gzip_index))
+            gz_stream.seek(checkpoint.resume_offset)
             with tarfile.open(fileobj=gz_stream, mode='r') as tar:
                 while True:
                     try:
+                        checkpoint.save()
+                        if deadline and time.monotonic() > deadline:
+                            raise ExtractionTimeout(f"Stopped at offset {tar.offset} of {tgz_key} "
+                                                    f"to checkpoint before the Lambda timeout")
                         member = tar.next()
                         if member is None:
                             break
+                        if member.isfile():
+                            index_members[member.name] = {'offset': member.offset_data, 'size': member.size}
+                        if checkpoint.is_done(member.name):
+                            continue
                         # Skip if not a file
                         elif member.isfile():
                             # Stream each file from tar to S3
@@ -114,35 +812,85 @@ def extract_and_upload(bucket, tgz_key, chunk_size=8388608):  # 8MB chunks
                                 
                             # Determine output key - strip any leading slashes
                             output_key = member.name.lstrip('/')
+                            compress_level = None
+                            if repack and output_key.endswith('.nii'):
+                                output_key += '.gz'
+                                compress_level = repack_level
 
-                            s3.upload_fileobj(
-                                Fileobj=file_obj,
-                                Bucket=bucket,
-                                Key=output_key,
-                                Config=transfer_config,
-                                ExtraArgs={
-                                    'ContentType': guess_content_type(output_key)
-                                }
-                            )
-                            logger.info(f"Uploaded {output_key}")
+                            on_uploaded = functools.partial(checkpoint.done, member.name, member.offset, member.size)
+                            checkpoint.start(member.offset)
+                            if member.size <= SMALL_MEMBER_SIZE:
+                                # Small members upload in the background while the next is read
+                                uploader.submit(output_key, file_obj.read(), guess_content_type(output_key),
+                                                compress_level, on_uploaded)
+                            else:
+                                # Tag the object with the archive and member it came from, so a
+                                # retry can tell it finished even if the checkpoint didn't record it
+                                source = f"{archive_tag}:{member.offset}"
+                                etag = existing_member_etag(s3, bucket, output_key, source) if checkpoint.resumed else None
+                                if etag:
+                                    uploader.skipped += 1
+                                else:
+                                    if compress_level:
+                                        file_obj = GzipCompressingReader(file_obj, compress_level,
+                                                                         threads=parallelization)
+                                    etag = upload_member_multipart(s3, bucket, output_key, file_obj, member.size,
+                                                                   chunk_size, guess_content_type(output_key),
+                                                                   metadata={'fastunpack-source': source})
+                                on_uploaded(etag)
                         elif member.isdir():
-                            s3.put_object(Bucket=bucket, Key=member.name + '/')
+                            checkpoint.start(member.offset)
+                            uploader.submit(member.name + '/', b'', on_uploaded=functools.partial(
+                                checkpoint.done, member.name, member.offset, member.size))
                         else:
                             logger.info(f"Skipping {member.name}")
                             continue
+                        checkpoint.advance(tar.offset)
                     except ClientError as e:
                         logger.error(f"Error uploading {output_key}: {str(e)}")
                         raise
 
+            # A resumed run never saw the members before the resume offset
+            if index and not checkpoint.resumed:
+                archive_index = ArchiveIndex.from_stream(response['ETag'], index_members, gz_stream)
+
+        # Let the queued uploads finish before the archive counts as extracted
+        closing, uploader = uploader, None
+        closing.close()
+        completed = True
+        checkpoint.delete()
+        if archive_index:
+            archive_index.save(s3, bucket, tgz_key)
+        if closing.skipped:
+            logger.info(f"Skipped {closing.skipped} members already in S3")
+
+    except ExtractionTimeout:
+        raise
+
     except Exception as e:
         logger.error(f"Extraction error for {tgz_key}: {str(e)}")
         raise
 
     finally:
+        if uploader:
+            # Extraction failed part way; drain the queue, but the original error wins
+            try:
+                uploader.close()
+            except Exception:
+                pass
+        if checkpoint and not completed:
+            try:
+                checkpoint.save(force=True)
+            except Exception as e:
+                logger.error(f"Could not save checkpoint for {tgz_key}: {str(e)}")
         if tar:
             tar.close()
         if gz_stream:
             gz_stream.close()
+        if tgz_data:
+            logger.info(f"Read {tgz_key} ({tgz_data.size} bytes) with {tgz_data.requests} ranged GETs "
+                        f"totalling {tgz_data.bytes_fetched} bytes")
+            tgz_data.close()
 
 def guess_content_type(filename):
     """Guess the content type based on file extension"""
@@ -158,10 +906,25 @@ def lambda_handler(event, context):
     if 'tasks' not in event:
         raise ValueError("Invalid S3 Batch event format")
     
-    results = []
-    for task in event['tasks']:
-        result = process_task(task)
-        results.append(result)
+    # Archives are processed TASK_CONCURRENCY at a time. Each task gets an equal share of
+    # the cores for rapidgzip and of the upload memory budget, and process_task turns any
+    # error into that task's own failure result, so one bad archive can't sink the rest.
+    tasks = event['tasks']
+    concurrency = max(1, min(TASK_CONCURRENCY, len(tasks)))
+    parallelization = max(1, (os.cpu_count() or 1) // concurrency)
+    memory_budget = UPLOAD_MEMORY_BUDGET // concurrency
+    # Leave time to drain uploads and save checkpoints before Lambda kills the invocation.
+    # The margin is capped at a quarter of the time left, so a short function timeout
+    # still gets most of its time for extraction rather than a deadline already passed.
+    deadline = None
+    if context is not None:
+        remaining = context.get_remaining_time_in_millis() / 1000
+        deadline = time.monotonic() + remaining - min(CHECKPOINT_TIMEOUT_MARGIN, remaining / 4)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # map() yields results in task order, as S3 Batch expects
+        results = list(executor.map(
+            lambda task: process_task(task, parallelization, memory_budget, deadline), tasks))
     
     return {
         'invocationSchemaVersion': event['invocationSchemaVersion'],
@@ -169,3 +932,28 @@ def lambda_handler(event, context):
         'invocationId': event['invocationId'],
         'results': results
     }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index .tgz archives in S3 and extract single members from them')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    index_parser = subparsers.add_parser('index', help='Build and store the seek index and member table for an archive')
+    index_parser.add_argument('bucket')
+    index_parser.add_argument('key', help='Key of the .tgz archive')
+    extract_parser = subparsers.add_parser('extract', help='Copy one member of an indexed archive into S3')
+    extract_parser.add_argument('bucket')
+    extract_parser.add_argument('key', help='Key of the .tgz archive')
+    extract_parser.add_argument('member', help='Name of the member inside the archive')
+    extract_parser.add_argument('--dest-bucket', help='Destination bucket (default: the archive bucket)')
+    extract_parser.add_argument('--dest-key', help='Destination key (default: the member name)')
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    if args.command == 'index':
+        build_archive_index(args.bucket, args.key)
+    else:
+        extract_member(args.bucket, args.key, args.member, args.dest_bucket, args.dest_key)
+
+
+if __name__ == '__main__':
+    main()
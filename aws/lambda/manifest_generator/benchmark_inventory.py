@@ -0,0 +1,147 @@
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import random
+import string
+import sys
+import time
+import urllib.parse
+from collections import Counter
+from datetime import datetime, timezone
+
+import boto3
+from moto import mock_aws
+
+from manifest_generatorv2 import ManifestGenerator
+
+'''
+Compares building a manifest by listing the bucket (ListObjectsV2) against building it
+from an S3 Inventory report (--from-inventory), using moto as a local S3 stand-in.
+
+The source bucket is filled with fmriresults01/<release>/<GUID>_... keys, and a gzipped
+CSV inventory report for it is written the way S3 Inventory delivers one (data files
+plus a timestamped manifest.json). Each path is timed and the S3 API calls it makes
+are counted. Wall times against moto only show the local CPU cost of each path; the
+request counts are what carry over to real S3, where every LIST call is ~1000 keys
+and a round trip.
+
+Example:
+python benchmark_inventory.py --objects 50000 --inventory-files 4 --output inventory_benchmark.json
+'''
+
+SOURCE_BUCKET = 'benchmark-source'
+INVENTORY_BUCKET = 'benchmark-inventory'
+INVENTORY_PREFIX = f'{SOURCE_BUCKET}/daily'
+INVENTORY_SCHEMA = 'Bucket, Key, Size, LastModifiedDate, ETag, StorageClass'
+
+
+def make_keys(n_objects):
+    """Generate ABCD-style keys: fmriresults01/<release>/<GUID>_<timepoint>_<type>.<ext>"""
+    random.seed(0)
+    guid_chars = string.digits + string.ascii_uppercase
+    keys = []
+    for i in range(n_objects):
+        release = random.choice(['abcd_v51', 'abcd_v60'])
+        guid = 'NDAR_INV' + ''.join(random.choices(guid_chars, k=8))
+        timepoint = random.choice(['baselineYear1Arm1', '2YearFollowUpYArm1', '4YearFollowUpYArm1'])
+        extension = random.choice(['.tgz', '.tgz', '.json'])
+        keys.append(f'fmriresults01/{release}/{guid}_{timepoint}_ABCD-MPROC-T1_{i}{extension}')
+    return keys
+
+
+def populate(s3, keys, n_files):
+    """Fill the source bucket and write a CSV inventory report covering it"""
+    s3.create_bucket(Bucket=SOURCE_BUCKET)
+    s3.create_bucket(Bucket=INVENTORY_BUCKET)
+    for key in keys:
+        s3.put_object(Bucket=SOURCE_BUCKET, Key=key, Body=b'x' * random.randint(0, 2048))
+
+    # Read the real sizes/ETags back so both paths see identical objects
+    paginator = s3.get_paginator('list_objects_v2')
+    objects = [obj for page in paginator.paginate(Bucket=SOURCE_BUCKET) for obj in page.get('Contents', [])]
+
+    delivery = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H-%MZ')
+    files = []
+    for i in range(n_files):
+        buffer = io.BytesIO()
+        with gzip.open(buffer, 'wt', newline='') as gz:
+            writer = csv.writer(gz, quoting=csv.QUOTE_ALL)
+            for obj in objects[i::n_files]:
+                writer.writerow([SOURCE_BUCKET, urllib.parse.quote(obj['Key']), obj['Size'],
+                                 obj['LastModified'].strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                                 obj['ETag'].strip('"'), 'STANDARD'])
+        data_key = f'{INVENTORY_PREFIX}/data/inventory-{i}.csv.gz'
+        s3.put_object(Bucket=INVENTORY_BUCKET, Key=data_key, Body=buffer.getvalue())
+        files.append({'key': data_key, 'size': buffer.tell(), 'MD5checksum': ''})
+
+    manifest = {
+        'sourceBucket': SOURCE_BUCKET,
+        'destinationBucket': f'arn:aws:s3:::{INVENTORY_BUCKET}',
+        'version': '2016-11-30',
+        'fileFormat': 'CSV',
+        'fileSchema': INVENTORY_SCHEMA,
+        'files': files
+    }
+    s3.put_object(Bucket=INVENTORY_BUCKET, Key=f'{INVENTORY_PREFIX}/{delivery}/manifest.json',
+                  Body=json.dumps(manifest))
+
+
+def run(label, generator, output_file, **filters):
+    """Generate a manifest, counting the S3 calls made by the generator's client"""
+    calls = Counter()
+    generator.s3_client.meta.events.register(
+        'before-call.s3.*', lambda model, **kwargs: calls.update([model.name]))
+    start = time.perf_counter()
+    generator.generate_csv_manifest(output_file, **filters)
+    elapsed = time.perf_counter() - start
+    with open(output_file) as f:
+        rows = sum(1 for _ in f) - 1
+    return {'path': label, 'seconds': round(elapsed, 3), 'rows': rows, 's3_calls': dict(calls)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark inventory-backed vs. live-listing manifest generation')
+    parser.add_argument('--objects', type=int, default=20000, help='Number of objects in the stand-in bucket')
+    parser.add_argument('--inventory-files', type=int, default=4, help='Number of inventory data files')
+    parser.add_argument('--workers', type=int, default=4, help='Workers for the inventory path')
+    parser.add_argument('--output', help='Optional JSON file for the results')
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    filters = {'min_size': 100, 'file_extension': '.tgz'}
+
+    with mock_aws():
+        s3 = boto3.client('s3')
+        print(f"Populating stand-in bucket with {args.objects} objects...")
+        populate(s3, make_keys(args.objects), args.inventory_files)
+
+        results = [
+            run('list_objects_v2',
+                ManifestGenerator(SOURCE_BUCKET, 'fmriresults01/'),
+                'benchmark_listing.csv', **filters),
+            run('inventory',
+                ManifestGenerator(SOURCE_BUCKET, 'fmriresults01/', max_workers=args.workers,
+                                  inventory_uri=f's3://{INVENTORY_BUCKET}/{INVENTORY_PREFIX}'),
+                'benchmark_inventory.csv', **filters)
+        ]
+
+        with open('benchmark_listing.csv') as listing, open('benchmark_inventory.csv') as inventory:
+            same_objects = sorted(listing) == sorted(inventory)
+
+    for result in results:
+        print(f"{result['path']:>16}: {result['rows']} rows in {result['seconds']}s, S3 calls {result['s3_calls']}")
+    print(f"Manifests contain the same objects: {same_objects}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'objects': args.objects, 'same_objects': same_objects, 'results': results}, f, indent=2)
+
+    if not same_objects:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
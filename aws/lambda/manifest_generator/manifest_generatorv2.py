@@ -1,124 +1,557 @@
 import boto3
 import csv
+import functools
+import gzip
+import hashlib
+import io
 import json
 import argparse
 import os
-from datetime import datetime
+import queue
+import string
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from botocore.config import Config
-from typing import List, Dict, Optional
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from tqdm import tqdm
 import sys
 
+from object_table import ObjectTable
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed for Parquet inventory reports and manifests
+    pa = pq = None
+
+# Characters probed when splitting a prefix into key ranges (S3 "safe" key characters, in byte order)
+SHARD_ALPHABET = ''.join(sorted(string.digits + string.ascii_letters + "!-_.*'()/"))
+
+# Parquet inventory column names mapped to the field names used in CSV inventory schemas
+INVENTORY_PARQUET_COLUMNS = {
+    'bucket': 'Bucket',
+    'key': 'Key',
+    'version_id': 'VersionId',
+    'is_latest': 'IsLatest',
+    'is_delete_marker': 'IsDeleteMarker',
+    'size': 'Size',
+    'last_modified_date': 'LastModifiedDate',
+    'e_tag': 'ETag',
+    'storage_class': 'StorageClass'
+}
+
+# fileSchema values for the inventory-style manifests written by generate_inventory_manifest
+INVENTORY_FILE_SCHEMAS = {
+    'CSV': 'Bucket, Key, Size',
+    'Parquet': 'message s3.inventory { required binary bucket (STRING); '
+               'required binary key (STRING); optional int64 size; }'
+}
+INVENTORY_PARQUET_SCHEMA = pa.schema([
+    ('bucket', pa.string()),
+    ('key', pa.string()),
+    ('size', pa.int64())
+]) if pa is not None else None
+
+
+class ChecksumWriter(io.RawIOBase):
+    """Writable file wrapper that MD5s and counts the bytes passing through it"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.md5.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
 class ManifestGenerator:
-    def __init__(self, source_bucket: str, prefix: Optional[str] = None):
+    def __init__(self,
+                 source_bucket: str,
+                 prefix: Optional[str] = None,
+                 max_workers: int = 1,
+                 target_shards: int = 64,
+                 shard_buffer_pages: int = 20,
+                 inventory_uri: Optional[str] = None):
         """
         Initialize the manifest generator.
 
         Args:
             source_bucket (str): The source S3 bucket name
             prefix (str, optional): Prefix to filter objects in the bucket
+            max_workers (int): Number of key-range shards listed at once (1 = single paginator)
+            target_shards (int): Stop discovering sub-prefixes once this many shards are found
+            shard_buffer_pages (int): Pages each shard may list ahead of the manifest writer
+            inventory_uri (str, optional): s3:// URI of an S3 Inventory report (or its manifest.json)
+                to read the object list from instead of listing the bucket
         """
         self.source_bucket = source_bucket
         self.prefix = prefix
+        self.max_workers = max_workers
+        self.target_shards = target_shards
+        self.shard_buffer_pages = shard_buffer_pages
+        self.inventory_uri = inventory_uri
 
         # Configure S3 client with retry strategy
         self.s3_client = boto3.client('s3', config=Config(
             retries={'max_attempts': 3, 'mode': 'adaptive'},
-            max_pool_connections=50
+            max_pool_connections=max(50, max_workers)
         ))
 
-    def _get_total_objects(self) -> int:
-        """Get total number of objects in bucket/prefix for progress bar"""
-        try:
-            paginator = self.s3_client.get_paginator('list_objects_v2')
-            total = 0
+    def _list_pages_serial(self) -> Iterator[List[Dict]]:
+        """List the bucket/prefix with a single paginator, one page at a time"""
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(
+            Bucket=self.source_bucket,
+            Prefix=self.prefix if self.prefix else ''
+        ):
+            if 'Contents' in page:
+                yield page['Contents']
+
+    def _discover_subprefixes(self, prefix: str, bucket: Optional[str] = None) -> List[str]:
+        """Find the '/'-delimited sub-prefixes directly under a prefix"""
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        return [common['Prefix']
+                for page in paginator.paginate(Bucket=bucket or self.source_bucket, Prefix=prefix, Delimiter='/')
+                for common in page.get('CommonPrefixes', [])]
+
+    def _prefix_has_objects(self, prefix: str) -> bool:
+        """Check whether any key starts with prefix (a single one-key LIST request)"""
+        response = self.s3_client.list_objects_v2(Bucket=self.source_bucket, Prefix=prefix, MaxKeys=1)
+        return response.get('KeyCount', 0) > 0
+
+    def _split_prefix(self, prefix: str, executor: ThreadPoolExecutor, max_stem: int = 32) -> List[str]:
+        """
+        Split a prefix on its next key character.
+
+        Walks down through characters shared by every key (e.g., the 'NDAR_INV' that starts
+        every ABCD GUID) until the keys fan out, then returns one boundary per populated
+        next character. Each step probes all of SHARD_ALPHABET concurrently.
+        """
+        stem = prefix
+        for _ in range(max_stem):
+            candidates = [stem + char for char in SHARD_ALPHABET]
+            populated = [candidate for candidate, has_objects
+                         in zip(candidates, executor.map(self._prefix_has_objects, candidates))
+                         if has_objects]
+            if len(populated) != 1:
+                return populated
+            stem = populated[0]
+        return []
+
+    def _plan_shards(self, executor: ThreadPoolExecutor) -> List[Tuple[Optional[str], Optional[str]]]:
+        """
+        Divide the bucket/prefix into contiguous key ranges that can be listed independently.
+
+        Sub-prefixes are found with Delimiter='/' discovery first, then by splitting the deepest
+        prefixes on their next character if that still gives fewer than target_shards. Each
+        range is (start_after, end_at], so together they cover every key exactly once and in
+        S3 listing order, whatever the boundaries turn out to be.
+        """
+        root = self.prefix if self.prefix else ''
+        prefixes = [root]
+        boundaries = set()
+        while len(boundaries) < self.target_shards:
+            children = [child for subprefixes in executor.map(self._discover_subprefixes, prefixes)
+                        for child in subprefixes]
+            if not children:
+                break
+            prefixes = children
+            boundaries.update(children)
+
+        if len(boundaries) < self.target_shards:
+            for prefix in prefixes:
+                boundaries.update(self._split_prefix(prefix, executor))
+        boundaries.discard(root)
 
-            for page in paginator.paginate(
-                Bucket=self.source_bucket,
-                Prefix=self.prefix if self.prefix else ''
-            ):
-                if 'Contents' in page:
-                    total += len(page['Contents'])
+        bounds = sorted(boundaries)
+        return list(zip([None] + bounds, bounds + [None]))
 
-            return total
+    def _list_shard(self, start_after: Optional[str], end_at: Optional[str]) -> Iterator[List[Dict]]:
+        """List the pages of one (start_after, end_at] key range"""
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        kwargs = {'Bucket': self.source_bucket, 'Prefix': self.prefix if self.prefix else ''}
+        if start_after is not None:
+            kwargs['StartAfter'] = start_after
+
+        for page in paginator.paginate(**kwargs):
+            contents = page.get('Contents', [])
+            finished = end_at is not None and bool(contents) and contents[-1]['Key'] > end_at
+            if finished:
+                contents = [obj for obj in contents if obj['Key'] <= end_at]
+            if contents:
+                yield contents
+            if finished:
+                break
+
+    def _put_page(self, out: queue.Queue, item, stop: threading.Event) -> bool:
+        """Queue an item for the manifest writer, giving up if the listing has been abandoned"""
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce_pages(self, make_pages: Callable[[], Iterator[List[Dict]]], out: queue.Queue, stop: threading.Event):
+        """Run one page source into a bounded queue, ending with None (or the exception raised)"""
+        try:
+            if stop.is_set():
+                return
+            for contents in make_pages():
+                if not self._put_page(out, contents, stop):
+                    return
         except Exception as e:
-            print(f"Warning: Could not get total object count: {str(e)}")
-            return 0
+            self._put_page(out, e, stop)
+        finally:
+            self._put_page(out, None, stop)
 
-    def _get_objects(self,
-                     min_size: Optional[int] = None,
-                     max_size: Optional[int] = None,
-                     file_extension: Optional[str] = None) -> List[Dict]:
+    def _merge_ordered(self,
+                       executor: ThreadPoolExecutor,
+                       sources: List[Callable[[], Iterator[List[Dict]]]]) -> Iterator[List[Dict]]:
         """
-        Get objects from S3 bucket with optional filtering and progress bar.
+        Run page sources concurrently but hand their pages back one source at a time.
+
+        Each source can only run shard_buffer_pages ahead of the consumer, which bounds
+        memory use. Sources are submitted in order, so the one being drained has always
+        been started.
+        """
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.shard_buffer_pages) for _ in sources]
+        futures = [executor.submit(self._produce_pages, make_pages, out, stop)
+                   for make_pages, out in zip(sources, queues)]
+        try:
+            for out in queues:
+                while True:
+                    item = out.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+        finally:
+            # Unblock or cancel any sources still running if the consumer stops early
+            stop.set()
+            for future in futures:
+                future.cancel()
+
+    def _list_pages_parallel(self) -> Iterator[List[Dict]]:
+        """
+        List the bucket/prefix as key-range shards on a thread pool.
+
+        Shards are listed concurrently, but pages are handed back shard by shard, so the
+        stream is in the same order a single paginator would produce.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            shards = self._plan_shards(executor)
+            print(f"Listing {len(shards)} key-range shards with {self.max_workers} workers")
+            yield from self._merge_ordered(
+                executor,
+                [functools.partial(self._list_shard, start_after, end_at) for start_after, end_at in shards]
+            )
+
+    def _find_inventory_manifest(self, inventory_bucket: str, inventory_prefix: str) -> str:
+        """
+        Find the key of the latest S3 Inventory manifest.json under an inventory prefix.
+
+        The prefix can point straight at a manifest.json, or at the inventory configuration
+        folder holding the YYYY-MM-DDTHH-MMZ/ delivery folders.
+        """
+        if inventory_prefix.endswith('manifest.json'):
+            return inventory_prefix
+
+        if inventory_prefix and not inventory_prefix.endswith('/'):
+            inventory_prefix += '/'
+        # Only timestamped folders hold manifests; skip data/ and hive/
+        deliveries = [prefix for prefix in self._discover_subprefixes(inventory_prefix, bucket=inventory_bucket)
+                      if prefix[len(inventory_prefix):][:1].isdigit()]
+        if not deliveries:
+            raise Exception(f"No inventory deliveries found under s3://{inventory_bucket}/{inventory_prefix}")
+        return f"{max(deliveries)}manifest.json"
+
+    def _read_inventory_csv(self, inventory_bucket: str, key: str, columns: List[str]) -> Iterator[Dict]:
+        """Stream rows out of a gzipped CSV inventory file without downloading it first"""
+        body = self.s3_client.get_object(Bucket=inventory_bucket, Key=key)['Body']
+        with gzip.GzipFile(fileobj=body) as gz, io.TextIOWrapper(gz, encoding='utf-8', newline='') as text:
+            for row in csv.reader(text):
+                record = dict(zip(columns, row))
+                # Inventory CSV keys are URL-encoded
+                record['Key'] = urllib.parse.unquote_plus(record['Key'])
+                record['Size'] = int(record['Size']) if record.get('Size') else 0
+                if record.get('LastModifiedDate'):
+                    record['LastModifiedDate'] = datetime.fromisoformat(record['LastModifiedDate'].replace('Z', '+00:00'))
+                yield record
+
+    def _read_inventory_parquet(self, inventory_bucket: str, key: str) -> Iterator[Dict]:
+        """
+        Read rows out of a Parquet inventory file one record batch at a time.
+
+        Parquet needs random access to its footer, so the (already compressed) file
+        is fetched whole rather than streamed.
+        """
+        if pq is None:
+            raise Exception("pyarrow is required to read Parquet inventory reports")
+
+        body = self.s3_client.get_object(Bucket=inventory_bucket, Key=key)['Body']
+        parquet_file = pq.ParquetFile(io.BytesIO(body.read()))
+        for batch in parquet_file.iter_batches():
+            for row in batch.to_pylist():
+                yield {INVENTORY_PARQUET_COLUMNS.get(name, name): value for name, value in row.items()}
+
+    def _read_inventory_file(self, inventory_bucket: str, file_format: str, key: str,
+                             columns: List[str]) -> Iterator[List[Dict]]:
+        """
+        Read one inventory data file as pages shaped like ListObjectsV2 'Contents'.
+
+        Rows outside the prefix, older versions and delete markers are dropped here,
+        so the size and extension filters in _iter_objects apply unchanged.
+        """
+        if file_format == 'CSV':
+            rows = self._read_inventory_csv(inventory_bucket, key, columns)
+        elif file_format == 'Parquet':
+            rows = self._read_inventory_parquet(inventory_bucket, key)
+        else:
+            raise Exception(f"Unsupported inventory format: {file_format}")
+
+        prefix = self.prefix if self.prefix else ''
+        page = []
+        for row in rows:
+            if not row['Key'].startswith(prefix):
+                continue
+            if str(row.get('IsLatest', 'true')).lower() == 'false':
+                continue
+            if str(row.get('IsDeleteMarker', 'false')).lower() == 'true':
+                continue
+            page.append({
+                'Key': row['Key'],
+                'Size': row.get('Size') or 0,
+                'LastModified': row.get('LastModifiedDate'),
+                'ETag': row.get('ETag'),
+                'StorageClass': row.get('StorageClass')
+            })
+            if len(page) == 1000:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def _list_pages_inventory(self) -> Iterator[List[Dict]]:
+        """
+        List the bucket/prefix from its latest S3 Inventory report instead of ListObjectsV2.
+
+        The inventory data files are streamed and decompressed on the fly, max_workers
+        at a time, so a bucket of millions of objects costs a handful of GETs.
+        """
+        inventory_bucket, _, inventory_prefix = self.inventory_uri.removeprefix('s3://').partition('/')
+        manifest_key = self._find_inventory_manifest(inventory_bucket, inventory_prefix)
+        print(f"Reading S3 Inventory manifest: s3://{inventory_bucket}/{manifest_key}")
+        manifest = json.loads(self.s3_client.get_object(Bucket=inventory_bucket, Key=manifest_key)['Body'].read())
+
+        if manifest['sourceBucket'] != self.source_bucket:
+            raise Exception(f"Inventory is for bucket {manifest['sourceBucket']}, not {self.source_bucket}")
+
+        file_format = manifest['fileFormat']
+        columns = [column.strip() for column in manifest['fileSchema'].split(',')]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            yield from self._merge_ordered(
+                executor,
+                [functools.partial(self._read_inventory_file, inventory_bucket, file_format, data_file['key'], columns)
+                 for data_file in manifest['files']]
+            )
+
+    def _list_pages(self) -> Iterator[List[Dict]]:
+        """List the bucket/prefix with whichever engine this generator is configured for"""
+        if self.inventory_uri:
+            return self._list_pages_inventory()
+        if self.max_workers > 1:
+            return self._list_pages_parallel()
+        return self._list_pages_serial()
+
+    def _iter_objects(self,
+                      min_size: Optional[int] = None,
+                      max_size: Optional[int] = None,
+                      file_extension: Optional[str] = None,
+                      total_hint: Optional[int] = None,
+                      modified_after: Optional[datetime] = None) -> Iterator[Dict]:
+        """
+        Stream objects from S3 bucket with optional filtering, listing the bucket only once.
+
+        Objects are yielded as soon as their page arrives, so callers can write them out
+        without holding the whole listing in memory. The progress bar shows a running count
+        of listed objects; pass total_hint (e.g., the object count from an S3 Inventory
+        report) to get a percentage and ETA instead.
 
         Args:
             min_size (int, optional): Minimum file size in bytes
             max_size (int, optional): Maximum file size in bytes
             file_extension (str, optional): File extension to filter (e.g., '.txt')
+            total_hint (int, optional): Estimated number of objects under the prefix
+            modified_after (datetime, optional): Only include objects modified at or after this time
 
-        Returns:
-            List[Dict]: List of S3 objects matching the criteria
+        Yields:
+            Dict: S3 objects matching the criteria
         """
-        objects = []
-        total_objects = self._get_total_objects()
-
         try:
-            paginator = self.s3_client.get_paginator('list_objects_v2')
-            page_iterator = paginator.paginate(
-                Bucket=self.source_bucket,
-                Prefix=self.prefix if self.prefix else ''
-            )
-
             # Initialize progress bar for object listing
-            with tqdm(total=total_objects,
+            with tqdm(total=total_hint,
                       desc="Listing objects",
-                      unit="obj",
-                      bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]") as pbar:
+                      unit="obj") as pbar:
 
-                for page in page_iterator:
-                    if 'Contents' not in page:
-                        continue
+                for contents in self._list_pages():
+                    pbar.update(len(contents))
 
-                    for obj in page['Contents']:
+                    for obj in contents:
                         # Apply filters
                         if min_size and obj['Size'] < min_size:
-                            pbar.update(1)
                             continue
                         if max_size and obj['Size'] > max_size:
-                            pbar.update(1)
                             continue
                         if file_extension and not obj['Key'].endswith(file_extension):
-                            pbar.update(1)
+                            continue
+                        if modified_after and (not obj.get('LastModified') or obj['LastModified'] < modified_after):
                             continue
 
-                        objects.append({
+                        yield {
                             'Bucket': self.source_bucket,
                             'Key': obj['Key'],
                             'Size': obj['Size'],
-                            'LastModified': obj['LastModified'].isoformat()
-                        })
-                        pbar.update(1)
+                            'LastModified': obj['LastModified'].isoformat() if obj.get('LastModified') else ''
+                        }
 
         except Exception as e:
             raise Exception(f"Error listing objects in bucket {self.source_bucket}: {str(e)}")
 
-        return objects
+    def build_object_table(self, total_hint: Optional[int] = None) -> ObjectTable:
+        """
+        List the bucket/prefix once into a columnar ObjectTable, without filtering.
 
-    def generate_csv_manifest(self,
-                              output_file: str,
-                              min_size: Optional[int] = None,
-                              max_size: Optional[int] = None,
-                              file_extension: Optional[str] = None,
-                              include_version: bool = False) -> str:
+        The table can be filtered any number of ways (and saved with ObjectTable.save)
+        to derive manifests without listing the bucket again.
         """
-        Generate a CSV manifest file for S3 Batch Operations with progress bar.
+        try:
+            with tqdm(total=total_hint, desc="Listing objects", unit="obj") as pbar:
+                def pages():
+                    for contents in self._list_pages():
+                        pbar.update(len(contents))
+                        yield contents
+
+                table = ObjectTable.from_pages(self.source_bucket, self.prefix or '', pages())
+        except Exception as e:
+            raise Exception(f"Error listing objects in bucket {self.source_bucket}: {str(e)}")
+
+        print(f"Object table: {len(table)} objects in {format_size(table.nbytes)}")
+        return table
+
+    def _get_objects(self,
+                     min_size: Optional[int] = None,
+                     max_size: Optional[int] = None,
+                     file_extension: Optional[str] = None) -> List[Dict]:
+        """
+        Get objects from S3 bucket with optional filtering and progress bar.
+
+        Args:
+            min_size (int, optional): Minimum file size in bytes
+            max_size (int, optional): Maximum file size in bytes
+            file_extension (str, optional): File extension to filter (e.g., '.txt')
+
+        Returns:
+            List[Dict]: List of S3 objects matching the criteria
         """
-        objects = self._get_objects(min_size, max_size, file_extension)
+        return list(self._iter_objects(min_size, max_size, file_extension))
 
-        if not objects:
-            raise Exception("No objects found matching the specified criteria")
+    def load_snapshot(self, snapshot_uri: str) -> Optional[ObjectTable]:
+        """
+        Load the listing snapshot saved by a previous run, from a local path or an s3:// URI.
+
+        Returns:
+            Optional[ObjectTable]: The snapshot, or None if there isn't one yet
+        """
+        try:
+            if snapshot_uri.startswith('s3://'):
+                bucket, _, key = snapshot_uri.removeprefix('s3://').partition('/')
+                try:
+                    body = self.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+                except self.s3_client.exceptions.NoSuchKey:
+                    return None
+                snapshot = ObjectTable.load(io.BytesIO(body))
+            elif os.path.exists(snapshot_uri):
+                snapshot = ObjectTable.load(snapshot_uri)
+            else:
+                return None
+        except Exception as e:
+            raise Exception(f"Error loading listing snapshot {snapshot_uri}: {str(e)}")
+
+        if snapshot.bucket != self.source_bucket or snapshot.prefix != (self.prefix or ''):
+            raise Exception(f"Snapshot {snapshot_uri} is for s3://{snapshot.bucket}/{snapshot.prefix}, "
+                            f"not s3://{self.source_bucket}/{self.prefix or ''}")
+        return snapshot
+
+    def save_snapshot(self, table: ObjectTable, snapshot_uri: str):
+        """
+        Replace the listing snapshot atomically.
 
+        Locally the table is written to a temporary file and renamed over the old one;
+        in S3 a single PutObject already replaces the object atomically. Either way a
+        crash part way through leaves the previous snapshot intact.
+        """
+        try:
+            if snapshot_uri.startswith('s3://'):
+                bucket, _, key = snapshot_uri.removeprefix('s3://').partition('/')
+                buffer = io.BytesIO()
+                table.save(buffer)
+                self.s3_client.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+            else:
+                temp_file = f"{snapshot_uri}.tmp"
+                with open(temp_file, 'wb') as f:
+                    table.save(f)
+                os.replace(temp_file, snapshot_uri)
+        except Exception as e:
+            raise Exception(f"Error saving listing snapshot {snapshot_uri}: {str(e)}")
+
+    def build_delta_table(self, table: ObjectTable, snapshot: Optional[ObjectTable]) -> ObjectTable:
+        """Reduce a fresh listing to the objects added or changed (size or ETag) since a snapshot"""
+        if snapshot is None:
+            print("No listing snapshot yet; every object counts as new")
+            return table
+
+        changed, removed = table.changed_since(snapshot)
+        delta = table.take(changed)
+        print(f"Since the snapshot: {len(delta)} new or changed, {len(table) - len(delta)} unchanged, "
+              f"{removed} removed objects")
+        return delta
+
+    def _select_objects(self,
+                        min_size: Optional[int] = None,
+                        max_size: Optional[int] = None,
+                        file_extension: Optional[str] = None,
+                        total_hint: Optional[int] = None,
+                        modified_after: Optional[datetime] = None,
+                        table: Optional[ObjectTable] = None) -> Iterator[Dict]:
+        """Filter a saved ObjectTable if one is given, otherwise stream a fresh listing"""
+        if table is not None:
+            mask = table.filter(min_size, max_size, file_extension, modified_after, self.prefix)
+            return table.iter_objects(mask)
+        return self._iter_objects(min_size, max_size, file_extension, total_hint, modified_after)
+
+    def _write_csv(self, output_file: str, objects: Iterable[Dict], include_version: bool = False,
+                   header: bool = True) -> int:
+        """
+        Write objects to a fully quoted CSV manifest, returning the number of rows.
+        S3 Batch's CSV format has no header row, so pass header=False for files that
+        are submitted as-is.
+        """
+        written = 0
         try:
             with open(output_file, 'w', newline='') as csvfile:
                 headers = ['Bucket', 'Key']
@@ -128,80 +561,296 @@ class ManifestGenerator:
                 writer = csv.DictWriter(csvfile,
                                         fieldnames=headers,
                                         quoting=csv.QUOTE_ALL)
-                writer.writeheader()
-
-                # Initialize progress bar for writing manifest
-                with tqdm(total=len(objects),
-                          desc="Writing CSV manifest",
-                          unit="obj",
-                          bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]") as pbar:
-
-                    for obj in objects:
-                        row = {
-                            'Bucket': obj['Bucket'],
-                            'Key': obj['Key']
-                        }
-                        if include_version:
-                            row['VersionId'] = ''
-                        writer.writerow(row)
-                        pbar.update(1)
+                if header:
+                    writer.writeheader()
+
+                for obj in objects:
+                    row = {
+                        'Bucket': obj['Bucket'],
+                        'Key': obj['Key']
+                    }
+                    if include_version:
+                        row['VersionId'] = ''
+                    writer.writerow(row)
+                    written += 1
+
+        except Exception as e:
+            raise Exception(f"Error writing manifest file: {str(e)}")
+
+        return written
+
+    def generate_csv_manifest(self,
+                              output_file: str,
+                              min_size: Optional[int] = None,
+                              max_size: Optional[int] = None,
+                              file_extension: Optional[str] = None,
+                              include_version: bool = False,
+                              total_hint: Optional[int] = None,
+                              modified_after: Optional[datetime] = None,
+                              table: Optional[ObjectTable] = None) -> str:
+        """
+        Generate a CSV manifest file for S3 Batch Operations with progress bar.
+
+        Rows are written as objects are listed, so the bucket is only listed once
+        and the full listing is never held in memory. If an ObjectTable is passed,
+        the filters are applied to it instead and the bucket is not listed at all.
+        """
+        objects = self._select_objects(min_size, max_size, file_extension, total_hint, modified_after, table)
+        written = self._write_csv(output_file, objects, include_version)
+
+        if not written:
+            os.remove(output_file)
+            raise Exception("No objects found matching the specified criteria")
+
+        print(f"Wrote {written} objects to manifest")
+        return output_file
 
-            return output_file
+    def _write_shard(self,
+                     shard_file: str,
+                     objects: List[Dict],
+                     include_version: bool,
+                     manifest_bucket: Optional[str],
+                     manifest_prefix: Optional[str],
+                     timestamp: str) -> Dict:
+        """Write one manifest shard and, if a manifest bucket is given, upload it"""
+        shard = {
+            'file': shard_file,
+            # Shards go straight to S3 Batch jobs, which would read a header as a task
+            'objects': self._write_csv(shard_file, objects, include_version, header=False),
+            'bytes': sum(obj['Size'] for obj in objects)
+        }
+        if manifest_bucket:
+            shard.update(self.upload_manifest(shard_file, manifest_bucket, manifest_prefix,
+                                              timestamp=timestamp, progress=False))
+        return shard
 
+    def generate_sharded_csv_manifests(self,
+                                       output_file: str,
+                                       shard_objects: Optional[int] = None,
+                                       shard_bytes: Optional[int] = None,
+                                       min_size: Optional[int] = None,
+                                       max_size: Optional[int] = None,
+                                       file_extension: Optional[str] = None,
+                                       include_version: bool = False,
+                                       total_hint: Optional[int] = None,
+                                       modified_after: Optional[datetime] = None,
+                                       table: Optional[ObjectTable] = None,
+                                       manifest_bucket: Optional[str] = None,
+                                       manifest_prefix: Optional[str] = None,
+                                       upload_workers: int = 8) -> str:
+        """
+        Split the manifest into shards of at most shard_objects objects and/or shard_bytes
+        total object size, so each shard can run (and be retried) as its own S3 Batch job.
+
+        Each shard is written and uploaded on a thread pool as soon as it fills, while
+        listing carries on. An index file (<output>_index.json) records every shard's
+        file, object count, total bytes and, when uploaded, its bucket, key and ETag.
+
+        Returns:
+            str: Path of the local index file
+        """
+        if not shard_objects and not shard_bytes:
+            raise Exception("Sharding needs shard_objects and/or shard_bytes")
+
+        base, extension = os.path.splitext(output_file)
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        objects = self._select_objects(min_size, max_size, file_extension, total_hint, modified_after, table)
+
+        with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+            futures = []
+            pending = []
+
+            def submit(rows):
+                shard_file = f"{base}_part{len(futures):05d}{extension}"
+                futures.append(executor.submit(self._write_shard, shard_file, rows, include_version,
+                                               manifest_bucket, manifest_prefix, timestamp))
+                pending.append(futures[-1])
+                # Don't let filled shards pile up in memory faster than they are written
+                while len(pending) > 2 * upload_workers:
+                    pending.pop(0).result()
+
+            rows, rows_bytes = [], 0
+            for obj in objects:
+                # Close the shard before an object that would take it over shard_bytes
+                # (an object bigger than shard_bytes gets a shard to itself)
+                if rows and shard_bytes and rows_bytes + obj['Size'] > shard_bytes:
+                    submit(rows)
+                    rows, rows_bytes = [], 0
+                rows.append(obj)
+                rows_bytes += obj['Size']
+                if shard_objects and len(rows) >= shard_objects:
+                    submit(rows)
+                    rows, rows_bytes = [], 0
+            if rows:
+                submit(rows)
+
+            shards = [future.result() for future in futures]
+
+        if not shards:
+            raise Exception("No objects found matching the specified criteria")
+
+        index = {
+            'format': 'S3BatchOperations_CSV_20180820',
+            'fields': ['Bucket', 'Key', 'VersionId'] if include_version else ['Bucket', 'Key'],
+            'sourceBucket': self.source_bucket,
+            'prefix': self.prefix or '',
+            'objects': sum(shard['objects'] for shard in shards),
+            'bytes': sum(shard['bytes'] for shard in shards),
+            'shards': shards
+        }
+        index_file = f"{base}_index.json"
+        with open(index_file, 'w') as f:
+            json.dump(index, f, indent=2)
+
+        print(f"Wrote {index['objects']} objects to {len(shards)} manifest shards")
+        if manifest_bucket:
+            index_info = self.upload_manifest(index_file, manifest_bucket, manifest_prefix,
+                                              timestamp=timestamp, progress=False)
+            print(f"Uploaded shard index to S3: s3://{index_info['bucket']}/{index_info['key']}")
+        return index_file
+
+    def _write_inventory_csv(self, sink: 'ChecksumWriter', objects: Iterable[Dict], batch_rows: int = 10000) -> int:
+        """
+        Write objects as an S3 Inventory style gzipped CSV (Bucket, Key, Size; no header).
+
+        Keys are URL-encoded as in real inventory reports, which leaves no commas, quotes
+        or newlines to escape, so rows are joined directly instead of going through csv.
+        """
+        written = 0
+        with gzip.GzipFile(fileobj=sink, mode='wb') as gz:
+            lines = []
+            for obj in objects:
+                lines.append(f"{obj['Bucket']},{urllib.parse.quote(obj['Key'], safe='/')},{obj['Size']}\n")
+                if len(lines) == batch_rows:
+                    gz.write(''.join(lines).encode('utf-8'))
+                    written += len(lines)
+                    lines = []
+            if lines:
+                gz.write(''.join(lines).encode('utf-8'))
+                written += len(lines)
+        return written
+
+    def _write_inventory_parquet(self, sink: 'ChecksumWriter', objects: Iterable[Dict], batch_rows: int = 100000) -> int:
+        """Write objects as an S3 Inventory style Parquet file (bucket, key, size)"""
+        if pa is None:
+            raise Exception("pyarrow is required to write Parquet manifests")
+
+        written = 0
+        with pq.ParquetWriter(sink, INVENTORY_PARQUET_SCHEMA) as writer:
+            buckets, keys, sizes = [], [], []
+            for obj in objects:
+                buckets.append(obj['Bucket'])
+                keys.append(obj['Key'])
+                sizes.append(obj['Size'])
+                if len(keys) == batch_rows:
+                    writer.write_batch(pa.record_batch([buckets, keys, sizes], schema=INVENTORY_PARQUET_SCHEMA))
+                    written += len(keys)
+                    buckets, keys, sizes = [], [], []
+            if keys:
+                writer.write_batch(pa.record_batch([buckets, keys, sizes], schema=INVENTORY_PARQUET_SCHEMA))
+                written += len(keys)
+        return written
+
+    def generate_inventory_manifest(self,
+                                    output_file: str,
+                                    file_format: str = 'CSV',
+                                    min_size: Optional[int] = None,
+                                    max_size: Optional[int] = None,
+                                    file_extension: Optional[str] = None,
+                                    total_hint: Optional[int] = None,
+                                    modified_after: Optional[datetime] = None,
+                                    table: Optional[ObjectTable] = None,
+                                    manifest_bucket: Optional[str] = None,
+                                    manifest_prefix: Optional[str] = None) -> Dict:
+        """
+        Generate an S3 Inventory style JSON manifest (S3InventoryReport_CSV_20161130) for S3 Batch Operations.
+
+        S3 Batch rejects plain JSON lines; it needs a manifest.json describing the data
+        files, with each file's key, size and MD5checksum, plus a .checksum file holding
+        the MD5 of manifest.json. The data file is gzipped CSV or Parquet (file_format)
+        and is hashed while it is written, so there is no second pass over it.
+
+        The data file goes in data/ next to output_file. If manifest_bucket is given,
+        everything is uploaded under <manifest_prefix>/<timestamp>/ and manifest.json
+        references the uploaded data key, ready to pass to create_job.
+
+        Returns:
+            Dict: Local manifest path and, when uploaded, its bucket, key and ETag
+        """
+        if file_format not in ('CSV', 'Parquet'):
+            raise Exception(f"Unsupported manifest data format: {file_format}")
+
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        output_dir = os.path.dirname(output_file) or '.'
+        stem = os.path.splitext(os.path.basename(output_file))[0]
+        data_name = f"{stem}.csv.gz" if file_format == 'CSV' else f"{stem}.parquet"
+        data_file = os.path.join(output_dir, 'data', data_name)
+        os.makedirs(os.path.dirname(data_file), exist_ok=True)
+
+        objects = self._select_objects(min_size, max_size, file_extension, total_hint, modified_after, table)
+        try:
+            with open(data_file, 'wb') as f:
+                sink = ChecksumWriter(f)
+                if file_format == 'CSV':
+                    written = self._write_inventory_csv(sink, objects)
+                else:
+                    written = self._write_inventory_parquet(sink, objects)
         except Exception as e:
             raise Exception(f"Error writing manifest file: {str(e)}")
 
-    # This doesn't work. The output JSON manifest lacks necessary header information (e.g., checksum) and is
-    # therefore rejected by S3 Batch Ops. Took too long to figure this out. Could fix it, but it's easier
-    # to just use CSV files instead.
-    # def generate_json_manifest(self,
-    #                            output_file: str,
-    #                            min_size: Optional[int] = None,
-    #                            max_size: Optional[int] = None,
-    #                            file_extension: Optional[str] = None,
-    #                            extra_args: Optional[Dict] = None) -> str:
-    #     """
-    #     Generate a JSON manifest file for S3 Batch Operations with progress bar.
-    #     """
-    #     objects = self._get_objects(min_size, max_size, file_extension)
-
-    #     if not objects:
-    #         raise Exception("No objects found matching the specified criteria")
-
-    #     try:
-    #         with open(output_file, 'w') as jsonfile:
-    #             # Initialize progress bar for writing manifest
-    #             with tqdm(total=len(objects),
-    #                       desc="Writing JSON manifest",
-    #                       unit="obj",
-    #                       bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]") as pbar:
-
-    #                 for obj in objects:
-    #                     manifest_entry = {
-    #                         'bucket': obj['Bucket'],
-    #                         'key': obj['Key']
-    #                     }
-
-    #                     if extra_args:
-    #                         manifest_entry.update(extra_args)
-
-    #                     jsonfile.write(json.dumps(manifest_entry) + '\n')
-    #                     pbar.update(1)
-
-    #         return output_file
-
-    #     except Exception as e:
-    #         raise Exception(f"Error writing manifest file: {str(e)}")
+        if not written:
+            os.remove(data_file)
+            raise Exception("No objects found matching the specified criteria")
+
+        base_key = None
+        if manifest_bucket:
+            base_key = f"{manifest_prefix}/{timestamp}" if manifest_prefix else timestamp
+        data_key = f"{base_key}/data/{data_name}" if base_key else f"data/{data_name}"
+
+        manifest = {
+            'sourceBucket': self.source_bucket,
+            'destinationBucket': f"arn:aws:s3:::{manifest_bucket}" if manifest_bucket else '',
+            'version': '2016-11-30',
+            'creationTimestamp': str(int(datetime.now(timezone.utc).timestamp() * 1000)),
+            'fileFormat': file_format,
+            'fileSchema': INVENTORY_FILE_SCHEMAS[file_format],
+            'files': [{'key': data_key, 'size': sink.size, 'MD5checksum': sink.md5.hexdigest()}]
+        }
+        manifest_bytes = json.dumps(manifest, indent=2).encode('utf-8')
+        checksum_file = os.path.join(output_dir, f"{stem}.checksum")
+        with open(output_file, 'wb') as f:
+            f.write(manifest_bytes)
+        with open(checksum_file, 'w') as f:
+            f.write(hashlib.md5(manifest_bytes).hexdigest() + '\n')
+
+        print(f"Wrote {written} objects to {file_format} manifest data file {data_file}")
+        result = {'file': output_file}
+        if manifest_bucket:
+            try:
+                manifest_key = f"{base_key}/manifest.json"
+                self.s3_client.upload_file(data_file, manifest_bucket, data_key)
+                self.s3_client.upload_file(output_file, manifest_bucket, manifest_key)
+                self.s3_client.upload_file(checksum_file, manifest_bucket, f"{base_key}/manifest.checksum")
+                result.update({
+                    'bucket': manifest_bucket,
+                    'key': manifest_key,
+                    'etag': self.s3_client.head_object(Bucket=manifest_bucket, Key=manifest_key)['ETag']
+                })
+            except Exception as e:
+                raise Exception(f"Error uploading manifest to S3: {str(e)}")
+        return result
 
     def upload_manifest(self,
                         manifest_file: str,
                         manifest_bucket: str,
-                        manifest_prefix: Optional[str] = None) -> Dict:
+                        manifest_prefix: Optional[str] = None,
+                        timestamp: Optional[str] = None,
+                        progress: bool = True) -> Dict:
         """
         Upload the manifest file to S3 with progress bar.
         """
         try:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            timestamp = timestamp or datetime.now().strftime('%Y%m%d_%H%M%S')
             file_name = manifest_file.split('/')[-1]
             manifest_key = f"{manifest_prefix}/{timestamp}_{file_name}" if manifest_prefix else f"{timestamp}_{file_name}"
 
@@ -214,6 +863,7 @@ class ManifestGenerator:
                       unit='B',
                       unit_scale=True,
                       unit_divisor=1024,
+                      disable=not progress,
                       bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]") as pbar:
 
                 def callback(bytes_transferred):
@@ -245,17 +895,45 @@ def format_size(size):
             return f"{size:.1f} {unit}"
         size /= 1024.0
 
+def parse_datetime(value):
+    """Parse an ISO date/time from the command line, assuming UTC if no offset is given"""
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
 def main():
     parser = argparse.ArgumentParser(description='Generate S3 Batch Operations manifest file')
     parser.add_argument('--source-bucket', required=True, help='Source S3 bucket')
     parser.add_argument('--prefix', help='Optional prefix filter')
     parser.add_argument('--output', required=True, help='Output file path')
-    parser.add_argument('--format', choices=['csv', 'json'], default='csv', help='Manifest format')
+    parser.add_argument('--format', choices=['csv', 'json', 'parquet'], default='csv',
+                        help='Manifest format: csv (S3BatchOperations_CSV_20180820), or an S3 Inventory style '
+                             'manifest.json with gzipped CSV (json) or Parquet (parquet) data')
     parser.add_argument('--min-size', type=int, help='Minimum file size in bytes')
     parser.add_argument('--max-size', type=int, help='Maximum file size in bytes')
     parser.add_argument('--extension', help='File extension filter')
     parser.add_argument('--manifest-bucket', help='S3 bucket to upload manifest')
     parser.add_argument('--manifest-prefix', help='S3 prefix for manifest')
+    parser.add_argument('--expected-count', type=int,
+                        help='Estimated object count (e.g., from S3 Inventory) for listing progress')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of key-range shards (or inventory files) to read concurrently')
+    parser.add_argument('--from-inventory', metavar='S3_URI',
+                        help='Build the manifest from the latest S3 Inventory report under this s3:// URI '
+                             '(or a specific manifest.json) instead of listing the bucket')
+    parser.add_argument('--modified-after', type=parse_datetime,
+                        help='Only include objects modified at or after this ISO date/time (UTC if no offset)')
+    parser.add_argument('--save-table', metavar='NPZ',
+                        help='Save the unfiltered listing as a columnar object table (.npz) for later runs')
+    parser.add_argument('--from-table', metavar='NPZ',
+                        help='Build the manifest from a saved object table instead of listing the bucket')
+    parser.add_argument('--shard-objects', type=int,
+                        help='Split the manifest into shards of at most this many objects')
+    parser.add_argument('--shard-bytes', type=int,
+                        help='Split the manifest into shards covering at most this many bytes of objects '
+                             '(an object larger than this gets a shard of its own)')
+    parser.add_argument('--since-snapshot', metavar='PATH_OR_S3_URI',
+                        help='Only include objects added or changed since the listing snapshot stored here '
+                             '(a local .npz path or s3:// URI), then replace the snapshot with this listing')
 
     args = parser.parse_args()
 
@@ -269,34 +947,96 @@ def main():
             print(f"Maximum size filter: {format_size(args.max_size)}")
         if args.extension:
             print(f"File extension filter: {args.extension}")
+        if args.modified_after:
+            print(f"Modified after filter: {args.modified_after.isoformat()}")
         print("\n")
 
-        generator = ManifestGenerator(args.source_bucket, args.prefix)
-
-        # if args.format == 'csv':
-        manifest_file = generator.generate_csv_manifest(
-            args.output,
-            args.min_size,
-            args.max_size,
-            args.extension
-        )
-        # else:
-        #     manifest_file = generator.generate_json_manifest(
-        #         args.output,
-        #         args.min_size,
-        #         args.max_size,
-        #         args.extension
-        #     )
-
-        print(f"\nGenerated manifest file: {manifest_file}")
-
-        if args.manifest_bucket:
-            manifest_info = generator.upload_manifest(
-                manifest_file,
-                args.manifest_bucket,
-                args.manifest_prefix
+        generator = ManifestGenerator(args.source_bucket, args.prefix,
+                                      max_workers=args.workers,
+                                      inventory_uri=args.from_inventory)
+
+        table = None
+        if args.from_table:
+            table = ObjectTable.load(args.from_table)
+            if table.bucket != args.source_bucket:
+                raise Exception(f"Object table {args.from_table} is for bucket {table.bucket}, not {args.source_bucket}")
+        elif args.save_table or args.since_snapshot:
+            table = generator.build_object_table(args.expected_count)
+            if args.save_table:
+                table.save(args.save_table)
+                print(f"Saved object table: {args.save_table}")
+
+        # In delta mode the manifest only covers what changed; the full listing becomes the
+        # next snapshot once the manifest has been written
+        listing = None
+        if args.since_snapshot:
+            listing = table
+            table = generator.build_delta_table(listing, generator.load_snapshot(args.since_snapshot))
+            if not len(table):
+                print("\nNo new or changed objects; no manifest written")
+                generator.save_snapshot(listing, args.since_snapshot)
+                return
+
+        if args.shard_objects or args.shard_bytes:
+            if args.format != 'csv':
+                raise Exception("Sharded manifests are only written in csv format")
+            index_file = generator.generate_sharded_csv_manifests(
+                args.output,
+                args.shard_objects,
+                args.shard_bytes,
+                args.min_size,
+                args.max_size,
+                args.extension,
+                total_hint=args.expected_count,
+                modified_after=args.modified_after,
+                table=table,
+                manifest_bucket=args.manifest_bucket,
+                manifest_prefix=args.manifest_prefix
+            )
+            print(f"\nGenerated manifest shard index: {index_file}")
+
+        elif args.format != 'csv':
+            manifest_info = generator.generate_inventory_manifest(
+                args.output,
+                'CSV' if args.format == 'json' else 'Parquet',
+                args.min_size,
+                args.max_size,
+                args.extension,
+                total_hint=args.expected_count,
+                modified_after=args.modified_after,
+                table=table,
+                manifest_bucket=args.manifest_bucket,
+                manifest_prefix=args.manifest_prefix
+            )
+            print(f"\nGenerated manifest file: {manifest_info['file']}")
+            if args.manifest_bucket:
+                print(f"Uploaded manifest to S3: s3://{manifest_info['bucket']}/{manifest_info['key']} "
+                      f"(ETag {manifest_info['etag']})")
+
+        else:
+            manifest_file = generator.generate_csv_manifest(
+                args.output,
+                args.min_size,
+                args.max_size,
+                args.extension,
+                total_hint=args.expected_count,
+                modified_after=args.modified_after,
+                table=table
             )
-            print(f"Uploaded manifest to S3: s3://{manifest_info['bucket']}/{manifest_info['key']}")
+
+            print(f"\nGenerated manifest file: {manifest_file}")
+
+            if args.manifest_bucket:
+                manifest_info = generator.upload_manifest(
+                    manifest_file,
+                    args.manifest_bucket,
+                    args.manifest_prefix
+                )
+                print(f"Uploaded manifest to S3: s3://{manifest_info['bucket']}/{manifest_info['key']}")
+
+        if listing is not None:
+            generator.save_snapshot(listing, args.since_snapshot)
+            print(f"Updated listing snapshot: {args.since_snapshot}")
 
     except Exception as e:
         print(f"\nError: {str(e)}", file=sys.stderr)
@@ -0,0 +1,235 @@
+import hashlib
+import json
+import numpy as np
+from datetime import datetime, timezone
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+
+class StringColumn:
+    """
+    A column of strings stored as one UTF-8 byte buffer plus an offsets array.
+
+    String i is buffer[offsets[i]:offsets[i + 1]]. Compared to a list of Python str
+    objects (~50+ bytes of overhead each) this costs 8 bytes per string on top of the
+    string itself, and prefix/suffix tests can run over every row at once.
+    """
+
+    def __init__(self, buffer: np.ndarray, offsets: np.ndarray):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings: List[str]) -> 'StringColumn':
+        encoded = [s.encode('utf-8') for s in strings]
+        lengths = np.fromiter((len(e) for e in encoded), dtype=np.int64, count=len(encoded))
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    @classmethod
+    def concatenate(cls, columns: List['StringColumn']) -> 'StringColumn':
+        if not columns:
+            return cls(np.zeros(0, dtype=np.uint8), np.zeros(1, dtype=np.int64))
+        starts = np.cumsum([0] + [len(column.buffer) for column in columns[:-1]])
+        offsets = np.concatenate([columns[0].offsets[:1]] +
+                                 [column.offsets[1:] + start for column, start in zip(columns, starts)])
+        return cls(np.concatenate([column.buffer for column in columns]), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def take(self, indices: np.ndarray) -> 'StringColumn':
+        """Gather the strings at indices into a new, compact column"""
+        starts = self.offsets[:-1][indices]
+        lengths = self.offsets[1:][indices] - starts
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Byte j of the output comes from starts[row] + (j - offsets[row])
+        gather = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1], dtype=np.int64)
+        return StringColumn(self.buffer[gather], offsets)
+
+    def hashes(self) -> np.ndarray:
+        """64-bit BLAKE2b digest of every string, for matching rows between columns"""
+        buffer = self.buffer.tobytes()
+        bounds = self.offsets.tolist()
+        return np.fromiter(
+            (int.from_bytes(hashlib.blake2b(buffer[start:end], digest_size=8).digest(), 'little')
+             for start, end in zip(bounds[:-1], bounds[1:])),
+            dtype=np.uint64, count=len(self))
+
+    def _matches_at(self, positions: np.ndarray, lengths: np.ndarray, value: str) -> np.ndarray:
+        """Compare value's bytes against the bytes at each row's start position"""
+        encoded = value.encode('utf-8')
+        mask = lengths >= len(encoded)
+        if not len(self.buffer):
+            return mask
+        for i, byte in enumerate(encoded):
+            # Rows too short to hold value are already False; point them at a safe index
+            index = np.where(mask, positions + i, 0)
+            mask &= self.buffer[index] == byte
+        return mask
+
+    def startswith(self, prefix: str) -> np.ndarray:
+        lengths = np.diff(self.offsets)
+        return self._matches_at(self.offsets[:-1], lengths, prefix)
+
+    def endswith(self, suffix: str) -> np.ndarray:
+        lengths = np.diff(self.offsets)
+        return self._matches_at(self.offsets[1:] - len(suffix.encode('utf-8')), lengths, suffix)
+
+
+class ObjectTable:
+    """
+    Columnar, in-memory listing of the objects in a bucket/prefix.
+
+    Keys (and ETags) are held as StringColumns, sizes as int64 and LastModified as
+    int64 epoch seconds, so tens of millions of objects fit in a few hundred MB instead
+    of several GB of dicts. Filters are vectorized predicates that return boolean masks,
+    and the table can be saved to a compressed .npz and loaded later to derive manifests
+    for other filter combinations without listing the bucket again.
+    """
+
+    def __init__(self,
+                 bucket: str,
+                 prefix: str,
+                 keys: StringColumn,
+                 sizes: np.ndarray,
+                 last_modified: np.ndarray,
+                 etags: StringColumn):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.keys = keys
+        self.sizes = sizes
+        self.last_modified = last_modified
+        self.etags = etags
+
+    @classmethod
+    def from_pages(cls, bucket: str, prefix: str, pages: Iterable[List[Dict]]) -> 'ObjectTable':
+        """
+        Build a table from ListObjectsV2-style pages ('Contents' lists).
+
+        Each page is converted to arrays as it arrives, so only one page of dicts is
+        alive at a time.
+        """
+        keys, sizes, last_modified, etags = [], [], [], []
+        for contents in pages:
+            keys.append(StringColumn.from_strings([obj['Key'] for obj in contents]))
+            etags.append(StringColumn.from_strings([(obj.get('ETag') or '').strip('"') for obj in contents]))
+            sizes.append(np.fromiter((obj['Size'] for obj in contents), dtype=np.int64, count=len(contents)))
+            last_modified.append(np.fromiter(
+                (obj['LastModified'].timestamp() if obj.get('LastModified') else 0 for obj in contents),
+                dtype=np.int64, count=len(contents)))
+
+        return cls(bucket, prefix,
+                   StringColumn.concatenate(keys),
+                   np.concatenate(sizes) if sizes else np.zeros(0, dtype=np.int64),
+                   np.concatenate(last_modified) if last_modified else np.zeros(0, dtype=np.int64),
+                   StringColumn.concatenate(etags))
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.keys.buffer, self.keys.offsets, self.sizes,
+                                              self.last_modified, self.etags.buffer, self.etags.offsets))
+
+    def filter(self,
+               min_size: Optional[int] = None,
+               max_size: Optional[int] = None,
+               file_extension: Optional[str] = None,
+               modified_after: Optional[datetime] = None,
+               prefix: Optional[str] = None) -> np.ndarray:
+        """
+        Evaluate the manifest filters over every row at once.
+
+        Returns:
+            np.ndarray: Boolean mask of the rows matching all the criteria
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if min_size:
+            mask &= self.sizes >= min_size
+        if max_size:
+            mask &= self.sizes <= max_size
+        if modified_after:
+            mask &= self.last_modified >= int(modified_after.timestamp())
+        if file_extension:
+            mask &= self.keys.endswith(file_extension)
+        if prefix:
+            mask &= self.keys.startswith(prefix)
+        return mask
+
+    def take(self, indices: np.ndarray) -> 'ObjectTable':
+        """Return a new table holding only the rows at indices (or where a boolean mask is True)"""
+        indices = np.flatnonzero(indices) if indices.dtype == bool else indices
+        return ObjectTable(self.bucket, self.prefix,
+                           self.keys.take(indices),
+                           self.sizes[indices],
+                           self.last_modified[indices],
+                           self.etags.take(indices))
+
+    def changed_since(self, previous: 'ObjectTable') -> Tuple[np.ndarray, int]:
+        """
+        Compare this listing against an earlier one of the same bucket/prefix.
+
+        Rows are matched on a 64-bit hash of the key; a matched row counts as changed if
+        its size or ETag differs.
+
+        Returns:
+            Tuple[np.ndarray, int]: Mask of rows that are new or changed, and the number
+                of keys in previous that are gone
+        """
+        current_hashes = self.keys.hashes()
+        if not len(previous):
+            return np.ones(len(self), dtype=bool), 0
+
+        previous_hashes = previous.keys.hashes()
+        order = np.argsort(previous_hashes)
+        sorted_hashes = previous_hashes[order]
+        positions = np.searchsorted(sorted_hashes, current_hashes).clip(max=len(sorted_hashes) - 1)
+        found = sorted_hashes[positions] == current_hashes
+        matches = order[positions]
+
+        unchanged = (found &
+                     (previous.sizes[matches] == self.sizes) &
+                     (previous.etags.hashes()[matches] == self.etags.hashes()))
+        removed = int(np.isin(previous_hashes, current_hashes, invert=True).sum())
+        return ~unchanged, removed
+
+    def iter_objects(self, mask: Optional[np.ndarray] = None) -> Iterator[Dict]:
+        """Yield the selected rows in the same shape as ManifestGenerator._iter_objects"""
+        rows = np.flatnonzero(mask) if mask is not None else range(len(self))
+        for i in rows:
+            yield {
+                'Bucket': self.bucket,
+                'Key': self.keys[i],
+                'Size': int(self.sizes[i]),
+                'LastModified': datetime.fromtimestamp(int(self.last_modified[i]), tz=timezone.utc).isoformat()
+            }
+
+    def save(self, path: Union[str, BinaryIO]):
+        """Save the table as a compressed .npz file (a path, or an open binary file)"""
+        np.savez_compressed(
+            path,
+            metadata=np.array(json.dumps({'bucket': self.bucket, 'prefix': self.prefix})),
+            key_buffer=self.keys.buffer,
+            key_offsets=self.keys.offsets,
+            sizes=self.sizes,
+            last_modified=self.last_modified,
+            etag_buffer=self.etags.buffer,
+            etag_offsets=self.etags.offsets
+        )
+
+    @classmethod
+    def load(cls, path: Union[str, BinaryIO]) -> 'ObjectTable':
+        """Load a table saved with save() (from a path, or an open binary file)"""
+        with np.load(path) as data:
+            metadata = json.loads(str(data['metadata']))
+            return cls(metadata['bucket'], metadata['prefix'],
+                       StringColumn(data['key_buffer'], data['key_offsets']),
+                       data['sizes'],
+                       data['last_modified'],
+                       StringColumn(data['etag_buffer'], data['etag_offsets']))
@@ -0,0 +1,121 @@
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import random
+import sys
+import time
+import urllib.parse
+from datetime import datetime, timedelta, timezone
+
+from moto import mock_aws
+
+'''
+Compares the row-by-row csv.reader inventory filter in s3movetoglacier.py against the
+vectorized pyarrow backend, using moto as a local S3 stand-in.
+
+A synthetic S3 Inventory (gzipped CSV data files plus manifest.json, as S3 Inventory
+delivers them) is written for --rows objects, then each backend builds the Glacier
+manifest for the same predicates and the manifests are compared. The default run
+uses the original predicate (exclude GLACIER) so both backends do the same work; pass
+--min-size/--min-age-days/--key-pattern to time the richer predicates as well.
+
+Example:
+python benchmark_inventory_filter.py --rows 2000000 --files 4 --output filter_benchmark.json
+'''
+
+INVENTORY_SCHEMA = 'Bucket, Key, Size, LastModifiedDate, ETag, StorageClass'
+STORAGE_CLASSES = ['STANDARD', 'STANDARD', 'INTELLIGENT_TIERING', 'GLACIER', 'STANDARD_IA']
+
+
+def write_inventory(s3, glacier, n_rows, n_files):
+    """Write a synthetic CSV inventory for glacier.SOURCE_BUCKET_NAME and return its manifest.json content"""
+    random.seed(0)
+    now = datetime.now(timezone.utc)
+    prefix = f"{glacier.INVENTORY_REPORT_PREFIX.rstrip('/')}/benchmark"
+    files = []
+    for i in range(n_files):
+        buffer = io.BytesIO()
+        with gzip.open(buffer, 'wt', newline='') as gz:
+            writer = csv.writer(gz, quoting=csv.QUOTE_ALL)
+            for row in range(i, n_rows, n_files):
+                key = f"fmriresults01/abcd_v51/NDAR_INV{row:08d}_baselineYear1Arm1_{row % 7}.{'tgz' if row % 3 else 'json'}"
+                modified = now - timedelta(days=random.randint(0, 720), seconds=row)
+                writer.writerow([glacier.SOURCE_BUCKET_NAME, urllib.parse.quote(key), random.choice([512, 40_000, 9_000_000]),
+                                 modified.strftime('%Y-%m-%dT%H:%M:%S.000Z'), f'{row:032x}',
+                                 random.choice(STORAGE_CLASSES)])
+        data_key = f"{prefix}/data/inventory-{i}.csv.gz"
+        s3.put_object(Bucket=glacier.INVENTORY_REPORT_BUCKET, Key=data_key, Body=buffer.getvalue())
+        files.append({'key': data_key, 'size': buffer.tell(), 'MD5checksum': ''})
+    return json.dumps({
+        'sourceBucket': glacier.SOURCE_BUCKET_NAME,
+        'fileFormat': 'CSV',
+        'fileSchema': INVENTORY_SCHEMA,
+        'files': files
+    })
+
+
+def run(glacier, s3, manifest_content, backend, predicates, workers, repeat):
+    """Build the manifest repeat times with one backend; report the fastest run"""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        writer = glacier.filter_inventory_report(manifest_content, max_workers=workers, predicates=predicates,
+                                                 backend=backend, manifest_key=f'benchmark/{backend}-{i}.csv')
+        times.append(time.perf_counter() - start)
+    body = s3.get_object(Bucket=writer.bucket, Key=writer.key)['Body'].read()
+    return {'backend': backend, 'seconds': round(min(times), 3), 'rows': writer.count}, sorted(body.splitlines())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the python and arrow inventory filter backends')
+    parser.add_argument('--rows', type=int, default=500000, help='Number of inventory rows')
+    parser.add_argument('--files', type=int, default=4, help='Number of inventory data files')
+    parser.add_argument('--workers', type=int, default=4, help='Files filtered at the same time')
+    parser.add_argument('--min-size', type=int, help='Only move objects at least this many bytes')
+    parser.add_argument('--min-age-days', type=float, help='Only move objects at least this old')
+    parser.add_argument('--key-pattern', help='Only move objects whose key matches this regex')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per backend; the fastest is reported (the first arrow run pays pyarrow start-up)')
+    parser.add_argument('--output', help='Optional JSON file for the results')
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        import s3movetoglacier as glacier
+        s3 = glacier.s3_client
+        for bucket in {glacier.INVENTORY_REPORT_BUCKET, glacier.MANIFEST_BUCKET}:
+            s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': glacier.REGION})
+        print(f"Writing a {args.rows}-row inventory in {args.files} files...")
+        manifest_content = write_inventory(s3, glacier, args.rows, args.files)
+
+        predicates = glacier.InventoryFilter(min_size=args.min_size, min_age_days=args.min_age_days,
+                                             key_pattern=args.key_pattern)
+        results = []
+        manifests = []
+        for backend in ('python', 'arrow'):
+            result, lines = run(glacier, s3, manifest_content, backend, predicates, args.workers, args.repeat)
+            result['rows_per_second'] = round(args.rows / result['seconds'])
+            results.append(result)
+            manifests.append(lines)
+        same_objects = manifests[0] == manifests[1]
+
+    for result in results:
+        print(f"{result['backend']:>8}: {result['rows']} of {args.rows} rows selected in {result['seconds']}s "
+              f"({result['rows_per_second']} rows/s)")
+    print(f"Speedup: {results[0]['seconds'] / results[1]['seconds']:.1f}x")
+    print(f"Manifests contain the same objects: {same_objects}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'rows': args.rows, 'files': args.files, 'arguments': vars(args),
+                       'same_objects': same_objects, 'results': results}, f, indent=2)
+
+    if not same_objects:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
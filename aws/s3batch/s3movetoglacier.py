@@ -1,7 +1,30 @@
+import argparse
 import boto3
 import csv
+import gzip
 import io
+import json
+import random
+import re
+import tarfile
+import threading
 import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+import numpy as np
+
+# pyarrow is optional; without it only the row-by-row CSV filter is available
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pc = pacsv = pq = None
 
 # --- Configuration ---
 SOURCE_BUCKET_NAME = 'abcd-v51'
@@ -15,9 +38,78 @@ REGION = 'us-east-2'  # e.g., 'us-east-1'
 TARGET_STORAGE_CLASS = 'GLACIER'
 EXCLUDE_STORAGE_CLASS = 'GLACIER'  # Objects already in this class will be excluded
 
+# Inventory data files are filtered FILTER_WORKERS at a time, and the filtered manifest
+# is uploaded in MANIFEST_PART_SIZE parts as it is written (S3's minimum part is 5 MiB)
+FILTER_WORKERS = 8
+MANIFEST_PART_SIZE = 16 * 1024 * 1024
+
+# Transition planning (plan_transitions). Objects below BUNDLE_MAX_OBJECT_SIZE are packed
+# into tar bundles of about BUNDLE_TARGET_SIZE written straight to TARGET_STORAGE_CLASS;
+# larger ones are transitioned directly by S3 Batch Operations.
+BUNDLE_MAX_OBJECT_SIZE = 128 * 1024
+BUNDLE_TARGET_SIZE = 1024 ** 3
+BUNDLE_BUCKET = 'brave-abcd'
+BUNDLE_PREFIX = f'glacier-bundles/{SOURCE_BUCKET_NAME}/'
+# Size classes (upper bounds, bytes) the cost report is broken down by
+SIZE_CLASSES = [16 * 1024, 128 * 1024, 1024 ** 2, 16 * 1024 ** 2, 128 * 1024 ** 2, 1024 ** 3]
+
+# Direct-transition manifests are split by object size at DIRECT_SIZE_BANDS and into
+# shards of at most DIRECT_SHARD_OBJECTS, one S3 Batch job per shard. S3PutObjectCopy
+# can't copy objects over 5 GiB, so the last band is planned but never submitted.
+DIRECT_SIZE_BANDS = [128 * 1024 ** 2, 5 * 1024 ** 3]
+DIRECT_BAND_NAMES = ['medium', 'large', 'oversize']
+DIRECT_SHARD_OBJECTS = 5_000_000
+COPY_SIZE_LIMIT = 5 * 1024 ** 3
+
+# Runner settings: jobs submitted at once, and the polling backoff (seconds)
+MAX_CONCURRENT_JOBS = 4
+POLL_INITIAL_SECONDS = 15
+POLL_MAX_SECONDS = 300
+
+# List prices (USD, us-east-2) for the planner's cost estimates
+STORAGE_PRICE_PER_GB_MONTH = {
+    'STANDARD': 0.023,
+    'INTELLIGENT_TIERING': 0.023,
+    'STANDARD_IA': 0.0125,
+    'ONEZONE_IA': 0.01,
+    'GLACIER_IR': 0.004,
+    'GLACIER': 0.0036,
+    'DEEP_ARCHIVE': 0.00099
+}
+# PUT/COPY/lifecycle transition requests into the class, per 1,000 objects
+TRANSITION_PRICE_PER_1000 = {'GLACIER_IR': 0.02, 'GLACIER': 0.03, 'DEEP_ARCHIVE': 0.05}
+GET_PRICE_PER_1000 = 0.0004
+BATCH_OPERATIONS_PRICE_PER_MILLION = 1.00
+# Glacier Flexible Retrieval and Deep Archive bill 32 KiB of index per object at the
+# archive rate plus 8 KiB of metadata at the STANDARD rate
+ARCHIVE_INDEX_BYTES = 32 * 1024
+ARCHIVE_METADATA_BYTES = 8 * 1024
+
+# Parquet inventories use snake_case column names for the fields named in CSV fileSchemas
+PARQUET_COLUMNS = {
+    'Bucket': 'bucket',
+    'Key': 'key',
+    'VersionId': 'version_id',
+    'Size': 'size',
+    'LastModifiedDate': 'last_modified_date',
+    'StorageClass': 'storage_class'
+}
+
+# Inventory deliveries are folders named like 2025-06-01T01-00Z, next to data/ and hive/
+DELIVERY_FOLDER = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}-\d{2}Z$')
+
 s3_client = boto3.client('s3', region_name=REGION)
 s3control_client = boto3.client('s3control', region_name=REGION)
-account_id = boto3.client('sts').get_caller_identity().get('Account')
+_account_id = None
+
+
+def get_account_id():
+    """The caller's AWS account ID, looked up on first use rather than at import"""
+    global _account_id
+    if _account_id is None:
+        _account_id = boto3.client('sts').get_caller_identity().get('Account')
+    return _account_id
+
 
 def get_latest_inventory_manifest(inventory_bucket, inventory_prefix):
     """
@@ -34,6 +126,9 @@ def get_latest_inventory_manifest(inventory_bucket, inventory_prefix):
             # Extract timestamp from prefix (assuming YYYY-MM-DDTHH-MMZ format)
             try:
                 timestamp_str = current_prefix.split('/')[-2]  # Assumes last part before trailing / is the timestamp
+                # 'hive' and 'data' sort after any timestamp, so only consider delivery folders
+                if not DELIVERY_FOLDER.match(timestamp_str):
+                    continue
                 if latest_timestamp_prefix is None or timestamp_str > latest_timestamp_prefix.split('/')[-2]:
                     latest_timestamp_prefix = current_prefix
             except IndexError:
@@ -50,70 +145,767 @@ def get_latest_inventory_manifest(inventory_bucket, inventory_prefix):
             return None
     return None
 
-def filter_inventory_report(manifest_content, exclude_storage_class):
+class MultipartWriter:
     """
-    Reads the inventory report from the manifest, filters objects, and creates a new manifest.
+    Writes an object straight to S3 as a multipart upload.
+
+    Data is buffered until a part's worth has accumulated, then that part is uploaded,
+    so memory stays at about one part per writing thread no matter how much is
+    written. Writes are thread-safe: the full buffer is swapped out (and given its part
+    number) under the lock, but uploaded outside it, so writers don't wait on each
+    other's uploads. An object smaller than one part is sent with a single PUT on close().
     """
-    manifest_json = json.loads(manifest_content)
-    inventory_file_path = manifest_json['files'][0]['key']  # Get the key of the inventory CSV.GZ file
 
-    print(f"Downloading and processing inventory file: s3://{INVENTORY_REPORT_BUCKET}/{inventory_file_path}")
-    inventory_obj = s3_client.get_object(Bucket=INVENTORY_REPORT_BUCKET, Key=inventory_file_path)
+    def __init__(self, bucket, key, content_type='application/octet-stream', storage_class=None,
+                 part_size=MANIFEST_PART_SIZE):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.arn = None
+        self.etag = None
+        self._extra = {'ContentType': content_type}
+        if storage_class:
+            self._extra['StorageClass'] = storage_class
+        self._buffer = bytearray()
+        self._parts = []
+        self._next_part = 1
+        self._in_flight = 0
+        self._error = None
+        self._upload_id = None
+        self._lock = threading.Lock()
+        self._uploads_done = threading.Condition(self._lock)
 
-    # Decompress gzipped content
-    with gzip.open(io.BytesIO(inventory_obj['Body'].read()), 'rt') as f:
-        reader = csv.reader(f)
-        header = next(reader)  # Skip header if present, or adapt if your report includes it
+    def _append(self, data):
+        """
+        Buffer data; called with the lock held. If that fills a part, returns
+        (part number, part bytes) for the caller to pass to _upload_part once it
+        has released the lock.
+        """
+        self._buffer += data
+        if len(self._buffer) < self.part_size:
+            return None
+        if self._upload_id is None:
+            self._upload_id = s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self._extra)['UploadId']
+        part, self._buffer = bytes(self._buffer), bytearray()
+        part_number = self._next_part
+        self._next_part += 1
+        self._in_flight += 1
+        return part_number, part
 
-        # Determine column indices dynamically
+    def _upload_part(self, part_number, data):
+        """Upload one part taken by _append; called without the lock"""
         try:
-            bucket_idx = header.index('Bucket') if 'Bucket' in header else 0
-            key_idx = header.index('Key') if 'Key' in header else 1
-            storage_class_idx = header.index('StorageClass') if 'StorageClass' in header else 3  # Default based on common inventory format
-            print(storage_class_idx)
-            version_id_idx = header.index('VersionId') if 'VersionId' in header else -1  # Optional for versioned buckets
-        except ValueError as e:
-            print(f"Error: Required column not found in inventory report header: {e}. Please check your inventory configuration.")
-            return None
+            response = s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                             PartNumber=part_number, Body=data)
+        except Exception as exc:
+            with self._lock:
+                # S3 would complete around a missing part, so make close() fail instead
+                self._error = exc
+                self._in_flight -= 1
+                self._uploads_done.notify_all()
+            raise
+        with self._lock:
+            self._parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+            self._in_flight -= 1
+            self._uploads_done.notify_all()
+
+    def write(self, data):
+        """File-like write, so the writer can be the target of e.g. a streaming tarfile"""
+        with self._lock:
+            part = self._append(data)
+        if part:
+            self._upload_part(*part)
+        return len(data)
+
+    def close(self):
+        """Wait for any parts still uploading, finish the upload and return the object's ARN"""
+        with self._lock:
+            self._uploads_done.wait_for(lambda: self._in_flight == 0)
+            if self._error is not None:
+                raise RuntimeError(f"A part of s3://{self.bucket}/{self.key} failed to upload") from self._error
+            if self._upload_id is None:
+                response = s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer),
+                                                **self._extra)
+            else:
+                if self._buffer:
+                    part_number = self._next_part
+                    response = s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                                     PartNumber=part_number, Body=bytes(self._buffer))
+                    self._parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+                response = s3_client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                    MultipartUpload={'Parts': sorted(self._parts, key=lambda part: part['PartNumber'])})
+            self._buffer = bytearray()
+            self.etag = response['ETag'].strip('"')
+            self.arn = f"arn:aws:s3:::{self.bucket}/{self.key}"
+        return self.arn
+
+    def abort(self):
+        if self._upload_id is not None:
+            s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+
+class ManifestWriter(MultipartWriter):
+    """A MultipartWriter for CSV manifests that counts the lines written"""
+
+    def __init__(self, bucket, key, versioned=False, part_size=MANIFEST_PART_SIZE):
+        super().__init__(bucket, key, content_type='text/csv', part_size=part_size)
+        self.versioned = versioned  # Lines carry a VersionId column
+        self.count = 0
+
+    def write_lines(self, lines):
+        """Append manifest lines (without newlines), uploading a part once enough have built up"""
+        self.write_encoded(''.join(line + '\n' for line in lines).encode('utf-8'), len(lines))
+
+    def write_encoded(self, data, count):
+        """Append count lines that are already newline-terminated and UTF-8 encoded"""
+        with self._lock:
+            self.count += count
+            part = self._append(data)
+        if part:
+            self._upload_part(*part)
+
+    def close(self):
+        arn = super().close()
+        print(f"Manifest file created: s3://{self.bucket}/{self.key} ({self.count} objects)")
+        return arn
+
+
+def new_manifest_key(suffix=''):
+    return f"batch-ops-manifests/{SOURCE_BUCKET_NAME}-move-to-glacier{suffix}-{int(time.time())}.csv"
+
+
+def inventory_columns(manifest_json):
+    """Map column name -> index from the inventory manifest's fileSchema"""
+    schema = [column.strip() for column in manifest_json['fileSchema'].split(',')]
+    if manifest_json.get('fileFormat', 'CSV') == 'Parquet':
+        # Parquet schemas look like 'message s3.inventory { required binary bucket (STRING); ... }'
+        fields = re.findall(r'(?:required|optional)\s+\w+\s+(\w+)', manifest_json['fileSchema'])
+        names = {parquet: csv_name for csv_name, parquet in PARQUET_COLUMNS.items()}
+        schema = [names.get(field, field) for field in fields]
+    return {name: index for index, name in enumerate(schema)}
+
+
+@dataclass
+class InventoryFilter:
+    """
+    Which inventory rows go into the manifest.
+
+    Rows must be in SOURCE_BUCKET_NAME and pass every predicate that is set. Small
+    objects are excluded with min_size because Glacier's per-object transition fee and
+    metadata overhead outweigh the storage savings on them; min_age_days skips objects
+    modified too recently to be worth archiving; key_pattern is a regular expression
+    searched for in the (decoded) key.
+    """
+    exclude_storage_classes: Tuple[str, ...] = (EXCLUDE_STORAGE_CLASS,)
+    include_storage_classes: Tuple[str, ...] = ()  # Empty means any class
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+    min_age_days: Optional[float] = None
+    key_pattern: Optional[str] = None
+
+    def __post_init__(self):
+        self._key_regex = re.compile(self.key_pattern) if self.key_pattern else None
+        self._cutoff = None
+        if self.min_age_days is not None:
+            self._cutoff = datetime.now(timezone.utc) - timedelta(days=self.min_age_days)
+
+    @property
+    def required_columns(self):
+        columns = ['Bucket', 'Key', 'StorageClass']
+        if self.min_size is not None or self.max_size is not None:
+            columns.append('Size')
+        if self._cutoff is not None:
+            columns.append('LastModifiedDate')
+        return columns
+
+    def matches(self, bucket, key, storage_class, size=None, last_modified=None):
+        """Row-by-row test, for the CSV reader loop (key URL-encoded, values as strings)"""
+        if bucket != SOURCE_BUCKET_NAME or storage_class in self.exclude_storage_classes:
+            return False
+        if self.include_storage_classes and storage_class not in self.include_storage_classes:
+            return False
+        if self.min_size is not None and int(size or 0) < self.min_size:
+            return False
+        if self.max_size is not None and int(size or 0) > self.max_size:
+            return False
+        # Inventory timestamps are ISO 8601 in UTC, so they compare correctly as strings
+        if self._cutoff is not None and last_modified >= self._cutoff.strftime('%Y-%m-%dT%H:%M:%S.000Z'):
+            return False
+        if self._key_regex and not self._key_regex.search(urllib.parse.unquote_plus(key)):
+            return False
+        return True
+
+    def mask(self, batch, keys_encoded=True):
+        """Vectorized test over an Arrow record batch with CSV column names"""
+        mask = pc.equal(batch['Bucket'], SOURCE_BUCKET_NAME)
+        storage_class = batch['StorageClass']
+        if self.exclude_storage_classes:
+            mask = pc.and_(mask, pc.invert(pc.is_in(storage_class, value_set=pa.array(self.exclude_storage_classes))))
+        if self.include_storage_classes:
+            mask = pc.and_(mask, pc.is_in(storage_class, value_set=pa.array(self.include_storage_classes)))
+        if self.min_size is not None:
+            mask = pc.and_(mask, pc.greater_equal(batch['Size'], self.min_size))
+        if self.max_size is not None:
+            mask = pc.and_(mask, pc.less_equal(batch['Size'], self.max_size))
+        if self._cutoff is not None:
+            last_modified = batch['LastModifiedDate']
+            mask = pc.and_(mask, pc.less(last_modified, pa.scalar(self._cutoff, type=last_modified.type)))
+        mask = pc.fill_null(mask, False)
+        if self._key_regex:
+            # Only the rows still selected are decoded and searched
+            rows = pc.indices_nonzero(mask).to_pylist()
+            keys = batch['Key'].take(rows).to_pylist()
+            if keys_encoded:
+                keys = [urllib.parse.unquote_plus(key) for key in keys]
+            hits = [row for row, key in zip(rows, keys) if self._key_regex.search(key)]
+            mask = pc.is_in(pa.array(range(len(batch)), type=pa.int64()), value_set=pa.array(hits, type=pa.int64()))
+        return mask
 
-        filtered_objects = []
-        for row in reader:
+
+class S3ObjectFile(io.RawIOBase):
+    """Seekable read-only file over an S3 object, so pyarrow can read Parquet footers and column chunks by range"""
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        self.size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size or not len(buffer):
+            return 0
+        end = min(self.position + len(buffer), self.size) - 1
+        data = s3_client.get_object(Bucket=self.bucket, Key=self.key,
+                                    Range=f'bytes={self.position}-{end}')['Body'].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def filter_inventory_file(inventory_file_path, columns, predicates, writer, batch_size=10000):
+    """
+    Stream one inventory .csv.gz data file, decompressing it incrementally, and write the
+    rows to move to writer in batches. Returns the number of rows written.
+    """
+    bucket_idx = columns['Bucket']
+    key_idx = columns['Key']
+    storage_class_idx = columns['StorageClass']
+    version_id_idx = columns.get('VersionId', -1)
+    size_idx = columns.get('Size', -1)
+    last_modified_idx = columns.get('LastModifiedDate', -1)
+
+    print(f"Processing inventory file: s3://{INVENTORY_REPORT_BUCKET}/{inventory_file_path}")
+    body = s3_client.get_object(Bucket=INVENTORY_REPORT_BUCKET, Key=inventory_file_path)['Body']
+    written = 0
+    batch = []
+    with io.TextIOWrapper(gzip.GzipFile(fileobj=body), encoding='utf-8', newline='') as f:
+        for row in csv.reader(f):
             if len(row) > max(bucket_idx, key_idx, storage_class_idx):  # Ensure row has enough columns
                 bucket = row[bucket_idx]
                 key = row[key_idx]
                 storage_class = row[storage_class_idx]
                 version_id = row[version_id_idx] if version_id_idx != -1 else None
+                size = row[size_idx] if size_idx != -1 else None
+                last_modified = row[last_modified_idx] if last_modified_idx != -1 else None
+
+                # Keys stay URL-encoded, as S3 Batch Operations CSV manifests expect
+                if predicates.matches(bucket, key, storage_class, size, last_modified):
+                    batch.append(f"{bucket},{key},{version_id}" if version_id else f"{bucket},{key}")
+                    if len(batch) >= batch_size:
+                        writer.write_lines(batch)
+                        written += len(batch)
+                        batch = []
+    if batch:
+        writer.write_lines(batch)
+        written += len(batch)
+    return written
+
+
+def _arrow_batches(inventory_file_path, manifest_json, columns, wanted, block_size):
+    """Yield record batches with CSV column names from one CSV or Parquet inventory data file"""
+    if manifest_json.get('fileFormat', 'CSV') == 'Parquet':
+        parquet_file = pq.ParquetFile(S3ObjectFile(INVENTORY_REPORT_BUCKET, inventory_file_path))
+        for batch in parquet_file.iter_batches(batch_size=block_size // 64, use_threads=False,
+                                               columns=[PARQUET_COLUMNS[name] for name in wanted]):
+            yield pa.RecordBatch.from_arrays(batch.columns, names=wanted)
+        return
+
+    schema = sorted(columns, key=columns.get)
+    types = {'Size': pa.int64(), 'LastModifiedDate': pa.timestamp('ms', tz='UTC')}
+    body = s3_client.get_object(Bucket=INVENTORY_REPORT_BUCKET, Key=inventory_file_path)['Body']
+    stream = pa.CompressedInputStream(pa.PythonFile(body, mode='r'), 'gzip')
+    reader = pacsv.open_csv(
+        stream,
+        # Files are already read in parallel, one per thread, so don't fan out again inside each
+        read_options=pacsv.ReadOptions(column_names=schema, block_size=block_size, use_threads=False),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=wanted,
+            column_types={name: types.get(name, pa.string()) for name in wanted},
+            strings_can_be_null=False))
+    for batch in reader:
+        yield batch
+
+
+def _manifest_text(batch, parquet, prefix=None):
+    """
+    Manifest lines (Bucket,Key[,VersionId]) for every row of an Arrow batch, as UTF-8
+    bytes. prefix, if given, is an Arrow array prepended to each line as its own field.
+    """
+    keys = batch['Key']
+    if parquet:
+        # Parquet keys are stored decoded; S3 Batch Operations manifests need them URL-encoded
+        keys = pa.array([urllib.parse.quote(key, safe='/') for key in keys.to_pylist()], type=pa.string())
+    fields = [batch['Bucket'], keys]
+    if 'VersionId' in batch.schema.names:
+        # Null or empty VersionIds (unversioned objects) are left off the line
+        version_ids = batch['VersionId']
+        fields.append(pc.if_else(pc.equal(version_ids, ''), pa.scalar(None, pa.string()), version_ids))
+    if prefix is not None:
+        fields.insert(0, prefix)
+    lines = pc.binary_join_element_wise(*fields, ',', null_handling='skip')
+    # Terminate each line and hand over the array's data buffer, which is then exactly
+    # the manifest text, without building Python strings
+    lines = pc.binary_join_element_wise(lines, '', '\n')
+    return lines.buffers()[2].slice(0, pc.sum(pc.binary_length(lines)).as_py() or 0).to_pybytes()
+
+
+def filter_inventory_file_arrow(inventory_file_path, manifest_json, columns, predicates, writer,
+                                block_size=16 * 1024 * 1024):
+    """
+    Vectorized version of filter_inventory_file: the data file (CSV or Parquet) is read
+    in blocks into Arrow record batches, every predicate is evaluated over a whole batch
+    at once, and the manifest lines are joined in Arrow too. Returns the number of rows
+    written.
+    """
+    parquet = manifest_json.get('fileFormat', 'CSV') == 'Parquet'
+    wanted = predicates.required_columns + (['VersionId'] if 'VersionId' in columns else [])
+
+    print(f"Processing inventory file: s3://{INVENTORY_REPORT_BUCKET}/{inventory_file_path}")
+    written = 0
+    for batch in _arrow_batches(inventory_file_path, manifest_json, columns, wanted, block_size):
+        selected = batch.filter(predicates.mask(batch, keys_encoded=not parquet))
+        if not selected.num_rows:
+            continue
+        writer.write_encoded(_manifest_text(selected, parquet), selected.num_rows)
+        written += selected.num_rows
+    return written
+
+
+def filter_inventory_report(manifest_content, exclude_storage_class=EXCLUDE_STORAGE_CLASS,
+                            max_workers=FILTER_WORKERS, predicates=None, backend=None, manifest_key=None):
+    """
+    Filters every data file listed in the inventory manifest and writes the objects to
+    move straight into a new S3 Batch Operations manifest.
+
+    Data files are streamed and filtered in parallel; filtered rows go to S3 as they
+    are produced, so memory stays flat however large the inventory is. predicates (an
+    InventoryFilter) defaults to excluding exclude_storage_class. backend is 'arrow'
+    (vectorized, CSV or Parquet; the default when pyarrow is installed) or 'python'
+    (the csv.reader loop, CSV only). manifest_key defaults to a new timestamped key.
+
+    Returns:
+        ManifestWriter: The closed writer (manifest ARN, ETag and object count), or None
+            if the inventory's schema lacks a required column
+    """
+    manifest_json = json.loads(manifest_content)
+    columns = inventory_columns(manifest_json)
+    predicates = predicates or InventoryFilter(exclude_storage_classes=(exclude_storage_class,))
+    backend = backend or ('arrow' if pa else 'python')
+    if backend == 'arrow' and pa is None:
+        raise ImportError("The arrow backend requires pyarrow")
+    if backend == 'python' and manifest_json.get('fileFormat', 'CSV') != 'CSV':
+        raise ValueError(f"The python backend only reads CSV inventories, not {manifest_json.get('fileFormat')}")
+
+    missing = [name for name in predicates.required_columns if name not in columns]
+    if missing:
+        print(f"Error: Required column not found in inventory report schema: {missing}. Please check your inventory configuration.")
+        return None
+
+    if backend == 'arrow':
+        filter_file = lambda path: filter_inventory_file_arrow(path, manifest_json, columns, predicates, writer)
+    else:
+        filter_file = lambda path: filter_inventory_file(path, columns, predicates, writer)
+
+    files = [entry['key'] for entry in manifest_json['files']]
+    writer = ManifestWriter(MANIFEST_BUCKET, manifest_key or new_manifest_key(), versioned='VersionId' in columns)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _ in executor.map(filter_file, files):
+                pass
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    return writer
+
+
+class ShardedManifestWriter:
+    """
+    Routes manifest lines into shards by object size band, rolling over to a new shard
+    (a new ManifestWriter) once one holds max_objects. Each shard becomes its own
+    S3 Batch Operations job.
+    """
+
+    def __init__(self, key_suffix, versioned=False, max_objects=DIRECT_SHARD_OBJECTS,
+                 bands=DIRECT_SIZE_BANDS, band_names=DIRECT_BAND_NAMES):
+        self.key_suffix = key_suffix
+        self.versioned = versioned
+        self.max_objects = max_objects
+        self.bands = bands
+        self.band_names = band_names
+        self.shards = []  # {'band', 'writer', 'bytes'}
+        self._current = {}  # band name -> shard being filled
+        self._lock = threading.Lock()
+
+    @property
+    def count(self):
+        return sum(shard['writer'].count for shard in self.shards)
+
+    def _shard(self, band):
+        shard = self._current.get(band)
+        if shard is None or shard['writer'].count >= self.max_objects:
+            key = new_manifest_key(f"{self.key_suffix}-{band}-{len(self.shards):04d}")
+            shard = {'band': band, 'writer': ManifestWriter(MANIFEST_BUCKET, key, self.versioned), 'bytes': 0}
+            self.shards.append(shard)
+            self._current[band] = shard
+        return shard
+
+    def write_batch(self, batch, sizes, parquet):
+        """Write an Arrow batch's rows (with their sizes as a numpy array) to the right shards"""
+        band_index = np.searchsorted(self.bands, sizes, side='right')
+        with self._lock:
+            for i, band in enumerate(self.band_names):
+                rows = np.flatnonzero(band_index == i)
+                while len(rows):
+                    shard = self._shard(band)
+                    take = rows[:self.max_objects - shard['writer'].count]
+                    rows = rows[len(take):]
+                    shard['writer'].write_encoded(_manifest_text(batch.take(pa.array(take)), parquet), len(take))
+                    shard['bytes'] += int(sizes[take].sum())
+
+    def close(self):
+        for shard in self.shards:
+            shard['writer'].close()
+
+    def abort(self):
+        for shard in self.shards:
+            shard['writer'].abort()
+
+    def summary(self):
+        return [{
+            'band': shard['band'],
+            'manifest': shard['writer'].arn,
+            'etag': shard['writer'].etag,
+            'objects': shard['writer'].count,
+            'bytes': shard['bytes'],
+            # The last band holds everything over bands[-1]
+            'submittable': shard['band'] != self.band_names[-1] or self.bands[-1] < COPY_SIZE_LIMIT
+        } for shard in self.shards]
+
+
+class TransitionPlanner:
+    """
+    Splits the objects to archive by size and estimates what moving them will cost.
+
+    Objects of at least bundle_max_object_size go into direct-transition manifests (a
+    ShardedManifestWriter, one S3 Batch job per shard). Smaller ones, where the
+    per-object transition fee and Glacier's 40 KiB per-object overhead outweigh the
+    storage saved, go into a bundle manifest (Bundle,Bucket,Key lines, each bundle's
+    lines contiguous) for pack_bundles. Counts, bytes and estimated costs are tallied
+    per size class as the inventory streams past.
+
+    Bundle keys are scoped by run_id, so a later run that plans the same (still
+    STANDARD) small objects writes new bundles instead of overwriting archived ones.
+    """
+
+    def __init__(self, manifest_json, columns, predicates, direct_writer, bundle_writer,
+                 target_storage_class=TARGET_STORAGE_CLASS, bundle_max_object_size=BUNDLE_MAX_OBJECT_SIZE,
+                 bundle_target_size=BUNDLE_TARGET_SIZE, run_id=None):
+        self.run_id = run_id or int(time.time())
+        self.manifest_json = manifest_json
+        self.columns = columns
+        self.predicates = predicates
+        self.direct_writer = direct_writer
+        self.bundle_writer = bundle_writer
+        self.target_storage_class = target_storage_class
+        self.bundle_max_object_size = bundle_max_object_size
+        self.bundle_target_size = bundle_target_size
+        self.bundles = 0
+        self.bundled_bytes = 0
+        # Per size class: objects, bytes, and bytes-times-current-price for the monthly cost now
+        n_classes = len(SIZE_CLASSES) + 1
+        self.class_objects = np.zeros(n_classes, dtype=np.int64)
+        self.class_bytes = np.zeros(n_classes, dtype=np.int64)
+        self.class_current_cost = np.zeros(n_classes, dtype=np.float64)
+        self._lock = threading.Lock()
+
+    def _next_bundle_key(self):
+        with self._lock:
+            self.bundles += 1
+            return f"{BUNDLE_PREFIX}{self.run_id}/bundle-{self.bundles:06d}.tar"
+
+    def _tally(self, sizes, storage_classes):
+        size_class = np.searchsorted(SIZE_CLASSES, sizes, side='right')
+        names = list(STORAGE_PRICE_PER_GB_MONTH)
+        # Unknown or empty classes are priced as STANDARD
+        class_index = pc.fill_null(pc.index_in(storage_classes, value_set=pa.array(names)), 0)
+        prices = np.array(list(STORAGE_PRICE_PER_GB_MONTH.values()))[class_index.to_numpy(zero_copy_only=False)]
+        n_classes = len(SIZE_CLASSES) + 1
+        with self._lock:
+            self.class_objects += np.bincount(size_class, minlength=n_classes)
+            self.class_bytes += np.bincount(size_class, weights=sizes, minlength=n_classes).astype(np.int64)
+            self.class_current_cost += np.bincount(size_class, weights=sizes * prices / 1024 ** 3, minlength=n_classes)
+
+    def plan_file(self, inventory_file_path, block_size=16 * 1024 * 1024):
+        """Route one inventory data file's objects into the direct and bundle manifests"""
+        parquet = self.manifest_json.get('fileFormat', 'CSV') == 'Parquet'
+        wanted = list(dict.fromkeys(self.predicates.required_columns + ['Size']))
+        wanted += ['VersionId'] if 'VersionId' in self.columns else []
+
+        print(f"Planning inventory file: s3://{INVENTORY_REPORT_BUCKET}/{inventory_file_path}")
+        bundle_key = None
+        bundle_size = 0
+        bundle_text = []
+        for batch in _arrow_batches(inventory_file_path, self.manifest_json, self.columns, wanted, block_size):
+            selected = batch.filter(self.predicates.mask(batch, keys_encoded=not parquet))
+            if not selected.num_rows:
+                continue
+            sizes = pc.fill_null(selected['Size'], 0).to_numpy(zero_copy_only=False)
+            self._tally(sizes, selected['StorageClass'])
+
+            small = sizes < self.bundle_max_object_size
+            if (~small).any():
+                self.direct_writer.write_batch(selected.filter(pa.array(~small)), sizes[~small], parquet)
+
+            # Fill bundles in inventory order, writing each one's lines once it is full
+            small_rows = selected.filter(pa.array(small))
+            small_sizes = sizes[small]
+            start = 0
+            while start < small_rows.num_rows:
+                if bundle_key is None:
+                    bundle_key = self._next_bundle_key()
+                # Take as many of the remaining small objects as still fit in this bundle
+                room = self.bundle_target_size - bundle_size
+                fits = int(np.searchsorted(np.cumsum(small_sizes[start:]), room, side='right'))
+                if not fits and bundle_size:
+                    self._finish_bundle(bundle_text, bundle_size)
+                    bundle_key, bundle_size, bundle_text = None, 0, []
+                    continue
+                end = start + max(fits, 1)
+                chunk = small_rows.slice(start, end - start)
+                bundle_text.append(_manifest_text(chunk, parquet, prefix=pa.array([bundle_key] * chunk.num_rows)))
+                bundle_size += int(small_sizes[start:end].sum())
+                start = end
+        if bundle_text:
+            self._finish_bundle(bundle_text, bundle_size)
+
+    def _finish_bundle(self, bundle_text, bundle_size):
+        data = b''.join(bundle_text)
+        self.bundle_writer.write_encoded(data, data.count(b'\n'))
+        with self._lock:
+            self.bundled_bytes += bundle_size
+
+    def summary(self):
+        """Per-size-class counts and cost estimates, and totals for the direct and bundled paths"""
+        archive_price = STORAGE_PRICE_PER_GB_MONTH[self.target_storage_class]
+        standard_price = STORAGE_PRICE_PER_GB_MONTH['STANDARD']
+        transition_price = TRANSITION_PRICE_PER_1000[self.target_storage_class] / 1000
+        # Per-object overhead only applies to the classes that keep an archive index
+        overhead = 0.0
+        if self.target_storage_class in ('GLACIER', 'DEEP_ARCHIVE'):
+            overhead = (ARCHIVE_INDEX_BYTES * archive_price + ARCHIVE_METADATA_BYTES * standard_price) / 1024 ** 3
+
+        def estimate(objects, size, current_monthly):
+            one_time = objects * (transition_price + BATCH_OPERATIONS_PRICE_PER_MILLION / 1e6)
+            archived_monthly = size * archive_price / 1024 ** 3 + objects * overhead
+            savings = current_monthly - archived_monthly
+            return {
+                'transition_cost': round(one_time, 4),
+                'current_monthly_cost': round(current_monthly, 4),
+                'archived_monthly_cost': round(archived_monthly, 4),
+                'monthly_savings': round(savings, 4),
+                'break_even_months': round(one_time / savings, 1) if savings > 0 else None
+            }
+
+        classes = []
+        bounds = [0] + SIZE_CLASSES + [None]
+        for i in range(len(SIZE_CLASSES) + 1):
+            objects, size = int(self.class_objects[i]), int(self.class_bytes[i])
+            if not objects:
+                continue
+            classes.append({
+                'min_size': bounds[i],
+                'max_size': bounds[i + 1],
+                'objects': objects,
+                'bytes': size,
+                'direct_transition': estimate(objects, size, float(self.class_current_cost[i]))
+            })
+
+        # Bundles: one PUT per bundle straight into the archive class, plus a GET per object packed
+        bundled_objects = self.bundle_writer.count
+        bundled_current = sum(float(self.class_current_cost[i]) for i in range(len(SIZE_CLASSES) + 1)
+                              if (bounds[i + 1] or float('inf')) <= self.bundle_max_object_size)
+        bundle_one_time = self.bundles * transition_price + bundled_objects * GET_PRICE_PER_1000 / 1000
+        bundle_monthly = self.bundled_bytes * archive_price / 1024 ** 3 + self.bundles * overhead
+        return {
+            'target_storage_class': self.target_storage_class,
+            'size_classes': classes,
+            'direct': {
+                'objects': self.direct_writer.count,
+                'shards': self.direct_writer.summary()
+            },
+            'bundled': {
+                'manifest': self.bundle_writer.arn,
+                'objects': bundled_objects,
+                'bytes': self.bundled_bytes,
+                'bundles': self.bundles,
+                'one_time_cost': round(bundle_one_time, 4),
+                'archived_monthly_cost': round(bundle_monthly, 4),
+                'current_monthly_cost': round(bundled_current, 4)
+            }
+        }
+
+
+def plan_transitions(manifest_content, predicates=None, max_workers=FILTER_WORKERS,
+                     target_storage_class=TARGET_STORAGE_CLASS, bundle_max_object_size=BUNDLE_MAX_OBJECT_SIZE,
+                     bundle_target_size=BUNDLE_TARGET_SIZE):
+    """
+    Planner stage of the Glacier workflow: reads the inventory once and writes sharded
+    direct-transition manifests (for create_s3_batch_job), a bundle manifest (for
+    pack_bundles) and a JSON cost report next to them.
+
+    Returns:
+        dict: The cost report (see TransitionPlanner.summary), with the ManifestWriters
+            under 'writers'
+    """
+    if pa is None:
+        raise ImportError("The transition planner requires pyarrow")
+    manifest_json = json.loads(manifest_content)
+    columns = inventory_columns(manifest_json)
+    predicates = predicates or InventoryFilter()
+    missing = [name for name in predicates.required_columns + ['Size'] if name not in columns]
+    if missing:
+        raise ValueError(f"Inventory report schema is missing required columns: {missing}")
+
+    stamp = int(time.time())
+    direct_writer = ShardedManifestWriter('-direct', versioned='VersionId' in columns)
+    bundle_writer = ManifestWriter(MANIFEST_BUCKET, new_manifest_key('-bundles'), versioned='VersionId' in columns)
+    planner = TransitionPlanner(manifest_json, columns, predicates, direct_writer, bundle_writer,
+                                target_storage_class, bundle_max_object_size, bundle_target_size, run_id=stamp)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _ in executor.map(planner.plan_file, [entry['key'] for entry in manifest_json['files']]):
+                pass
+        direct_writer.close()
+        bundle_writer.close()
+    except Exception:
+        direct_writer.abort()
+        bundle_writer.abort()
+        raise
+
+    report = planner.summary()
+    report_key = f"batch-ops-manifests/{SOURCE_BUCKET_NAME}-transition-plan-{stamp}.json"
+    s3_client.put_object(Bucket=MANIFEST_BUCKET, Key=report_key, Body=json.dumps(report, indent=2),
+                         ContentType='application/json')
+    print(f"Transition plan written: s3://{MANIFEST_BUCKET}/{report_key}")
+    report['writers'] = {'direct': direct_writer, 'bundled': bundle_writer}
+    return report
+
 
-                if bucket == SOURCE_BUCKET_NAME and storage_class != exclude_storage_class:
-                    if version_id:
-                        filtered_objects.append(f"{bucket},{key},{version_id}")
-                    else:
-                        filtered_objects.append(f"{bucket},{key}")
+def pack_bundle(bundle_key, entries, storage_class=TARGET_STORAGE_CLASS):
+    """
+    Stream the objects listed for one bundle into a tar written straight to
+    storage_class. entries are (bucket, url-encoded key, version id or None).
+    """
+    writer = MultipartWriter(BUNDLE_BUCKET, bundle_key, content_type='application/x-tar',
+                             storage_class=storage_class)
+    try:
+        with tarfile.open(fileobj=writer, mode='w|') as tar:
+            for bucket, key, version_id in entries:
+                key = urllib.parse.unquote_plus(key)
+                extra = {'VersionId': version_id} if version_id else {}
+                response = s3_client.get_object(Bucket=bucket, Key=key, **extra)
+                info = tarfile.TarInfo(name=key)
+                info.size = response['ContentLength']
+                info.mtime = response['LastModified'].timestamp()
+                tar.addfile(info, response['Body'])
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    print(f"Packed {len(entries)} objects into s3://{BUNDLE_BUCKET}/{bundle_key}")
+    return len(entries)
+
+
+def pack_bundles(bundle_manifest_key, max_workers=FILTER_WORKERS, storage_class=TARGET_STORAGE_CLASS):
+    """
+    Build every bundle listed in a planner bundle manifest, max_workers at a time.
+    The originals are left in place; delete them once the bundles are verified.
+
+    Returns:
+        int: Number of objects packed
+    """
+    body = s3_client.get_object(Bucket=MANIFEST_BUCKET, Key=bundle_manifest_key)['Body']
+    packed = 0
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        bundle_key, entries = None, []
+        for line in io.TextIOWrapper(body, encoding='utf-8'):
+            fields = line.rstrip('\n').split(',')
+            if fields[0] != bundle_key and entries:
+                futures.append(executor.submit(pack_bundle, bundle_key, entries, storage_class))
+                entries = []
+            bundle_key = fields[0]
+            entries.append((fields[1], fields[2], fields[3] if len(fields) > 3 else None))
+        if entries:
+            futures.append(executor.submit(pack_bundle, bundle_key, entries, storage_class))
+        for future in futures:
+            packed += future.result()
+    return packed
 
-    return filtered_objects
 
 def create_manifest_file(filtered_objects):
     """
     Creates a CSV manifest file for S3 Batch Operations.
     """
-    manifest_content = "\n".join(filtered_objects)
-    manifest_key = f"batch-ops-manifests/{SOURCE_BUCKET_NAME}-move-to-glacier-{int(time.time())}.csv"
+    writer = ManifestWriter(MANIFEST_BUCKET, new_manifest_key())
+    writer.write_lines(list(filtered_objects))
+    return writer.close()
 
-    s3_client.put_object(
-        Bucket=MANIFEST_BUCKET,
-        Key=manifest_key,
-        Body=manifest_content,
-        ContentType='text/csv'
-    )
-    print(f"Manifest file created: s3://{MANIFEST_BUCKET}/{manifest_key}")
-    return f"arn:aws:s3:::{MANIFEST_BUCKET}/{manifest_key}"
 
-def create_s3_batch_job(manifest_arn, job_description):
+def create_s3_batch_job(manifest_arn, job_description, manifest_etag=None, versioned=False, priority=10):
     """
     Creates an S3 Batch Operations job to change storage class.
+
+    manifest_etag and versioned come from the ManifestWriter that wrote the manifest;
+    if the ETag isn't given, it is looked up from the manifest object itself.
     """
+    if manifest_etag is None:
+        # arn:aws:s3:::bucket/key/with/slashes
+        bucket, key = manifest_arn.split(':::', 1)[1].split('/', 1)
+        manifest_etag = s3_client.head_object(Bucket=bucket, Key=key)['ETag'].strip('"')
+
     response = s3control_client.create_job(
-        AccountId=account_id,
+        AccountId=get_account_id(),
         Operation={
             'S3PutObjectCopy': {
                 'TargetResource': f"arn:aws:s3:::{SOURCE_BUCKET_NAME}",
@@ -124,20 +916,21 @@ def create_s3_batch_job(manifest_arn, job_description):
             'Bucket': f"arn:aws:s3:::{BATCH_OPERATIONS_REPORT_BUCKET}",
             'Format': 'Report_CSV_20180820',
             'Enabled': True,
-            'Prefix': f"batch-ops-reports/{job_description}/",
-            'ReportScope': 'AllTasks'
+            'Prefix': f"batch-ops-reports/{job_description}",
+            # Totals come from describe_job; the report only needs the rows to follow up on
+            'ReportScope': 'FailedTasksOnly'
         },
         Manifest={
             'Spec': {
                 'Format': 'S3BatchOperations_CSV_20180820',
-                'Fields': ['Bucket', 'Key', 'VersionId'] if 'VersionId' in get_latest_inventory_manifest(INVENTORY_REPORT_BUCKET, INVENTORY_REPORT_PREFIX) else ['Bucket', 'Key']
+                'Fields': ['Bucket', 'Key', 'VersionId'] if versioned else ['Bucket', 'Key']
             },
             'Location': {
                 'ObjectArn': manifest_arn,
-                'Etag': s3_client.head_object(Bucket=MANIFEST_BUCKET, Key=manifest_arn.split('/')[-1])['ETag'].strip('"')  # Get ETag of the manifest object
+                'ETag': manifest_etag
             }
         },
-        Priority=10,
+        Priority=priority,
         RoleArn=IAM_ROLE_ARN_FOR_BATCH_OPERATIONS,
         Description=job_description,
         ConfirmationRequired=False
@@ -145,49 +938,190 @@ def create_s3_batch_job(manifest_arn, job_description):
     return response['JobId']
 
 
-if __name__ == "__main__":
-    import json
-    import gzip
+def submit_shards(shards, versioned, max_workers=MAX_CONCURRENT_JOBS):
+    """
+    Create one S3 Batch job per submittable shard, max_workers at a time.
+
+    Returns:
+        Dict[str, dict]: Job ID -> the shard it moves, with its job description added
+    """
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+
+    def submit(indexed_shard):
+        i, shard = indexed_shard
+        description = f"Move-to-{TARGET_STORAGE_CLASS}-{stamp}-{shard['band']}-{i:04d}"
+        job_id = create_s3_batch_job(shard['manifest'], description, shard['etag'], versioned)
+        print(f"S3 Batch Operations job {job_id} created for {shard['objects']} objects ({description})")
+        return job_id, dict(shard, description=description)
+
+    submittable = [shard for shard in shards if shard['submittable'] and shard['objects']]
+    for shard in shards:
+        if not shard['submittable']:
+            print(f"Not submitting {shard['manifest']}: objects over 5 GiB can't be copied by S3 Batch "
+                  f"Operations; transition them with a lifecycle rule instead")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(executor.map(submit, enumerate(submittable)))
+
+
+def wait_for_jobs(job_ids, initial_delay=POLL_INITIAL_SECONDS, max_delay=POLL_MAX_SECONDS):
+    """
+    Poll S3 Batch jobs until all have finished, describing the ones still running
+    concurrently each round. The delay between rounds doubles (with jitter) up to
+    max_delay, and drops back whenever a job finishes.
 
-    print("Starting S3 Batch Operation to move objects to Glacier Flexible Retrieval...")
+    Returns:
+        Dict[str, dict]: Job ID -> final describe_job 'Job' description
+    """
+    pending = set(job_ids)
+    finished = {}
+    delay = initial_delay
+    with ThreadPoolExecutor(max_workers=max(1, min(len(pending), MAX_CONCURRENT_JOBS))) as executor:
+        while pending:
+            jobs = executor.map(
+                lambda job_id: s3control_client.describe_job(AccountId=get_account_id(), JobId=job_id)['Job'],
+                sorted(pending))
+            done_this_round = False
+            for job in jobs:
+                progress = job.get('ProgressSummary', {})
+                print(f"Job {job['JobId']}: {job['Status']} "
+                      f"({progress.get('NumberOfTasksSucceeded', 0)} succeeded, "
+                      f"{progress.get('NumberOfTasksFailed', 0)} failed of {progress.get('TotalNumberOfTasks', '?')})")
+                if job['Status'] in ('Complete', 'Failed', 'Cancelled'):
+                    finished[job['JobId']] = job
+                    pending.discard(job['JobId'])
+                    done_this_round = True
+            if pending:
+                delay = initial_delay if done_this_round else min(max_delay, delay * 2)
+                time.sleep(delay * random.uniform(0.8, 1.2))
+    return finished
+
+
+def read_failures(job, limit=20):
+    """Failed tasks from a job's completion report, grouped by error code (with up to limit example keys each)"""
+    report = job.get('Report', {})
+    if not report.get('Enabled'):
+        return {}
+    bucket = report['Bucket'].split(':::', 1)[1]
+    manifest_key = f"{report['Prefix']}/job-{job['JobId']}/manifest.json"
+    try:
+        report_manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=manifest_key)['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        return {}
+
+    failures = {}
+    for result in report_manifest.get('Results', []):
+        if result.get('TaskExecutionStatus') != 'failed':
+            continue
+        body = s3_client.get_object(Bucket=bucket, Key=result['Key'])['Body']
+        # Bucket, Key, VersionId, TaskStatus, ErrorCode, HTTPStatusCode, ResultMessage
+        for row in csv.reader(io.TextIOWrapper(body, encoding='utf-8', newline='')):
+            if len(row) < 5:
+                continue
+            entry = failures.setdefault(row[4] or 'Unknown', {'count': 0, 'examples': []})
+            entry['count'] += 1
+            if len(entry['examples']) < limit:
+                entry['examples'].append(urllib.parse.unquote_plus(row[1]))
+    return failures
+
+
+def summarize_jobs(jobs, shards):
+    """Combine the finished jobs into one summary of throughput and failures"""
+    per_job = []
+    failures = {}
+    for job_id, job in jobs.items():
+        shard = shards[job_id]
+        progress = job.get('ProgressSummary', {})
+        elapsed = progress.get('Timers', {}).get('ElapsedTimeInActiveSeconds') or 0
+        succeeded = progress.get('NumberOfTasksSucceeded', 0)
+        per_job.append({
+            'job_id': job_id,
+            'description': shard['description'],
+            'band': shard['band'],
+            'status': job['Status'],
+            'objects': shard['objects'],
+            'bytes': shard['bytes'],
+            'succeeded': succeeded,
+            'failed': progress.get('NumberOfTasksFailed', 0),
+            'active_seconds': elapsed,
+            'objects_per_second': round(succeeded / elapsed, 1) if elapsed else None,
+            'mb_per_second': round(shard['bytes'] / 1024 ** 2 / elapsed, 1) if elapsed else None
+        })
+        for code, entry in read_failures(job).items():
+            combined = failures.setdefault(code, {'count': 0, 'examples': []})
+            combined['count'] += entry['count']
+            combined['examples'] = (combined['examples'] + entry['examples'])[:20]
+
+    # Jobs run side by side, so overall throughput is over the longest-running one
+    wall_seconds = max((job['active_seconds'] for job in per_job), default=0)
+    succeeded = sum(job['succeeded'] for job in per_job)
+    total_bytes = sum(job['bytes'] for job in per_job if job['status'] == 'Complete')
+    return {
+        'jobs': per_job,
+        'objects': sum(job['objects'] for job in per_job),
+        'succeeded': succeeded,
+        'failed': sum(job['failed'] for job in per_job),
+        'wall_seconds': wall_seconds,
+        'objects_per_second': round(succeeded / wall_seconds, 1) if wall_seconds else None,
+        'mb_per_second': round(total_bytes / 1024 ** 2 / wall_seconds, 1) if wall_seconds else None,
+        'failures_by_error_code': failures
+    }
+
+
+def run_glacier_move(max_concurrent_jobs=MAX_CONCURRENT_JOBS, wait=True, dry_run=False):
+    """
+    End-to-end Glacier move: plan from the latest inventory (manifests are built once),
+    pack the small objects into bundles while one S3 Batch job per direct-transition
+    shard is submitted, then wait for every job and write a combined summary.
 
-    # 1. Get the latest S3 Inventory manifest
+    Returns:
+        dict: The combined job summary, or the plan if dry_run or not waiting
+    """
     manifest_content = get_latest_inventory_manifest(INVENTORY_REPORT_BUCKET, INVENTORY_REPORT_PREFIX)
     if not manifest_content:
-        print("Could not retrieve latest inventory manifest. Exiting.")
-        exit()
-
-    # 2. Filter the inventory report
-    print(f"Filtering inventory report to exclude objects already in {EXCLUDE_STORAGE_CLASS}...")
-    objects_to_process = filter_inventory_report(manifest_content, EXCLUDE_STORAGE_CLASS)
-
-    if not objects_to_process:
-        print("No objects found to move to Glacier Flexible Retrieval. Exiting.")
-        exit()
-
-    print(f"Found {len(objects_to_process)} objects to move.")
-
-    # 3. Create the manifest file for S3 Batch Operations
-    manifest_arn = create_manifest_file(objects_to_process)
-
-    # # 4. Create the S3 Batch Operations job
-    # job_description = f"Move-to-{TARGET_STORAGE_CLASS}-{time.strftime('%Y%m%d-%H%M%S')}"
-    # job_id = create_s3_batch_job(manifest_arn, job_description)
-
-    # print(f"S3 Batch Operations job created with ID: {job_id}")
-    # print(f"Monitor the job status in the AWS S3 console: https://console.aws.amazon.com/s3/home?region={REGION}#jobs/{job_id}")
-
-    # # Optional: Wait for job completion and check status
-    # print("Waiting for job to complete (this may take a while)...")
-    # while True:
-    #     job_status = s3control_client.describe_job(AccountId=account_id, JobId=job_id)['Job']['Status']
-    #     print(f"Job status: {job_status}")
-    #     if job_status in ['Complete', 'Failed', 'Cancelled']:
-    #         break
-    #     time.sleep(30)  # Check every 30 seconds
-
-    # print(f"Job {job_id} finished with status: {job_status}")
-    # if job_status == 'Complete':
-    #     print(f"Successfully moved objects to {TARGET_STORAGE_CLASS}.")
-    # else:
-    #     print(f"Batch job {job_id} did not complete successfully. Check the completion report in s3://{BATCH_OPERATIONS_REPORT_BUCKET}/batch-ops-reports/{job_description}/ for details.")
+        raise RuntimeError("Could not retrieve latest inventory manifest")
+
+    plan = plan_transitions(manifest_content)
+    writers = plan.pop('writers')
+    print(f"Direct transition: {plan['direct']['objects']} objects in {len(plan['direct']['shards'])} shards. "
+          f"Bundled: {plan['bundled']['objects']} objects in {plan['bundled']['bundles']} bundles.")
+    for size_class in plan['size_classes']:
+        estimate = size_class['direct_transition']
+        print(f"  {size_class['min_size']}-{size_class['max_size'] or ''} bytes: {size_class['objects']} objects, "
+              f"transition ${estimate['transition_cost']}, saves ${estimate['monthly_savings']}/month, "
+              f"break-even {estimate['break_even_months']} months")
+    if dry_run:
+        return plan
+
+    with ThreadPoolExecutor(max_workers=1) as bundler:
+        # Bundling reads and writes through this machine; the jobs run inside S3 meanwhile
+        bundling = bundler.submit(pack_bundles, writers['bundled'].key) if plan['bundled']['objects'] else None
+        shards = submit_shards(plan['direct']['shards'], writers['direct'].versioned, max_concurrent_jobs)
+        if bundling:
+            print(f"Packed {bundling.result()} objects into bundles")
+
+    if not wait:
+        return plan
+
+    summary = summarize_jobs(wait_for_jobs(shards), shards)
+    summary['plan'] = plan
+    summary_key = f"batch-ops-reports/{SOURCE_BUCKET_NAME}-glacier-move-summary-{int(time.time())}.json"
+    s3_client.put_object(Bucket=BATCH_OPERATIONS_REPORT_BUCKET, Key=summary_key,
+                         Body=json.dumps(summary, indent=2, default=str), ContentType='application/json')
+    print(f"{summary['succeeded']} of {summary['objects']} objects moved to {TARGET_STORAGE_CLASS} "
+          f"({summary['failed']} failed) at {summary['objects_per_second']} objects/s, {summary['mb_per_second']} MB/s")
+    for code, entry in summary['failures_by_error_code'].items():
+        print(f"  {code}: {entry['count']} (e.g. {', '.join(entry['examples'][:3])})")
+    print(f"Summary written: s3://{BATCH_OPERATIONS_REPORT_BUCKET}/{summary_key}")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=f'Move {SOURCE_BUCKET_NAME} objects to {TARGET_STORAGE_CLASS} with S3 Batch Operations')
+    parser.add_argument('--max-concurrent-jobs', type=int, default=MAX_CONCURRENT_JOBS,
+                        help='S3 Batch jobs submitted at the same time')
+    parser.add_argument('--no-wait', action='store_true', help='Submit the jobs and exit without waiting for them')
+    parser.add_argument('--dry-run', action='store_true', help='Only plan: write the manifests and cost report')
+    args = parser.parse_args()
+
+    print(f"Starting S3 Batch Operation to move objects to {TARGET_STORAGE_CLASS}...")
+    run_glacier_move(args.max_concurrent_jobs, wait=not args.no_wait, dry_run=args.dry_run)
@@ -0,0 +1,99 @@
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from boto3.dynamodb.types import TypeSerializer
+
+from ddbItems import dataframe_to_dynamo
+
+'''
+Compares the original python_to_dynamo (to_dict("records"), then one TypeSerializer
+call on the whole list as an L attribute, then unwrapping it) against the streaming
+dataframe_to_dynamo serializer, on a synthetic tracking-table dataframe.
+
+Each serializer's items are consumed one at a time, as the bulk writer does. The
+time to produce all of them and the peak Python memory while doing so (tracemalloc)
+are reported, and the two outputs are compared item by item.
+
+Example:
+python benchmark_ddb_serializer.py --rows 200000 --output serializer_benchmark.json
+'''
+
+
+def tracking_dataframe(rows, batch_size=10):
+    """A dataframe shaped like the one pullABCD_IDs.addProcColumns builds"""
+    timepoints = np.array(['baselineYear1Arm1', '2YearFollowUpYArm1', '4YearFollowUpYArm1'])
+    df = pd.DataFrame({
+        'BatchIndex': np.arange(rows) // batch_size,
+        'subject_timepoint': [f'NDAR_INV{i // 3:08X}_{timepoints[i % 3]}' for i in range(rows)],
+    })
+    df.insert(2, 'InProcessing', 0)
+    df.insert(3, 'Segmented', 0)
+    df.insert(4, 'Parcellated', 0)
+    return df
+
+
+def legacy_python_to_dynamo(df):
+    ts = TypeSerializer()
+    dict_list = df.to_dict("records")
+    return [i["M"] for i in ts.serialize(dict_list)["L"]]
+
+
+def measure(name, serialize, df):
+    """Produce and consume every item; return the timing/memory measurements and the items' digest"""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = 0
+    digest = []
+    for i, item in enumerate(serialize(df)):
+        count += 1
+        # Keep a sample of items to check the serializers agree
+        if i % 997 == 0:
+            digest.append(item)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'serializer': name,
+        'items': count,
+        'seconds': round(seconds, 3),
+        'items_per_second': round(count / seconds),
+        'peak_python_mb': round(peak / 1024 ** 2, 1)
+    }, digest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark DataFrame to DynamoDB JSON serializers')
+    parser.add_argument('--rows', type=int, default=200000, help='Number of dataframe rows')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='Rows per chunk for the streaming serializer')
+    parser.add_argument('--output', help='Optional JSON file for the results')
+    args = parser.parse_args()
+
+    df = tracking_dataframe(args.rows)
+    results = []
+    digests = []
+    for name, serialize in (('typeserializer', legacy_python_to_dynamo),
+                            ('streaming', lambda frame: dataframe_to_dynamo(frame, args.chunk_size))):
+        result, digest = measure(name, serialize, df)
+        results.append(result)
+        digests.append(digest)
+        print(f"{name:>15}: {result['items']} items in {result['seconds']}s "
+              f"({result['items_per_second']} items/s), peak {result['peak_python_mb']} MB")
+    same_items = digests[0] == digests[1]
+    print(f"Speedup: {results[0]['seconds'] / results[1]['seconds']:.1f}x, "
+          f"peak memory {results[0]['peak_python_mb'] / max(results[1]['peak_python_mb'], 0.1):.1f}x lower")
+    print(f"Serializers produce the same items: {same_items}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'rows': args.rows, 'chunk_size': args.chunk_size,
+                       'same_items': same_items, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,213 @@
 import boto3
+import contextlib
+import gzip
+import io
+import itertools
+import json
 import numpy as np
 import os
 import pandas as pd
 import random
 import sys
+import threading
+import time
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from boto3.dynamodb.types import TypeSerializer
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterable, Iterator, List, Optional
 
 from dataclasses import dataclass
 
 # setting path
 sys.path.append(f'{os.path.dirname(os.path.realpath(__file__))}/..')
 from batched import config, ndaConnect
+from batched.ddbItems import dataframe_to_dynamo
 
 
 # Cannibalizing code from https://github.com/DrGFreeman/dynamo-pandas/blob/main/dynamo_pandas/transactions/transactions.py
 
+# Tracking table keys, shared by createDDBTable and the S3 import path
+KEY_SCHEMA = [
+    {'AttributeName': 'BatchIndex', 'KeyType': 'HASH'},
+    {'AttributeName': 'subject_timepoint', 'KeyType': 'RANGE'}]
+ATTRIBUTE_DEFINITIONS = [
+    {'AttributeName': 'BatchIndex', 'AttributeType': 'N'},
+    {'AttributeName': 'subject_timepoint', 'AttributeType': 'S'}]
+
+# batch_write_item takes at most 25 put requests per call
+DDB_BATCH_LIMIT = 25
+RETRYABLE_ERRORS = {'ProvisionedThroughputExceededException', 'ThrottlingException',
+                    'RequestLimitExceeded', 'InternalServerError'}
+
+
+class CapacityPacer:
+    """
+    Token bucket shared by the writer threads that holds writes to a target rate in
+    write capacity units per second (with up to one second of burst).
+
+    Each call reserves its estimated units up front (sleeping if that puts the bucket
+    in debt), then settles the difference once ReturnConsumedCapacity reports what
+    the call really used. A throttle cuts the rate by backoff_factor; it recovers
+    towards the target by recovery_step of the target per second after that.
+    """
+
+    def __init__(self, rate: float, backoff_factor: float = 0.7, recovery_step: float = 0.05):
+        self.target = rate
+        self.rate = rate
+        self.backoff_factor = backoff_factor
+        self.recovery_step = recovery_step
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.rate = min(self.target, self.rate + self.target * self.recovery_step * elapsed)
+        self.tokens = min(self.rate, self.tokens + self.rate * elapsed)
+
+    def acquire(self, units: float):
+        with self._lock:
+            self._refill()
+            self.tokens -= units
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+    def settle(self, units: float):
+        """Charge (or refund, if negative) units the last reservation got wrong"""
+        with self._lock:
+            self.tokens -= units
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.target * 0.05, self.rate * self.backoff_factor)
+            self.tokens = min(self.tokens, 0)
+
+
+@dataclass
+class DDBBulkWriter:
+    """
+    Writes DynamoDB-JSON items to a table from a pool of batch_write_item workers.
+
+    Items are taken from any iterable 25 at a time, so a generator is never fully
+    materialised; at most max_workers * 2 batches are in flight. Unprocessed items and
+    throttling errors are retried by the same worker with exponential backoff and full
+    jitter, up to max_retries times per batch.
+
+    If write_capacity (WCU) is given, writes are paced to utilization of it with a
+    CapacityPacer fed by each call's ConsumedCapacity, so a provisioned table is
+    kept just under its limit instead of being throttled and backed off. Leave it
+    as None for on-demand tables.
+    """
+
+    session: boto3.Session
+    tableName: str
+    max_workers: int = 8
+    max_retries: int = 10
+    base_delay: float = 0.05
+    max_delay: float = 20.0
+    write_capacity: Optional[float] = None
+    utilization: float = 0.9
+
+    def __post_init__(self):
+        # One client shared by the workers (boto3 clients are thread-safe) with a
+        # connection per worker
+        self.client = self.session.client('dynamodb', config=Config(max_pool_connections=self.max_workers))
+        self.written = 0
+        self.retries = 0
+        self.consumed = 0.0
+        self.pacer = CapacityPacer(self.write_capacity * self.utilization) if self.write_capacity else None
+        # Running average of WCUs per item, used to reserve capacity before each call
+        self.units_per_item = 1.0
+        self._lock = threading.Lock()
+
+    def _backoff(self, attempt: int):
+        time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+    def _write_batch(self, items: List[dict]) -> int:
+        requests = [{'PutRequest': {'Item': item}} for item in items]
+        attempt = 0
+        while requests:
+            estimate = len(requests) * self.units_per_item
+            if self.pacer:
+                self.pacer.acquire(estimate)
+            try:
+                response = self.client.batch_write_item(RequestItems={self.tableName: requests},
+                                                        ReturnConsumedCapacity='TOTAL')
+            except ClientError as err:
+                if err.response['Error']['Code'] not in RETRYABLE_ERRORS:
+                    raise
+                if self.pacer:
+                    self.pacer.throttled()
+            else:
+                unprocessed = response.get('UnprocessedItems', {}).get(self.tableName, [])
+                consumed = sum(c.get('CapacityUnits', 0) for c in response.get('ConsumedCapacity', []))
+                written = len(requests) - len(unprocessed)
+                with self._lock:
+                    self.consumed += consumed
+                    if written and consumed:
+                        # A put costs at least 1 WCU (per KB, rounded up)
+                        self.units_per_item = max(1.0, 0.9 * self.units_per_item + 0.1 * consumed / written)
+                if self.pacer:
+                    self.pacer.settle(consumed - estimate)
+                    if unprocessed:
+                        self.pacer.throttled()
+                requests = unprocessed
+                if not requests:
+                    break
+            attempt += 1
+            if attempt > self.max_retries:
+                raise RuntimeError(f'{len(requests)} items still unprocessed after {self.max_retries} retries')
+            with self._lock:
+                self.retries += 1
+            self._backoff(attempt)
+        return len(items)
+
+    def write(self, items: Iterable[dict]) -> int:
+        """
+        Write every item in items to the table.
+
+        :param items: An iterable (list or generator) of DynamoDB-JSON items
+        :return: The number of items written
+        """
+        items = iter(items)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight = set()
+            for batch in iter(lambda: list(itertools.islice(items, DDB_BATCH_LIMIT)), []):
+                if len(in_flight) >= self.max_workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    self.written += sum(future.result() for future in done)
+                in_flight.add(executor.submit(self._write_batch, batch))
+            self.written += sum(future.result() for future in wait(in_flight).done)
+        elapsed = time.perf_counter() - start
+        print(f'Wrote {self.written} items to {self.tableName} in {elapsed:.1f}s '
+              f'({self.written / max(elapsed, 1e-9):.0f} items/s, {self.consumed / max(elapsed, 1e-9):.0f} WCU/s, '
+              f'{self.retries} retried batches)')
+        return self.written
+
+
 @dataclass
 class pullABCD_IDs:
 
     session: boto3.Session
     tableName: str
     append: bool = False
+    # First loads of at least import_threshold rows go through DynamoDB's S3 import
+    # (ImportTable) when an import_bucket is given, instead of batch_write_item
+    import_bucket: Optional[str] = None
+    import_prefix: str = 'trackingdb-import'
+    import_threshold: int = 1_000_000
+    max_workers: int = 8
+    # 'PROVISIONED' or 'PAY_PER_REQUEST' (on-demand). For provisioned tables the
+    # write capacity is raised to load_write_capacity for the initial load, then
+    # lowered back to write_capacity
+    billing_mode: str = 'PROVISIONED'
+    read_capacity: int = 100
+    write_capacity: int = 100
+    load_write_capacity: Optional[int] = None
 
     def __post_init__(self):
         if self.append:
@@ -50,36 +236,25 @@ class pullABCD_IDs:
         df.insert(3, 'Parcellated', 0)
 
         # 'Chunking' the workload by creating a batch index
-        # that will assign a common value to 'batches' of jobs (e.g., 10)
-        i = 0
-        while i < (len(df) // config.batch_size):
-            single = np.repeat(i, config.batch_size)
-            if i == 0:
-                batch = single
-            else:
-                batch = np.append(batch, single)
-            i += 1
-        batch = np.append(batch, np.repeat(i, len(df) % config.batch_size))
-        df.insert(0, 'BatchIndex', batch)
-        df.sort_values(by='BatchIndex', inplace=True)
+        # that will assign a common value to 'batches' of jobs (e.g., 10).
+        # Row i goes to batch i // batch_size, so the frame is already in BatchIndex order
+        df.insert(0, 'BatchIndex', np.arange(len(df)) // config.batch_size)
 
         return df
 
-    def python_to_dynamo(self, df: pd.DataFrame) -> dict:
+    def python_to_dynamo(self, df: pd.DataFrame) -> Iterator[dict]:
         """
-        Converts the incoming Pandas dataframe into a 'records' format dictionary.
-        Then uses the boto3.dynamodb TypeSerializer class to convert the dictionary
-        into a list of item records, each in DynamoDB-format JSON (i.e., a JSON format 
-        that can be imported into a DynamoDB table).
+        Converts the incoming Pandas dataframe into DynamoDB-format JSON item records
+        (i.e., a JSON format that can be imported into a DynamoDB table), a chunk of
+        rows at a time. The records are generated lazily as the table writer consumes
+        them, rather than being built up front via to_dict("records") and a
+        TypeSerializer list round trip.
 
         :param df: A Pandas dataframe containing the table data
-        :return ddb_json_list: A list of DynamoDB JSON-formatted records (row data) from the Pandas dataframe
+        :return ddb_json_list: A generator of DynamoDB JSON-formatted records (row data) from the Pandas dataframe
         """
         print('Converting data frame to DynamoDB JSON...')
-        ts = TypeSerializer()
-        dict_list = df.to_dict("records")  # ‘records’ : list-like [{column -> value}, … , {column -> value}] (output is list, not dict)
-        ddb_json_list = [i["M"] for i in ts.serialize(dict_list)["L"]]
-        return (ddb_json_list)
+        return dataframe_to_dynamo(df)
 
     def createDDBTable(self, tableName):
         """
@@ -94,16 +269,9 @@ class pullABCD_IDs:
             print('Creating empty DynamoDB table...')
             self.table = self.session.resource('dynamodb').create_table(
                 TableName=tableName,
-                KeySchema=[
-                    {'AttributeName': 'BatchIndex', 'KeyType': 'HASH'},
-                    {'AttributeName': 'subject_timepoint', 'KeyType': 'RANGE'}],
-                AttributeDefinitions=[
-                    {'AttributeName': 'BatchIndex', 'AttributeType': 'N'},
-                    {'AttributeName': 'subject_timepoint', 'AttributeType': 'S'}],
-                ProvisionedThroughput={
-                    "ReadCapacityUnits": 100,
-                    "WriteCapacityUnits": 100,
-                },
+                KeySchema=KEY_SCHEMA,
+                AttributeDefinitions=ATTRIBUTE_DEFINITIONS,
+                **self._billing_parameters()
             )
             self.table.wait_until_exists()
 
@@ -116,45 +284,118 @@ class pullABCD_IDs:
             # to write2DDBTable
             return self.table
 
-    def batchwrite(self, items, tableName):
+    def _billing_parameters(self) -> dict:
+        if self.billing_mode == 'PAY_PER_REQUEST':
+            return {'BillingMode': 'PAY_PER_REQUEST'}
+        return {
+            'BillingMode': 'PROVISIONED',
+            'ProvisionedThroughput': {
+                'ReadCapacityUnits': self.read_capacity,
+                'WriteCapacityUnits': self.write_capacity,
+            }
+        }
 
-        dynamodb = self.session.client("dynamodb")
+    def _set_write_capacity(self, tableName: str, write_capacity: int):
+        dynamodb = self.session.client('dynamodb')
+        dynamodb.update_table(TableName=tableName, ProvisionedThroughput={
+            'ReadCapacityUnits': self.read_capacity,
+            'WriteCapacityUnits': write_capacity,
+        })
+        dynamodb.get_waiter('table_exists').wait(TableName=tableName)
 
-        response = dynamodb.batch_write_item(
-            RequestItems={tableName: [{"PutRequest": {"Item": item}} for item in items]}
-        )
+    @contextlib.contextmanager
+    def loadCapacity(self, tableName: str):
+        """
+        Raises the table's write capacity to load_write_capacity for the duration of a
+        bulk load, then lowers it back to write_capacity. Yields the write capacity
+        to pace the load to (None for on-demand tables).
 
-        if response["UnprocessedItems"] != {}:
-            return [
-                item["PutRequest"]["Item"] for item in response["UnprocessedItems"][tableName]
-            ]
-        else:
-            return []
+        DynamoDB limits how often capacity can be decreased per day, so a failed
+        decrease is reported rather than raised.
+        """
+        if self.billing_mode == 'PAY_PER_REQUEST':
+            yield None
+            return
+        if not self.load_write_capacity or self.load_write_capacity <= self.write_capacity:
+            yield self.write_capacity
+            return
 
-    def write2DDBTable(self, ddb_json_list: list, tableName: str):
-        print('Writing to the job tracking table...')
+        print(f'Raising {tableName} write capacity to {self.load_write_capacity} WCU for the load...')
+        self._set_write_capacity(tableName, self.load_write_capacity)
+        try:
+            yield self.load_write_capacity
+        finally:
+            try:
+                print(f'Lowering {tableName} write capacity back to {self.write_capacity} WCU...')
+                self._set_write_capacity(tableName, self.write_capacity)
+            except ClientError as err:
+                print(f"Could not lower {tableName} write capacity: {err.response['Error']['Message']}")
 
-        # The size of the item batches (# of rows) that will be written to the table at each pass
-        batch_size = 25
+    def write2DDBTable(self, ddb_json_list: Iterable[dict], tableName: str,
+                       write_capacity: Optional[float] = None) -> int:
+        print('Writing to the job tracking table...')
+        return DDBBulkWriter(self.session, tableName, max_workers=self.max_workers,
+                             write_capacity=write_capacity).write(ddb_json_list)
 
-        while len(ddb_json_list) > 0:
-            batch_items = ddb_json_list[:batch_size]
-            ddb_json_list = ddb_json_list[batch_size:]
+    def importDDBTable(self, ddb_json_list: Iterable[dict], tableName: str, part_items: int = 500_000):
+        """
+        Creates the table from S3 with DynamoDB's ImportTable, for first loads too
+        large to write item by item. Import doesn't consume write capacity and is
+        billed per GB imported.
 
-            unprocessed_items = self.batchwrite(batch_items, tableName)
+        The items are written to s3://import_bucket/import_prefix/tableName/ as gzipped
+        DynamoDB JSON (one {"Item": ...} per line, part_items lines per object), then
+        the import is started and waited on. The table must not already exist.
 
-            if len(unprocessed_items) > batch_size // 2:
-                batch_size = max(batch_size // 2, 1)
+        :param ddb_json_list: An iterable of DynamoDB-JSON items
+        :param tableName: The name of the table to create
+        :return: The import's final ImportTableDescription
+        """
+        print(f'Staging items for DynamoDB import in s3://{self.import_bucket}/{self.import_prefix}/{tableName}/...')
+        s3 = self.session.client('s3')
+        prefix = f'{self.import_prefix}/{tableName}/{int(time.time())}'
+        items = iter(ddb_json_list)
+        for part in itertools.count():
+            lines = [json.dumps({'Item': item}) for item in itertools.islice(items, part_items)]
+            if not lines:
+                break
+            body = io.BytesIO()
+            with gzip.GzipFile(fileobj=body, mode='wb', compresslevel=1, mtime=0) as gz:
+                gz.write(('\n'.join(lines) + '\n').encode('utf-8'))
+            s3.put_object(Bucket=self.import_bucket, Key=f'{prefix}/part-{part:05d}.json.gz', Body=body.getvalue())
 
-            # Put unprocessed items at back of queue.
-            ddb_json_list.extend(unprocessed_items)
+        dynamodb = self.session.client('dynamodb')
+        description = dynamodb.import_table(
+            S3BucketSource={'S3Bucket': self.import_bucket, 'S3KeyPrefix': f'{prefix}/'},
+            InputFormat='DYNAMODB_JSON',
+            InputCompressionType='GZIP',
+            TableCreationParameters={
+                'TableName': tableName,
+                'KeySchema': KEY_SCHEMA,
+                'AttributeDefinitions': ATTRIBUTE_DEFINITIONS,
+                'BillingMode': 'PAY_PER_REQUEST'
+            }
+        )['ImportTableDescription']
+        while description['ImportStatus'] == 'IN_PROGRESS':
+            time.sleep(30)
+            description = dynamodb.describe_import(ImportArn=description['ImportArn'])['ImportTableDescription']
+        if description['ImportStatus'] != 'COMPLETED':
+            raise RuntimeError(f"Import into {tableName} ended {description['ImportStatus']}: "
+                               f"{description.get('FailureCode')} {description.get('FailureMessage')}")
+        print(f"Imported {description.get('ImportedItemCount')} items into {tableName} "
+              f"({description.get('ErrorCount', 0)} errors)")
+        return description
 
     def main(self):
         df = self.getScanIDs()
         df = self.addProcColumns(df)
         ddb_json_list = self.python_to_dynamo(df)
-        self.createDDBTable(config.trackingdb_tablename)
-        self.write2DDBTable(ddb_json_list, config.trackingdb_tablename)
+        if self.import_bucket and len(df) >= self.import_threshold:
+            self.importDDBTable(ddb_json_list, config.trackingdb_tablename)
+        else:
+            self.createDDBTable(config.trackingdb_tablename)
+            with self.loadCapacity(config.trackingdb_tablename) as write_capacity:
+                self.write2DDBTable(ddb_json_list, config.trackingdb_tablename, write_capacity)
 
 
 if __name__ == '__main__':
@@ -166,6 +407,9 @@ if __name__ == '__main__':
         region_name=config.aws_region
     )
     try:
-        pullABCD_IDs(session, config.trackingdb_tablename)
+        pullABCD_IDs(session, config.trackingdb_tablename,
+                     import_bucket=getattr(config, 'trackingdb_import_bucket', None),
+                     billing_mode=getattr(config, 'trackingdb_billing_mode', 'PROVISIONED'),
+                     load_write_capacity=getattr(config, 'trackingdb_load_wcu', None))
     except Exception as exc:
         raise exc
@@ -0,0 +1,37 @@
+import pandas as pd
+from boto3.dynamodb.types import TypeSerializer
+from typing import Iterator
+
+'''
+Streaming conversion of a pandas dataframe into DynamoDB-JSON items, for the job
+tracking table loader in createJobTrackingDB.py (and its benchmark). Kept apart from
+that module so it can be used without the queue configuration.
+'''
+
+
+def _column_attributes(values: pd.Series, serializer: TypeSerializer) -> list:
+    """DynamoDB attribute values for every row of one column, chosen once from its dtype"""
+    kind = values.dtype.kind
+    if kind in 'iu':
+        return [{'N': value} for value in values.to_numpy().astype(str).tolist()]
+    if kind == 'b':
+        return [{'BOOL': value} for value in values.tolist()]
+    # Strings (the common case) directly; anything else the way TypeSerializer would
+    return [{'S': value} if type(value) is str else serializer.serialize(value) for value in values.tolist()]
+
+
+def dataframe_to_dynamo(df: pd.DataFrame, chunk_size: int = 10_000) -> Iterator[dict]:
+    """
+    Lazily converts a dataframe to DynamoDB-JSON items, chunk_size rows at a time.
+
+    Each column is converted for a whole chunk at once based on its dtype (integers to
+    N, booleans to BOOL, strings to S), so only one chunk's worth of items exists at a
+    time and the output matches TypeSerializer's for the same records.
+    """
+    serializer = TypeSerializer()
+    names = [str(name) for name in df.columns]
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+        columns = [_column_attributes(chunk.iloc[:, i], serializer) for i in range(len(names))]
+        for row in zip(*columns):
+            yield dict(zip(names, row))
@@ -9,7 +9,9 @@ from sqlalchemy import (
     String,
     Integer,
     MetaData,
-    create_engine
+    create_engine,
+    func,
+    select
 )
 
 '''
@@ -29,11 +31,19 @@ We only need to tell SQLAlchemy about the table columns we're interested in for
 We'll grab the 'file_source' column since it contains the filename for each scan
 which includes the subjectkey and the timepoint, as well as the qc_outcome. The
 'fmriresults01_id' column is just a numeric id (which Dask needs). We'll craft our query
-from that table to select ony the rows where qc_outcome == 'pass'. Then we'll tell Dask
-to read that query into a dask dataframe (40 partitions seems fastest).
+from that table to select ony the rows where qc_outcome == 'pass'.
 
-Next, we'll break apart 'file_source' into separate columns for subjectkey and time, recode
-time as numeric, then sort the dataframe by subjectkey, then time, then return it.
+Only the subjectkey and timepoint at the start of each filename are used, so on Oracle
+the query does that projection itself (REGEXP_SUBSTR on 'file_source') and returns the
+DISTINCT subject_timepoint strings, rather than sending every full 'file_source' path
+back. The results are read in chunks of config.miNDAR_chunksize rows (default 50000)
+through a server-side cursor, and each chunk is formatted as it arrives, so the full
+selection is never held in memory. (This replaces the earlier idea of reading the query
+into a Dask dataframe, which never worked well with SQLAlchemy.) Other databases get
+the plain 'file_source' selection, read and formatted in the same chunks.
+
+Next, we'll break apart the subject_timepoint into separate columns for subjectkey and time,
+recode time as numeric, then sort the dataframe by subjectkey, then time, then return it.
 
 To get a listing of all the columns (and their types) in all the tables in the miNDAR database
 (i.e., to customize create_query):
@@ -64,24 +74,46 @@ class SQL_Query():
         self.connection = "".join(["oracle+oracledb://", userpass_comb,
                                    "@", self.miNDAR_host, ":1521/ORCL"])
         self.miNDAR_tablename = self.miNDAR_tablename
+        # Rows fetched per round trip / formatted at a time by query2chunks
+        self.chunksize = getattr(config, 'miNDAR_chunksize', 50000)
 
-    def create_query(self):
+    def create_query(self, dialect: str = 'oracle'):
         # Tell SQLAlchemy about the table we're going to query by giving the name and columns (with types)
         fmriresults01 = Table("fmriresults01", MetaData(),
                               Column("fmriresults01_id", Integer, primary_key=True),
                               Column("file_source", String(1024)),
                               Column("qc_outcome", String))
-        # Craft a query to select only the rows where qc_outcome == 'pass'
-        query = fmriresults01.select().where(fmriresults01.c.qc_outcome == "pass")
+        if dialect != 'oracle':
+            # Craft a query to select only the rows where qc_outcome == 'pass'
+            query = fmriresults01.select().where(fmriresults01.c.qc_outcome == "pass")
+            return (query)
+
+        # On Oracle, pull 'NDARINVXXXX_baselineYear1Arm1' out of
+        # '.../NDARINVXXXX_baselineYear1Arm1_ABCD-MPROC-T1_20180101.tgz' in the database
+        # (the first two '_' fields of the last path component) and deduplicate there
+        subject_timepoint = func.regexp_substr(
+            fmriresults01.c.file_source, "([^/_]+_[^/_]+)[^/]*$", 1, 1, None, 1)
+        query = (select(subject_timepoint.label("subject_timepoint"))
+                 .where(fmriresults01.c.qc_outcome == "pass")
+                 .distinct())
         return (query)
 
-    # Run the query and read the results into a pandas dataframe (dask would be quicker, but isn't playing well with SQLAlchemy)
+    # Run the query and read all the results into one pandas dataframe (the projected
+    # Oracle query has no fmriresults01_id, and formatDataframe doesn't need the index)
     def query2dataframe(self, query):
         engine_cloud = create_engine(self.connection)
         with engine_cloud.connect() as conn:
-            raw_df = pd.read_sql_query(query, conn, index_col="_".join(["fmriresults01", "id"]))
+            raw_df = pd.read_sql_query(query, conn)
         return raw_df
 
+    # Run the query through a server-side cursor and yield the results chunksize rows at a time
+    def query2chunks(self, query, engine=None):
+        engine_cloud = engine or create_engine(self.connection, arraysize=self.chunksize)
+        with engine_cloud.connect() as conn:
+            conn = conn.execution_options(stream_results=True, max_row_buffer=self.chunksize)
+            for chunk in pd.read_sql_query(query, conn, chunksize=self.chunksize):
+                yield chunk
+
     # Getting a list of completed subject_ses output archive files already in the S3 bucket
     def getCompleted(self):
         logging.getLogger('Removing Completed Subjects/Sessions')
@@ -101,39 +133,58 @@ class SQL_Query():
         done = pd.Series(done).str.replace('_seg','')
         return (done)
 
-    def formatDataframe(self, raw_df: pd.DataFrame, done=None):
-        # Extract the "file_source" column from the table received from the SQL query to NDA
-        df = raw_df["file_source"]
-        # Split the "file_source" column by "/" and retain the last value (the filename)
-        df = df.str.split("/").str[-1]
-        # Split the new "filename" by "_" 
-        df = df.str.split("_", expand=True)
+    def splitSubjectTime(self, raw_df: pd.DataFrame) -> pd.DataFrame:
+        if "subject_timepoint" in raw_df:
+            # The query already reduced each filename to 'subjectkey_TimeTxt'
+            # (NULL where a filename didn't match the pattern)
+            df = raw_df["subject_timepoint"].dropna().drop_duplicates().str.split("_", n=1, expand=True)
+        else:
+            # Extract the "file_source" column from the table received from the SQL query to NDA
+            df = raw_df["file_source"].dropna()
+            # Split the "file_source" column by "/" and retain the last value (the filename)
+            df = df.str.split("/").str[-1]
+            # Split the new "filename" by "_" and keep the subjectkey and timepoint
+            df = df.str.split("_", n=2, expand=True).iloc[:, :2]
+        # An empty chunk (an empty result, or one holding only NULLs) splits into no
+        # columns at all, and a filename without a '_' into just one; neither has a
+        # subject and timepoint to keep
+        if df.shape[1] < 2:
+            return pd.DataFrame(columns=["subjectkey", "TimeTxt", "Time", "rawsubjses_strs"])
+        df = df.dropna()
         # Rename the columns as appropriate
-        df.rename(
-            columns={0: "subjectkey", 1: "TimeTxt", 2: "Type", 3: "Timestamp"}, inplace=True
-        )
+        df.columns = ["subjectkey", "TimeTxt"]
         # Create a numeric 'Time' column recoded from 'TimeTxt' and convert it to integer type
         df["Time"] = df["TimeTxt"].replace(
             {"baselineYear1Arm1": "0", "2YearFollowUpYArm1": "2", "4YearFollowUpYArm1": "4"}
         )
         df["Time"] = df["Time"].astype(int)
-        # Sort the dataframe by 'subjectkey' and 'Time', then return it inplace.
-        df.sort_values(["subjectkey", "Time"], axis=0, inplace=True)
-        # Create a new column called 'rawsubjses_strs' which combines the subjectkey and 
+        # Create a new column called 'rawsubjses_strs' which combines the subjectkey and
         # timepoint (e.g., NDARXXXXX_baselineYear1Arm1)
         df["rawsubjses_strs"] = df["subjectkey"] + "_" + df["TimeTxt"]
-        # If a pandas series of completed subject_ses outputs was passed 
+        # Drop duplicates within the chunk, so only distinct subject_timepoints are kept between chunks
+        return df.drop_duplicates("rawsubjses_strs")
+
+    def formatDataframe(self, raw_df, done=None):
+        # raw_df is either one dataframe from the SQL query to NDA or an iterable of
+        # chunks of it (from query2chunks), each reduced to its distinct
+        # subject_timepoints as it arrives
+        chunks = [raw_df] if isinstance(raw_df, pd.DataFrame) else raw_df
+        df = pd.concat([self.splitSubjectTime(chunk) for chunk in chunks], ignore_index=True)
+        # Sort the dataframe by 'subjectkey' and 'Time', then return it inplace.
+        df.sort_values(["subjectkey", "Time"], axis=0, inplace=True)
+        # If a pandas series of completed subject_ses outputs was passed
         # (from getCompleted() above), remove those from the dataframe
         if done is not None:
-            df = df[~df.isin(done)]
+            df = df[~df["rawsubjses_strs"].isin(done)]
         # Subset the dataframe to include only the rawsubjses_strs, then reset the index and drop any duplicates
         df = df["rawsubjses_strs"].reset_index(drop=True)
         df = df.drop_duplicates()
         return (df)
 
     def main(self):
-        query = self.create_query()
-        raw_df = self.query2dataframe(query)
+        engine_cloud = create_engine(self.connection, arraysize=self.chunksize)
+        query = self.create_query(engine_cloud.dialect.name)
+        raw_df = self.query2chunks(query, engine_cloud)
         if self.checks3:
             df_done = self.getCompleted()
             df_done_len = len(df_done)